@@ -0,0 +1,8 @@
+"""Benchmark scripts.
+
+Run them from the repository root, for example::
+
+    python -m benchmarks.token_login --help
+
+They create a throwaway database, so they can't harm your data.
+"""
@@ -0,0 +1,57 @@
+import contextlib
+import django
+import os
+import tempfile
+
+
+def setup():
+    """Configure Django.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'website.settings')
+    django.setup()
+
+
+@contextlib.contextmanager
+def test_database():
+    """Create a throwaway database, and the test environment.
+
+    SQLite databases are created as a file rather than in memory, so they can
+    be used from several threads.
+    """
+    from django.db import connection
+    from django.test.utils import setup_test_environment, \
+        teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    with tempfile.TemporaryDirectory(prefix='cym-benchmark-') as tmp:
+        if connection.vendor == 'sqlite':
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = \
+                os.path.join(tmp, 'db.sqlite3')
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            yield
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers.
+    """
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    rank = max(int(round(p / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def report_latencies(name, latencies, elapsed):
+    """Print statistics about request latencies, given in seconds.
+    """
+    print("{0}: {1} requests in {2:.2f}s ({3:.0f}/s)".format(
+        name, len(latencies), elapsed, len(latencies) / elapsed))
+    print("    latency p50 {0:.2f}ms, p95 {1:.2f}ms, p99 {2:.2f}ms, "
+          "max {3:.2f}ms".format(*[
+              1000 * percentile(latencies, p) for p in (50, 95, 99, 100)
+          ]))
@@ -0,0 +1,154 @@
+"""Benchmark of the reminder run and the pages users see most, at scale.
+
+Fills a throwaway database with ``generate_load_data``, then measures the
+``send_reminders`` command (sending to the locmem email backend), rendering
+the profile page and acknowledging tasks. Reports the wall time, the number
+of database queries and the peak memory allocated by Python for each.
+
+Tracing memory allocations slows everything down, use ``--no-memory`` for
+more realistic timings.
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import logging
+import time
+import tracemalloc
+
+from ._common import setup, test_database
+
+
+class Measure(object):
+    def __init__(self):
+        self.elapsed = self.queries = self.peak = None
+
+    def report(self, name, count=None):
+        line = "{0}: {1:.2f}s, {2} queries".format(
+            name, self.elapsed, self.queries)
+        if count:
+            line += " ({0:.2f}ms, {1:.1f} queries each)".format(
+                1000 * self.elapsed / count, self.queries / count)
+        if self.peak is not None:
+            line += ", peak memory {0:.1f} MiB".format(
+                self.peak / (1024 * 1024))
+        print(line)
+
+
+@contextlib.contextmanager
+def measure(trace_memory=True):
+    """Measure the wall time, queries and peak memory of a block.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    result = Measure()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            yield result
+            result.elapsed = time.perf_counter() - start
+        result.queries = len(queries)
+        if trace_memory:
+            result.peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+
+def logged_in_client(user):
+    from django.test import Client
+
+    from call_your_mom.auth import make_login_token
+
+    client = Client()
+    response = client.get('/?token=' + make_login_token(user.id))
+    assert response.status_code == 302
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--tasks-per-user', type=float, default=5)
+    parser.add_argument('--history-days', type=int, default=365)
+    parser.add_argument('--requests', type=int, default=100,
+                        help="Number of profile pages and acknowledgements")
+    parser.add_argument('--digest', action='store_true', default=False,
+                        help="Send a single reminder email per user")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', dest='trace_memory',
+                        action='store_false', default=True,
+                        help="Don't trace memory allocations")
+    args = parser.parse_args()
+
+    setup()
+    # Don't print a line per email sent
+    logging.disable(logging.INFO)
+    with test_database():
+        from django.core import mail
+        from django.core.management import call_command
+        from django.db.models import Count
+        from django.urls import reverse
+
+        from call_your_mom.models import CYMUser, Task
+        from call_your_mom.timezones import local_date
+
+        start = time.perf_counter()
+        call_command('generate_load_data',
+                     users=args.users,
+                     tasks_per_user=args.tasks_per_user,
+                     history_days=args.history_days,
+                     seed=args.seed)
+        print("generated data in {0:.2f}s".format(
+            time.perf_counter() - start))
+
+        # Reminder run
+        mail.outbox = []
+        with measure(args.trace_memory) as result:
+            call_command('send_reminders', digest=args.digest,
+                         stderr=io.StringIO())
+        result.report("reminder run, {0} emails".format(len(mail.outbox)))
+
+        # The users with the most tasks
+        users = list(
+            CYMUser.objects.annotate(tasks=Count('task'))
+            .order_by('-tasks', 'id')[:max(1, args.requests // 10)]
+        )
+        clients = [(user, logged_in_client(user)) for user in users]
+
+        # Profile page
+        with measure(args.trace_memory) as result:
+            for i in range(args.requests):
+                user, client = clients[i % len(clients)]
+                response = client.get(reverse('profile'))
+                assert response.status_code == 200
+        result.report("profile, {0} tasks per user".format(
+            sum(user.tasks for user in users) // len(users)),
+            args.requests)
+
+        # Acknowledging tasks
+        tasks = list(Task.objects.filter(user__in=users)
+                     .select_related('user').order_by('id')[:args.requests])
+        requests = [
+            (task, client)
+            for task in tasks
+            for user, client in clients if user.id == task.user_id
+        ]
+        with measure(args.trace_memory) as result:
+            for task, client in requests:
+                done = local_date(task.user.timezone)
+                response = client.post(
+                    reverse('ack_task', kwargs=dict(task_id=task.id)),
+                    {'done': done.isoformat(),
+                     'due': (done + datetime.timedelta(
+                         days=task.interval_days)).isoformat()})
+                assert response.status_code == 302
+        result.report("ack_task", len(requests))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Benchmark of building reminder emails.
+
+Compares rendering the templates for every message, as was done before, with
+filling the emails compiled once per language.
+"""
+
+import argparse
+import time
+
+from ._common import setup, test_database
+
+
+def legacy_build_reminder(task):
+    """Build a reminder by rendering everything, the way it used to be done.
+    """
+    from django.core.mail import EmailMultiAlternatives
+    from django.template.loader import render_to_string
+    from django.urls import reverse
+    from django.utils import translation
+    from django.utils.translation import gettext as _
+
+    from call_your_mom.auth import make_login_link
+    from website import settings
+
+    user = task.user
+    translation.activate(user.language)
+    link = reverse('ack_task', kwargs=dict(task_id=task.id))
+    link = make_login_link(user.id, link)
+
+    message = EmailMultiAlternatives(
+        subject=_("Reminder - {0}").format(task.name),
+        body="{0}\n\n{1}\n\n{2}\n{3}".format(
+            _("You asked to be reminded of this task by Call Your Mom."),
+            task.description,
+            _("Follow this link to mark this as done and prime the next "
+              "reminder:"),
+            link,
+        ),
+        from_email=settings.EMAIL_FROM,
+        to=[user.email],
+    )
+    message.attach_alternative(
+        render_to_string(
+            'call_your_mom/email_reminder.html',
+            {'name': task.name,
+             'description': task.description,
+             'link': link}),
+        'text/html',
+    )
+    return message
+
+
+def create_tasks(tasks, users):
+    import datetime
+    from django.utils import timezone
+
+    from call_your_mom.models import CYMUser, Task
+    from website import settings
+
+    languages = [code for code, name in settings.LANGUAGES]
+    now = timezone.now()
+    CYMUser.objects.bulk_create([
+        CYMUser(email='user{0}@example.com'.format(i),
+                language=languages[i % len(languages)],
+                last_login_email=now)
+        for i in range(users)
+    ])
+    user_ids = list(CYMUser.objects.values_list('id', flat=True))
+    due = datetime.date.today()
+    Task.objects.bulk_create(
+        [Task(user_id=user_ids[i % len(user_ids)],
+              type=Task.Type.normal,
+              name="task {0}".format(i),
+              description="Description of task {0} & co".format(i),
+              interval_days=7,
+              due=due)
+         for i in range(tasks)],
+    )
+
+
+def run(name, build, tasks):
+    start = time.perf_counter()
+    for task in tasks:
+        build(task).message()
+    elapsed = time.perf_counter() - start
+    print("{0}: {1} messages in {2:.2f}s ({3:.0f}/s)".format(
+        name, len(tasks), elapsed, len(tasks) / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--tasks', type=int, default=50000)
+    parser.add_argument('--users', type=int, default=5000)
+    args = parser.parse_args()
+
+    setup()
+    with test_database():
+        from call_your_mom import emails
+        from call_your_mom.models import Task
+        from call_your_mom.reminders import build_reminder
+
+        create_tasks(args.tasks, args.users)
+        tasks = list(Task.objects.select_related('user').order_by('id'))
+
+        run("rendering templates", legacy_build_reminder, tasks)
+        emails.preload()
+        run("compiled emails", build_reminder, tasks)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Benchmark of logging in with tokens from reminder links.
+
+Several threads follow login links at the same time, either each as a
+different user, or all as the same user (the case of a user clicking several
+reminder links in a row, which contends on the same row).
+"""
+
+import argparse
+import threading
+import time
+
+from ._common import report_latencies, setup, test_database
+
+
+def run(tokens, requests, path):
+    from django.db import connection
+    from django.test import Client
+
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(token):
+        client = Client()
+        url = path + '?token=' + token
+        mine = []
+        try:
+            for _ in range(requests):
+                start = time.perf_counter()
+                response = client.get(url)
+                mine.append(time.perf_counter() - start)
+                assert response.status_code == 302
+        finally:
+            connection.close()
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=worker, args=(token,))
+               for token in tokens]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200,
+                        help="Number of requests per thread")
+    args = parser.parse_args()
+
+    setup()
+    with test_database():
+        from django.urls import reverse
+        from django.utils import timezone
+
+        from call_your_mom.auth import make_login_token
+        from call_your_mom.models import CYMUser
+
+        users = [
+            CYMUser.objects.create(email='user{0}@example.com'.format(i),
+                                   last_login_email=timezone.now())
+            for i in range(args.threads)
+        ]
+        path = reverse('profile')
+
+        for name, tokens in [
+            ("distinct users", [make_login_token(u.id) for u in users]),
+            ("same user", [make_login_token(users[0].id)] * args.threads),
+        ]:
+            latencies, elapsed = run(tokens, args.requests, path)
+            report_latencies(
+                "{0} threads, {1}".format(args.threads, name),
+                latencies, elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+default_app_config = 'call_your_mom.apps.CallYourMomConfig'
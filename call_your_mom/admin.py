@@ -1,8 +1,35 @@
 from django.contrib import admin
+from django.db import transaction
 
-from .models import CYMUser, Task, TaskDone
+from .auth import bump_revision
+from .models import CYMUser, EmailOutbox, ReminderOutbox, Task, TaskDone, \
+    TaskStats
+
+
+@admin.register(CYMUser)
+class CYMUserAdmin(admin.ModelAdmin):
+    # Maintained by `auth.bump_revision()`
+    readonly_fields = ['revision', 'modified']
+
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            super(CYMUserAdmin, self).save_model(request, obj, form, change)
+            if change and 'timezone' in form.changed_data:
+                # Reminders are sent at the local midnight of the due date
+                obj.task_set.reschedule(obj.timezone)
+                bump_revision(obj.id)
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    # `Task.save()` reschedules the reminder
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            super(TaskAdmin, self).save_model(request, obj, form, change)
+            bump_revision(obj.user_id)
 
 
-admin.site.register(CYMUser)
-admin.site.register(Task)
 admin.site.register(TaskDone)
+admin.site.register(ReminderOutbox)
+admin.site.register(EmailOutbox)
+admin.site.register(TaskStats)
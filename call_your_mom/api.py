@@ -0,0 +1,262 @@
+"""JSON API, version 1.
+
+Clients authenticate with an ``Authorization: Token <token>`` header, using
+the token from a login link. The session is also accepted for reading.
+
+Responses to GET requests have an ``ETag`` and ``Last-Modified`` derived from
+the user's revision counter (see `auth.bump_revision()`) and local date, so
+that polling clients get a 304 with a single database query when nothing
+changed.
+"""
+
+import datetime
+import functools
+import json
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse
+from django.urls import reverse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.translation import gettext as _
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
+
+from .auth import get_revision, get_user, verify_login_token
+from .models import Task, TaskDone
+from .tasks import acknowledge_task, clean_ack, clean_task, remove_task, \
+    save_task
+from .timezones import local_date, local_midnight
+
+
+DONE_PAGE_SIZE = 100
+
+
+class BadRequest(ValueError):
+    """The request body is not a JSON object.
+    """
+
+
+def _error(status, message):
+    return JsonResponse({'error': message}, status=status)
+
+
+def _get_api_user(request):
+    header = request.META.get('HTTP_AUTHORIZATION', '').split()
+    if len(header) == 2 and header[0].lower() == 'token':
+        user_id = verify_login_token(header[1])
+        if user_id is None:
+            return None
+        return get_user(user_id)
+    elif request.method in ('GET', 'HEAD') and request.cym_user:
+        return request.cym_user
+    return None
+
+
+def _get_revision(request):
+    # Not from the cached user, which might not have seen changes made by
+    # other processes
+    if not hasattr(request, '_cym_revision'):
+        request._cym_revision = get_revision(request.cym_user.id)
+    return request._cym_revision
+
+
+def _etag(request, *args, **kwargs):
+    user = request.cym_user
+    revision, modified = _get_revision(request)
+    return '{0}-{1}-{2}'.format(user.id, revision,
+                                local_date(user.timezone).isoformat())
+
+
+def _last_modified(request, *args, **kwargs):
+    user = request.cym_user
+    revision, modified = _get_revision(request)
+    # Tasks become due at midnight, even though nothing was modified
+    midnight = local_midnight(local_date(user.timezone), user.timezone)
+    return max(modified, midnight)
+
+
+def api_view(*methods):
+    """Decorator for API views, handling authentication and conditional GET.
+
+    The view gets the user as ``request.cym_user``, and can raise
+    `BadRequest`.
+    """
+    if 'GET' in methods:
+        methods += ('HEAD',)
+
+    def decorator(wrapped):
+        conditional = condition(etag_func=_etag,
+                                last_modified_func=_last_modified)(wrapped)
+
+        @csrf_exempt
+        @functools.wraps(wrapped)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                response = _error(405, _("Method not allowed"))
+                response['Allow'] = ', '.join(methods)
+                return response
+            request.cym_user = _get_api_user(request)
+            if request.cym_user is None:
+                response = _error(401, _("Invalid or missing token"))
+                response['WWW-Authenticate'] = 'Token'
+                return response
+
+            try:
+                response = conditional(request, *args, **kwargs)
+            except BadRequest as e:
+                response = _error(400, str(e))
+            patch_vary_headers(response, ['Authorization', 'Cookie'])
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def _read_body(request):
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except ValueError:
+        raise BadRequest(_("Request body is not valid JSON"))
+    if not isinstance(data, dict):
+        raise BadRequest(_("Request body should be a JSON object"))
+    return data
+
+
+def _get_task(request, task_id):
+    return Task.objects.filter(id=task_id,
+                               user_id=request.cym_user.id).first()
+
+
+def task_dict(task, today):
+    return {
+        'id': task.id,
+        'type': task.type,
+        'name': task.name,
+        'description': task.description,
+        'interval_days': task.interval_days,
+        'due': task.due.isoformat(),
+        'is_due': task.due <= today,
+        'created': task.created.isoformat(),
+    }
+
+
+def _validation_error(errors):
+    return JsonResponse({'errors': errors}, status=400)
+
+
+@api_view('GET', 'POST')
+def task_list(request):
+    """List the user's tasks, or create one.
+    """
+    user = request.cym_user
+    today = local_date(user.timezone)
+    if request.method == 'POST':
+        values, errors = clean_task(_read_body(request), None, user.timezone)
+        if errors:
+            return _validation_error(errors)
+        task = save_task(None, values, user)
+        response = JsonResponse(task_dict(task, today), status=201)
+        response['Location'] = reverse('api_task', args=[task.id])
+        return response
+
+    tasks = Task.objects.filter(user_id=user.id).order_by('due', 'id')
+    return JsonResponse({'tasks': [task_dict(task, today) for task in tasks]})
+
+
+@api_view('GET', 'PUT', 'PATCH', 'DELETE')
+def task_detail(request, task_id):
+    """Get, update, or delete a task.
+
+    PUT needs all the fields, PATCH only the ones to change.
+    """
+    user = request.cym_user
+    task = _get_task(request, task_id)
+    if task is None:
+        return _error(404, _("Couldn't find this task!"))
+
+    if request.method == 'DELETE':
+        remove_task(task)
+        return HttpResponse(status=204)
+    elif request.method in ('PUT', 'PATCH'):
+        data = _read_body(request)
+        if request.method == 'PATCH':
+            data = dict({'type': task.type,
+                         'name': task.name,
+                         'description': task.description,
+                         'interval_days': task.interval_days,
+                         'due': task.due.isoformat()},
+                        **data)
+        values, errors = clean_task(data, task, user.timezone)
+        if errors:
+            return _validation_error(errors)
+        save_task(task, values, user)
+
+    return JsonResponse(task_dict(task, local_date(user.timezone)))
+
+
+@api_view('POST')
+def task_ack(request, task_id):
+    """Acknowledge a task, giving the date it was done (default: today) and
+    when it is due next (default: its next occurrence).
+    """
+    user = request.cym_user
+    task = _get_task(request, task_id)
+    if task is None:
+        return _error(404, _("Couldn't find this task!"))
+
+    today = local_date(user.timezone)
+    body = _read_body(request)
+    data = dict({'done': today.isoformat()}, **body)
+    values, errors = clean_ack(data, task, user.timezone)
+    if 'due' not in body:
+        # Filled in from the date it was done
+        errors.pop('due', None)
+    if errors:
+        return _validation_error(errors)
+    acknowledge_task(task, values, user)
+    return JsonResponse(task_dict(task, today))
+
+
+def _parse_done_key(value):
+    """Parse the position of a page of completions, as ``<done>_<id>``.
+    """
+    try:
+        done, done_id = value.split('_', 1)
+        done = datetime.datetime.strptime(done, '%Y-%m-%d').date()
+        return done, int(done_id)
+    except ValueError:
+        return None
+
+
+@api_view('GET')
+def task_done(request, task_id):
+    """List the completions of a task, most recent first.
+
+    Pages hold `DONE_PAGE_SIZE` completions, the next one is requested by
+    passing the returned ``next`` value as the ``before`` parameter.
+    """
+    task = _get_task(request, task_id)
+    if task is None:
+        return _error(404, _("Couldn't find this task!"))
+
+    done = TaskDone.objects.filter(task=task).order_by('-done', '-id')
+    before = _parse_done_key(request.GET.get('before', ''))
+    if before is not None:
+        done = done.filter(Q(done__lt=before[0]) |
+                           Q(done=before[0], id__lt=before[1]))
+    # Get one more to know if there is a next page
+    done = list(done[:DONE_PAGE_SIZE + 1])
+    next_page = None
+    if len(done) > DONE_PAGE_SIZE:
+        done = done[:DONE_PAGE_SIZE]
+        next_page = '{0}_{1}'.format(done[-1].done.isoformat(), done[-1].id)
+
+    return JsonResponse({
+        'done': [{'id': d.id,
+                  'done': d.done.isoformat(),
+                  'due': d.due.isoformat() if d.due is not None else None,
+                  'recorded': d.recorded.isoformat()}
+                 for d in done],
+        'next': next_page,
+    })
@@ -3,3 +3,13 @@ from django.apps import AppConfig
 
 class CallYourMomConfig(AppConfig):
     name = 'call_your_mom'
+
+    def ready(self):
+        # Connect signal handlers
+        from . import auth  # noqa: F401
+        # Register system checks
+        from . import checks  # noqa: F401
+
+        from . import metrics
+        if metrics.ENABLED:
+            metrics.install()
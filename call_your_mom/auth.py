@@ -1,35 +1,205 @@
 from base64 import b32encode, b32decode
 import datetime
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.mail import send_mail
-from django.core.signing import Signer
+from django.core.signing import BadSignature, Signer
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.shortcuts import redirect
-from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils import timezone, translation
 from django.utils.deprecation import MiddlewareMixin
-from django.utils.translation import gettext as _
+from django.utils.functional import SimpleLazyObject
 import functools
 import logging
+import time
 import urllib.parse
 
 from website import settings
-from .models import CYMUser
+from . import metrics
+from .emails import render_email
+from .models import CYMUser, EmailOutbox
 
 
 logger = logging.getLogger(__name__)
 
 
+USER_CACHE_TIMEOUT = 3600
+
+
+def _user_cache_key(user_id):
+    return 'cym_user:{0}'.format(user_id)
+
+
+def get_user(user_id):
+    """Get a user from its id, using the cache.
+
+    Changes are only seen by other processes if the cache is shared, see
+    `checks.check_shared_cache()`. Returns None if the user doesn't exist.
+    """
+    key = _user_cache_key(user_id)
+    user = cache.get(key)
+    if user is None:
+        try:
+            user = CYMUser.objects.get(id=user_id)
+        except ObjectDoesNotExist:
+            return None
+        cache.set(key, user, USER_CACHE_TIMEOUT)
+    return user
+
+
+def invalidate_user(user_id):
+    """Remove a user from the cache.
+
+    Saving or deleting a `CYMUser` does this automatically, but this has to be
+    called after changing users through `QuerySet.update()`.
+    """
+    cache.delete(_user_cache_key(user_id))
+
+
+def get_revision(user_id):
+    """The revision of a user's data, and when it was last modified.
+
+    This is read from the database rather than the cache, so that changes
+    made by other processes are always seen. Returns None if the user
+    doesn't exist.
+    """
+    return (CYMUser.objects.filter(id=user_id)
+            .values_list('revision', Coalesce('modified', 'created'))
+            .first())
+
+
+def bump_revision(user_id, now=None):
+    """Record that some of the user's data changed.
+
+    This increments `CYMUser.revision` and sets `CYMUser.modified`, which the
+    API uses for conditional requests.
+    """
+    bump_revisions([user_id], now)
+
+
+def bump_revisions(user_ids, now=None):
+    """Like `bump_revision()`, for several users in a single query.
+    """
+    if now is None:
+        now = timezone.now()
+    if not user_ids:
+        return
+    CYMUser.objects.filter(id__in=user_ids).update(
+        revision=F('revision') + 1,
+        modified=now,
+    )
+
+    def invalidate():
+        cache.delete_many([_user_cache_key(user_id) for user_id in user_ids])
+
+    invalidate()
+    # Another request might have cached the old row before this commits
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_save, sender=CYMUser)
+def _user_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None:
+        cache.set(_user_cache_key(instance.id), instance, USER_CACHE_TIMEOUT)
+    else:
+        # The other fields of the instance might be out of date
+        invalidate_user(instance.id)
+
+
+@receiver(post_delete, sender=CYMUser)
+def _user_deleted(sender, instance, **kwargs):
+    invalidate_user(instance.id)
+
+
+def _get_session_user(request, user_id):
+    user = get_user(user_id)
+    if user is None:
+        request.session.pop(CYMUser.USER_ID_KEY, None)
+    return user
+
+
+# Logins closer together than this only update last_login once
+LOGIN_UPDATE_INTERVAL = datetime.timedelta(minutes=1)
+
+
+def record_login(user, now=None):
+    """Update the user's last login time.
+
+    Only that column is written, and not at all if it was updated recently,
+    unless an email was sent since.
+    """
+    if now is None:
+        now = timezone.now()
+    if (user.last_login is not None and
+            user.last_login >= user.last_login_email and
+            user.last_login + LOGIN_UPDATE_INTERVAL > now):
+        return
+    CYMUser.objects.filter(id=user.id).update(last_login=now)
+    user.last_login = now
+    cache.set(_user_cache_key(user.id), user, USER_CACHE_TIMEOUT)
+
+
+# Salt for the tokens in calendar feed URLs, so they can't be used to log in
+FEED_SALT = 'call_your_mom.feed'
+
+
+@functools.lru_cache(maxsize=4)
+def _get_signer(salt=None):
+    return Signer(salt=salt)
+
+
+def _sign(value, salt=None):
+    token = _get_signer(salt).sign(str(value))
+    return b32encode(token.encode('ascii')).decode('ascii')
+
+
+@functools.lru_cache(maxsize=4096)
+def _unsign(token, salt=None):
+    try:
+        token = b32decode(token.upper().encode('ascii')).decode('ascii')
+        return _get_signer(salt).unsign(token)
+    except (ValueError, BadSignature):
+        return None
+
+
+def verify_login_token(token):
+    """Check a login token and return the user ID it is for, or None.
+    """
+    return _unsign(token)
+
+
+def make_feed_token(user_id):
+    """Make the token identifying a user's calendar feed.
+
+    This uses the same scheme as login tokens, but a feed token can't be used
+    to log in.
+    """
+    return _sign(user_id, FEED_SALT)
+
+
+def verify_feed_token(token):
+    """Check a feed token and return the user ID it is for, or None.
+    """
+    return _unsign(token, FEED_SALT)
+
+
 class TokenAuthMiddleware(MiddlewareMixin):
     def process_request(self, request):
         # Use a token to log in
         if 'token' in request.GET:
-            token = request.GET['token']
-            token = b32decode(token.upper().encode('ascii')).decode('ascii')
-            user_id = Signer().unsign(token)
-            request.cym_user = CYMUser.objects.get(id=user_id)
-            request.cym_user.last_login = timezone.now()
-            request.cym_user.save()
+            user_id = verify_login_token(request.GET['token'])
+            user = get_user(user_id) if user_id is not None else None
+            if user is None:
+                logger.warning("Invalid login token")
+                # Redirect to destination without token, not logged in
+                return redirect(request.path)
+
+            request.cym_user = user
+            record_login(user)
             request.session[CYMUser.USER_ID_KEY] = user_id
 
             # Also set preferred language
@@ -42,14 +212,12 @@ class TokenAuthMiddleware(MiddlewareMixin):
 
             # Redirect to destination without token
             return redirect(request.path)
-        # Get user from session
+        # Get user from session, when it is first used
+        # Note that this evaluates to false if the user doesn't exist anymore
         elif CYMUser.USER_ID_KEY in request.session:
             user_id = request.session[CYMUser.USER_ID_KEY]
-            try:
-                request.cym_user = CYMUser.objects.get(id=user_id)
-            except ObjectDoesNotExist:
-                del request.session[CYMUser.USER_ID_KEY]
-                request.cym_user = None
+            request.cym_user = SimpleLazyObject(
+                lambda: _get_session_user(request, user_id))
         # Not logged in
         else:
             request.cym_user = None
@@ -62,11 +230,14 @@ def clear_login(request):
 def needs_login(wrapped):
     @functools.wraps(wrapped)
     def wrapper(request, *args, **kwargs):
-        if request.cym_user is None:
+        if not request.cym_user:
             return redirect(
                 '%s?%s' % (reverse('login'),
                            urllib.parse.urlencode({'path': request.path})),
                 permanent=False)
+        if metrics.ENABLED:
+            with metrics.measure_view(request):
+                return wrapped(request, *args, **kwargs)
         return wrapped(request, *args, **kwargs)
 
     return wrapper
@@ -106,62 +277,45 @@ def email_rate_limit(user, now=None):
                                  "sent email less than 23 hours ago")
 
 
-def make_login_link(user_id, path='/'):
-    signer = Signer()
-    token = signer.sign(str(user_id))
-    token = b32encode(token.encode('ascii')).decode('ascii')
+def make_login_token(user_id):
+    return _sign(user_id)
+
+
+def make_login_link(user_id, path='/', token=None):
+    if token is None:
+        token = make_login_token(user_id)
     return settings.URL_ROOT + path + '?token=' + token
 
 
-def send_login_email(user, path='/'):
+def _queue_email(user, kind, subject, body, html_body):
+    """Add an email to the outbox, to be sent by the ``send_emails`` command.
+    """
+    start = time.perf_counter()
+    EmailOutbox.objects.create(
+        kind=kind,
+        user=user,
+        to=user.email,
+        subject=subject,
+        body=body,
+        html_body=html_body,
+        next_attempt=timezone.now(),
+    )
+    logger.info("Queued %s email in %.1f ms", kind,
+                (time.perf_counter() - start) * 1000)
+
+
+def queue_login_email(user, path='/'):
     email_rate_limit(user)
 
+    # We send the email in the user's preferred language, not the requester's
     link = make_login_link(user.id, path)
+    _queue_email(user, EmailOutbox.Kind.login,
+                 *render_email('login', user.language, link=link))
 
-    # We send the email in the user's preferred language, not the requester's
-    cur_language = translation.get_language()
-    try:
-        translation.activate(user.language)
-        send_mail(
-            subject="Log in to Call Your mom",
-            message="{0}\n\n{1}\n\n{2}".format(
-                _("Someone requested a login link for Call Your Mom. You can "
-                  "use the link below to log in:"),
-                link,
-                _("If this wasn't you, feel free to ignore this message."),
-            ),
-            html_message=render_to_string('call_your_mom/email_login.html', {
-                'link': link,
-            }),
-            from_email=settings.EMAIL_FROM,
-            recipient_list=[user.email],
-        )
-    finally:
-        translation.activate(cur_language)
-
-
-def send_register_email(user):
-    email_rate_limit(user)
 
+def queue_register_email(user):
+    # No rate-limiting on the user, this is only sent to new users, requests
+    # are limited by `ratelimit.limit_email_requests()`
     link = make_login_link(user.id)
-
-    # We send the email in the user's preferred language, not the requester's
-    cur_language = translation.get_language()
-    try:
-        translation.activate(user.language)
-        send_mail(
-            subject="Register for Call Your mom",
-            message="{0}\n\n{1}\n\n{2}".format(
-                _("Someone requested an account for Call Your Mom using this "
-                  "email address. You can use the link below to log in:"),
-                link,
-                _("If this wasn't you, feel free to ignore this message."),
-            ),
-            html_message=render_to_string(
-                'call_your_mom/email_register.html',
-                {'link': link}),
-            from_email=settings.EMAIL_FROM,
-            recipient_list=[user.email],
-        )
-    finally:
-        translation.activate(cur_language)
+    _queue_email(user, EmailOutbox.Kind.register,
+                 *render_email('register', user.language, link=link))
@@ -0,0 +1,229 @@
+"""Bulk import and export of a user's tasks and their completions.
+
+Two formats are supported:
+
+* JSON: ``{"tasks": [{"name": ..., "description": ..., "type": ...,
+  "interval_days": ..., "due": ..., "done": [{"done": ..., "due": ...},
+  ...]}, ...]}``
+* CSV: one row per task, with columns ``name``, ``description``, ``type``,
+  ``interval_days``, ``due`` and ``done``, the last one listing the dates the
+  task was done separated by spaces, each followed by ``/`` and the date it
+  was due if it is known.
+
+Imported tasks are validated with the same rules as the task form, and are
+all created in a single transaction, or not at all.
+"""
+
+import collections
+import csv
+import json
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils.translation import gettext as _
+
+from .auth import bump_revision
+from .models import CYMUser, Task, TaskDone, TaskStats
+from .stats import compute_stats
+from .tasks import clean_task, parse_date
+
+
+FORMATS = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+}
+
+CSV_FIELDS = ['name', 'description', 'type', 'interval_days', 'due',
+              'done']
+
+EXPORT_CHUNK_SIZE = 500
+
+
+class InvalidImport(ValueError):
+    """The imported tasks have errors, nothing was imported.
+
+    `errors` is a list of ``(row, field, message)``, rows numbered from 1.
+    """
+    def __init__(self, errors):
+        super(InvalidImport, self).__init__(
+            "{0} errors in imported tasks".format(len(errors)))
+        self.errors = errors
+
+
+def read_tasks(fileobj, fmt):
+    """Read tasks from a text file, as a list of dicts of strings.
+    """
+    try:
+        if fmt == 'csv':
+            rows = []
+            for row in csv.DictReader(fileobj):
+                row['done'] = [dict(zip(('done', 'due'), entry.split('/', 1)))
+                               for entry in (row.get('done') or '').split()]
+                rows.append(row)
+            return rows
+        elif fmt == 'json':
+            data = json.load(fileobj)
+        else:
+            raise ValueError("Unknown format %r" % fmt)
+    except (UnicodeDecodeError, csv.Error, json.JSONDecodeError) as e:
+        raise InvalidImport([(0, None, str(e))])
+
+    if isinstance(data, dict):
+        data = data.get('tasks')
+    if (not isinstance(data, list) or
+            not all(isinstance(row, dict) for row in data)):
+        raise InvalidImport([(0, None, _("Expected a list of tasks"))])
+    return data
+
+
+def _clean_completions(entries):
+    completions = []
+    errors = []
+    if not isinstance(entries, list):
+        entries = [entries]
+    for entry in entries:
+        if not isinstance(entry, dict):
+            entry = {'done': entry}
+        done = parse_date(entry.get('done'))
+        due = parse_date(entry.get('due'))
+        if done is None or (entry.get('due') and due is None):
+            errors.append(_("Invalid completion {0}").format(
+                json.dumps(entry)))
+        else:
+            completions.append((done, due))
+    completions.sort(key=lambda completion: completion[0])
+    return completions, errors
+
+
+def _create_tasks(user, tasks):
+    """Insert tasks in bulk and set their IDs.
+    """
+    if connection.features.can_return_ids_from_bulk_insert:
+        Task.objects.bulk_create(tasks)
+        return
+
+    # Read the new IDs back, in insertion order. Locking the user prevents
+    # other imports from interleaving, the check catches anything else
+    list(CYMUser.objects.select_for_update().filter(id=user.id)
+         .values_list('id'))
+    last_id = (Task.objects.filter(user_id=user.id)
+               .aggregate(last_id=Max('id'))['last_id']) or 0
+    Task.objects.bulk_create(tasks)
+    ids = list(Task.objects.filter(user_id=user.id, id__gt=last_id)
+               .order_by('id').values_list('id', flat=True))
+    if len(ids) != len(tasks):
+        raise RuntimeError("Tasks were created during import")
+    for task, task_id in zip(tasks, ids):
+        task.id = task_id
+
+
+def import_tasks(user, rows):
+    """Validate and create tasks and their completions for a user.
+
+    Raises `InvalidImport` if any row is invalid. Returns the new tasks.
+    """
+    tasks = []
+    history = []
+    errors = []
+    for number, row in enumerate(rows, 1):
+        values, row_errors = clean_task(row, None, user.timezone)
+        errors.extend((number, field, message)
+                      for field, message in sorted(row_errors.items()))
+        completions, done_errors = _clean_completions(row.get('done') or [])
+        errors.extend((number, 'done', message) for message in done_errors)
+
+        task = Task(user_id=user.id, **values)
+        task.schedule_reminder(user.timezone)
+        tasks.append(task)
+        history.append(completions)
+    if errors:
+        raise InvalidImport(errors)
+
+    with transaction.atomic():
+        _create_tasks(user, tasks)
+        TaskDone.objects.bulk_create(
+            [TaskDone(task_id=task.id, done=done, due=due)
+             for task, completions in zip(tasks, history)
+             for done, due in completions],
+        )
+        TaskStats.objects.bulk_create(
+            [compute_stats(task.id, completions)
+             for task, completions in zip(tasks, history)
+             if completions],
+        )
+        bump_revision(user.id)
+    return tasks
+
+
+def _iter_tasks(user):
+    """Yield ``(task, completions)`` for all the tasks of a user.
+
+    Tasks are read in chunks, with one query for the completions of each.
+    """
+    last_id = 0
+    while True:
+        tasks = list(Task.objects.filter(user_id=user.id, id__gt=last_id)
+                     .order_by('id')[:EXPORT_CHUNK_SIZE])
+        if not tasks:
+            return
+        last_id = tasks[-1].id
+
+        history = collections.defaultdict(list)
+        rows = (TaskDone.objects.filter(task_id__in=[t.id for t in tasks])
+                .order_by('task_id', 'done', 'id')
+                .values_list('task_id', 'done', 'due'))
+        for task_id, done, due in rows:
+            history[task_id].append((done, due))
+        for task in tasks:
+            yield task, history[task.id]
+
+
+def _export_json(user):
+    yield '{"tasks": ['
+    separator = '\n'
+    for task, completions in _iter_tasks(user):
+        yield separator + json.dumps({
+            'name': task.name,
+            'description': task.description,
+            'type': task.type,
+            'interval_days': task.interval_days,
+            'due': task.due.isoformat(),
+            'done': [{'done': done.isoformat(),
+                      'due': due.isoformat() if due is not None else None}
+                     for done, due in completions],
+        })
+        separator = ',\n'
+    yield '\n]}\n'
+
+
+class _Echo(object):
+    """File-like object returning what is written, for `csv.writer`.
+    """
+    def write(self, value):
+        return value
+
+
+def _export_csv(user):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_FIELDS)
+    for task, completions in _iter_tasks(user):
+        yield writer.writerow([
+            task.name,
+            task.description,
+            task.type,
+            task.interval_days,
+            task.due.isoformat(),
+            ' '.join(done.isoformat() +
+                     ('/' + due.isoformat() if due is not None else '')
+                     for done, due in completions),
+        ])
+
+
+def export_tasks(user, fmt):
+    """Generate the export of a user's tasks as chunks of text.
+    """
+    if fmt == 'csv':
+        return _export_csv(user)
+    elif fmt == 'json':
+        return _export_json(user)
+    else:
+        raise ValueError("Unknown format %r" % fmt)
@@ -0,0 +1,24 @@
+from django.core import checks
+
+from website import settings
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """Warn if the cache is local to each process.
+
+    Users and rate-limiting counters are kept in the cache, and changed by
+    all the web workers and commands, so they need to see the same cache.
+    """
+    if settings.DEBUG:
+        return []
+    backend = getattr(settings, 'CACHES', {}).get('default', {}).get(
+        'BACKEND', 'django.core.cache.backends.locmem.LocMemCache')
+    if backend == 'django.core.cache.backends.locmem.LocMemCache':
+        return [checks.Warning(
+            "The default cache is local to each process",
+            hint="Use a cache shared by the web workers and the commands, "
+                 "such as memcached, Redis, or the database cache",
+            id='call_your_mom.W001',
+        )]
+    return []
@@ -0,0 +1,180 @@
+"""Rendering of the reminder, digest, login and register emails.
+
+Only a few values vary between messages of the same kind, so each kind is
+rendered once per language with placeholders for those values, and split
+into its static fragments. Building a message then only joins the fragments
+with the values, without activating the language, looking up translations,
+or rendering templates. Digests are joined from a compiled fragment per task.
+"""
+
+from django.template.loader import get_template
+from django.utils import translation
+from django.utils.html import escape
+from django.utils.translation import gettext as _, ngettext
+import functools
+
+from website import settings
+
+
+# Delimits placeholders, a private use character that templates don't escape
+_MARK = '\ue000'
+
+
+def _placeholders(*names):
+    return {name: _MARK + name + _MARK for name in names}
+
+
+class CompiledText(object):
+    """A text with placeholders, split so that they can be filled quickly.
+    """
+    def __init__(self, text):
+        parts = text.split(_MARK)
+        self.fragments = parts[0::2]
+        self.names = parts[1::2]
+
+    def fill(self, values, escape_values=False):
+        result = [self.fragments[0]]
+        for name, fragment in zip(self.names, self.fragments[1:]):
+            value = values[name]
+            result.append(escape(value) if escape_values else value)
+            result.append(fragment)
+        return ''.join(result)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_template(name):
+    return get_template(name)
+
+
+def _reminder():
+    values = _placeholders('name', 'description', 'link', 'snooze_link')
+    subject = _("Reminder - {0}").format(values['name'])
+    body = "{0}\n\n{1}\n\n{2}\n{3}\n\n{4}\n{5}".format(
+        _("You asked to be reminded of this task by Call Your Mom."),
+        values['description'],
+        _("Follow this link to mark this as done and prime the next "
+          "reminder:"),
+        values['link'],
+        _("Or follow this link to be reminded again later:"),
+        values['snooze_link'],
+    )
+    html = _get_template('call_your_mom/email_reminder.html').render(values)
+    return subject, body, html
+
+
+def _digest():
+    values = _placeholders('tasks')
+    body = "{0}\n\n{1}".format(
+        _("You asked to be reminded of these tasks by Call Your Mom. "
+          "Follow the links to mark them as done and prime the next "
+          "reminders."),
+        values['tasks'],
+    )
+    html = _get_template('call_your_mom/email_reminder_digest.html').render(
+        values)
+    return '', body, html
+
+
+def _digest_task():
+    values = _placeholders('name', 'description', 'link', 'snooze_link')
+    body = "{0}\n{1}{2}\n{3}: {4}".format(
+        values['name'],
+        values['description'],
+        values['link'],
+        _("Remind me again later"),
+        values['snooze_link'],
+    )
+    html = _get_template('call_your_mom/email_reminder_digest_task.html')\
+        .render(values)
+    return '', body, html
+
+
+def _login():
+    values = _placeholders('link')
+    body = "{0}\n\n{1}\n\n{2}".format(
+        _("Someone requested a login link for Call Your Mom. You can use the "
+          "link below to log in:"),
+        values['link'],
+        _("If this wasn't you, feel free to ignore this message."),
+    )
+    html = _get_template('call_your_mom/email_login.html').render(values)
+    return "Log in to Call Your mom", body, html
+
+
+def _register():
+    values = _placeholders('link')
+    body = "{0}\n\n{1}\n\n{2}".format(
+        _("Someone requested an account for Call Your Mom using this email "
+          "address. You can use the link below to log in:"),
+        values['link'],
+        _("If this wasn't you, feel free to ignore this message."),
+    )
+    html = _get_template('call_your_mom/email_register.html').render(values)
+    return "Register for Call Your mom", body, html
+
+
+KINDS = {
+    'reminder': _reminder,
+    'digest': _digest,
+    'digest_task': _digest_task,
+    'login': _login,
+    'register': _register,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def compile_email(kind, language):
+    """Render an email kind in a language, returning the compiled subject,
+    text body and HTML body.
+    """
+    with translation.override(language):
+        return tuple(CompiledText(text) for text in KINDS[kind]())
+
+
+def render_email(kind, language, **values):
+    """Build the subject, text body and HTML body of an email.
+
+    The values are escaped in the HTML body.
+    """
+    subject, body, html = compile_email(kind, language)
+    return (subject.fill(values),
+            body.fill(values),
+            html.fill(values, escape_values=True))
+
+
+@functools.lru_cache(maxsize=256)
+def _digest_subject(language, count):
+    with translation.override(language):
+        return ngettext("Reminder - {0} task",
+                        "Reminder - {0} tasks",
+                        count).format(count)
+
+
+def render_digest(language, tasks):
+    """Build the subject, text body and HTML body of a reminder for several
+    tasks.
+
+    `tasks` is a list of dicts with the values of the reminder email.
+    """
+    _subject, body, html = compile_email('digest', language)
+    _subject, task_body, task_html = compile_email('digest_task', language)
+    bodies = []
+    htmls = []
+    for values in tasks:
+        description = values['description']
+        bodies.append(task_body.fill(dict(
+            values, description=description + "\n" if description else "")))
+        htmls.append(task_html.fill(dict(
+            values, description=": " + description if description else ""),
+            escape_values=True))
+    return (_digest_subject(language, len(tasks)),
+            body.fill({'tasks': "\n\n".join(bodies)}),
+            html.fill({'tasks': "".join(htmls)}))
+
+
+def preload():
+    """Compile every kind of email for all the languages of the website.
+    """
+    for language, _name in settings.LANGUAGES:
+        for kind in KINDS:
+            compile_email(kind, language)
@@ -0,0 +1,111 @@
+"""iCalendar feed of a user's tasks.
+
+Calendar applications poll the feed often, so the serialized feed is cached
+per user revision (see `auth.bump_revision()`), read from the database with
+`auth.get_revision()` rather than from the cached user: it is only generated
+again after the user's tasks change.
+"""
+
+import datetime
+from django.core.cache import cache
+from django.urls import reverse
+
+from website import settings
+from .auth import make_feed_token
+from .models import Task
+
+
+FEED_CACHE_TIMEOUT = 7 * 24 * 3600
+
+
+def make_feed_link(user_id):
+    return settings.URL_ROOT + reverse('calendar_feed',
+                                       args=[make_feed_token(user_id)])
+
+
+def feed_etag(user_id, revision):
+    return '{0}-{1}'.format(user_id, revision)
+
+
+def _escape(text):
+    return (text.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def _fold(line):
+    """Fold a content line to 75 octets, as required by RFC 5545.
+    """
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line
+    parts = []
+    limit = 75
+    while data:
+        # Don't split UTF-8 sequences
+        cut = min(limit, len(data))
+        while cut < len(data) and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(data[:cut].decode('utf-8'))
+        data = data[cut:]
+        limit = 74  # Continuation lines start with a space
+    return '\r\n '.join(parts)
+
+
+def _date(day):
+    return day.strftime('%Y%m%d')
+
+
+def build_feed(user_id, modified):
+    """Serialize the feed of a user's tasks.
+
+    Each task is an all-day event on its due date, stamped with `modified`.
+    Exact tasks, which happen every `Task.interval_days` regardless of when
+    they are done, repeat.
+    """
+    stamp = modified.astimezone(datetime.timezone.utc)
+    stamp = stamp.strftime('%Y%m%dT%H%M%SZ')
+    host = settings.URL_ROOT.split('://', 1)[-1].strip('/')
+
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Call Your Mom//Tasks//EN',
+        'CALSCALE:GREGORIAN',
+        'X-WR-CALNAME:' + _escape("Call Your Mom"),
+    ]
+    tasks = (Task.objects.filter(user_id=user_id)
+             .only('id', 'type', 'name', 'description', 'interval_days',
+                   'due')
+             .order_by('due', 'id'))
+    for task in tasks:
+        lines.extend([
+            'BEGIN:VEVENT',
+            'UID:task-{0}@{1}'.format(task.id, host),
+            'DTSTAMP:' + stamp,
+            'DTSTART;VALUE=DATE:' + _date(task.due),
+            'DTEND;VALUE=DATE:' + _date(task.due + datetime.timedelta(days=1)),
+            'SUMMARY:' + _escape(task.name),
+        ])
+        if task.description:
+            lines.append('DESCRIPTION:' + _escape(task.description))
+        lines.append('URL:' + settings.URL_ROOT +
+                     reverse('ack_task', args=[task.id]))
+        if task.type == Task.Type.exact:
+            lines.append('RRULE:FREQ=DAILY;INTERVAL={0}'.format(
+                task.interval_days))
+        lines.append('END:VEVENT')
+    lines.append('END:VCALENDAR')
+    return ''.join(_fold(line) + '\r\n' for line in lines)
+
+
+def get_feed(user_id, revision, modified):
+    """Get the feed of a user's tasks, from the cache if it is up to date.
+
+    `revision` and `modified` are the ones returned by `auth.get_revision()`.
+    """
+    key = 'cym_feed:{0}'.format(feed_etag(user_id, revision))
+    feed = cache.get(key)
+    if feed is None:
+        feed = build_feed(user_id, modified)
+        cache.set(key, feed, FEED_CACHE_TIMEOUT)
+    return feed
@@ -0,0 +1,143 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+import datetime
+import pytz
+import random
+
+from website import settings
+from ...models import CYMUser, Task, TaskDone, TaskStats
+from ...stats import compute_stats
+
+
+INTERVALS = [1, 2, 3, 7, 7, 7, 14, 14, 30, 30, 60, 90, 180, 365]
+
+
+class Command(BaseCommand):
+    help = ("Create users, tasks and completion history with random values, "
+            "to measure performance at scale. Don't run this on a production "
+            "database")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=1000,
+            help="Number of users to create")
+        parser.add_argument(
+            '--tasks-per-user', type=float, default=5,
+            help="Average number of tasks per user")
+        parser.add_argument(
+            '--exact-ratio', type=float, default=0.2,
+            help="Proportion of tasks that are exact rather than normal")
+        parser.add_argument(
+            '--history-days', type=int, default=365,
+            help="How far back the completion history goes")
+        parser.add_argument(
+            '--chunk-size', type=int, default=500,
+            help="Number of users created at once")
+        parser.add_argument(
+            '--email-prefix', default='load',
+            help="Prefix of the generated email addresses")
+        parser.add_argument(
+            '--seed', type=int, default=None,
+            help="Seed for the random generator, to get the same data again")
+
+    def handle(self, *args, **options):
+        rand = random.Random(options['seed'])
+        now = timezone.now()
+        zones = list(pytz.common_timezones)
+        languages = [code for code, name in settings.LANGUAGES]
+
+        # Users and tasks are read back by email and name after being
+        # created, they would get mixed up with those of a previous run
+        existing = CYMUser.objects.filter(
+            email__startswith=options['email_prefix'] + '-',
+            email__endswith='@example.org',
+        )
+        if existing.exists():
+            raise CommandError(
+                "Users with prefix {0!r} already exist, use another "
+                "--email-prefix".format(options['email_prefix']))
+
+        created = [0, 0, 0]
+        for start in range(0, options['users'], options['chunk_size']):
+            count = min(options['chunk_size'], options['users'] - start)
+            with transaction.atomic():
+                counts = self.create_chunk(
+                    rand, now, zones, languages,
+                    ['{0}-{1}@example.org'.format(options['email_prefix'], i)
+                     for i in range(start, start + count)],
+                    options,
+                )
+            created = [a + b for a, b in zip(created, counts)]
+        self.stderr.write("Created {0} users, {1} tasks, {2} completions"
+                          .format(*created))
+
+    def create_chunk(self, rand, now, zones, languages, emails, options):
+        """Create the users with the given emails, and their data.
+        """
+        CYMUser.objects.bulk_create([
+            CYMUser(email=email,
+                    created=now,
+                    language=rand.choice(languages),
+                    timezone=rand.choice(zones),
+                    last_login=now - datetime.timedelta(
+                        days=rand.randrange(30)),
+                    last_login_email=now - datetime.timedelta(
+                        days=rand.randrange(30, 60)))
+            for email in emails
+        ])
+        # IDs are not returned by bulk_create() on every database
+        users = list(CYMUser.objects.filter(email__in=emails))
+
+        tasks = []
+        for user in users:
+            number = int(rand.expovariate(1.0 / options['tasks_per_user']))
+            today = now.astimezone(pytz.timezone(user.timezone)).date()
+            for i in range(number):
+                interval = rand.choice(INTERVALS)
+                if rand.random() < options['exact_ratio']:
+                    task_type = Task.Type.exact
+                else:
+                    task_type = Task.Type.normal
+                task = Task(
+                    user_id=user.id,
+                    type=task_type,
+                    name="task {0}".format(i),
+                    description=rand.choice(["", "Don't forget!"]),
+                    interval_days=interval,
+                    due=today + datetime.timedelta(
+                        days=rand.randint(-interval, interval)),
+                )
+                task.schedule_reminder(user.timezone)
+                tasks.append(task)
+        Task.objects.bulk_create(tasks)
+        task_ids = {
+            (user_id, name): task_id
+            for task_id, user_id, name in (
+                Task.objects.filter(user__in=users)
+                .values_list('id', 'user_id', 'name'))
+        }
+
+        # Completions, going back from the due date, early or late
+        completions = []
+        stats = []
+        history_start = now.date() - datetime.timedelta(
+            days=options['history_days'])
+        for task in tasks:
+            task.id = task_ids[(task.user_id, task.name)]
+            history = []
+            due = task.due - datetime.timedelta(days=task.interval_days)
+            while due > history_start:
+                done = due + datetime.timedelta(
+                    days=rand.randint(-1, task.interval_days // 2))
+                history.append((done, due))
+                due = due - datetime.timedelta(days=task.interval_days)
+            history.sort()
+            completions.extend(TaskDone(task_id=task.id, done=done, due=due)
+                               for done, due in history)
+            if history:
+                stats.append(compute_stats(task.id, history))
+        TaskDone.objects.bulk_create(completions)
+        TaskStats.objects.bulk_create(stats)
+
+        return len(users), len(tasks), len(completions)
@@ -0,0 +1,40 @@
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+import os
+
+from ...bulk import FORMATS, InvalidImport, import_tasks, read_tasks
+from ...models import CYMUser
+
+
+class Command(BaseCommand):
+    help = ("Import tasks and their completions for a user, from a CSV or "
+            "JSON file in the export format")
+
+    def add_arguments(self, parser):
+        parser.add_argument('email', help="Email of the user")
+        parser.add_argument('file', help="File to import")
+        parser.add_argument(
+            '--format', choices=sorted(FORMATS),
+            help="Format of the file (default: from its extension)")
+
+    def handle(self, *args, **options):
+        try:
+            user = CYMUser.objects.get(email=options['email'])
+        except ObjectDoesNotExist:
+            raise CommandError("No user with email %s" % options['email'])
+
+        fmt = options['format']
+        if fmt is None:
+            fmt = os.path.splitext(options['file'])[1][1:].lower()
+            if fmt not in FORMATS:
+                raise CommandError("Can't tell the format from the file "
+                                   "name, use --format")
+
+        with open(options['file'], encoding='utf-8', newline='') as fp:
+            try:
+                tasks = import_tasks(user, read_tasks(fp, fmt))
+            except InvalidImport as e:
+                for row, field, message in e.errors:
+                    self.stderr.write("Task {0}: {1}".format(row, message))
+                raise CommandError("Nothing was imported")
+        self.stderr.write("Imported {0} tasks".format(len(tasks)))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from ...stats import DEFAULT_CHUNK_SIZE, rebuild_all_stats
+
+
+class Command(BaseCommand):
+    help = "Recompute the statistics of all tasks from their completions"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+            help="Number of tasks whose history is loaded at once")
+
+    def handle(self, *args, **options):
+        total = rebuild_all_stats(chunk_size=options['chunk_size'])
+        self.stderr.write("Rebuilt statistics for {0} tasks".format(total))
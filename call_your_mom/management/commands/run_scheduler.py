@@ -0,0 +1,65 @@
+from django.db import connections
+from django.utils import timezone
+import datetime
+import logging
+import signal
+import threading
+
+from ...reminders import next_due_time, next_retry_time
+from .send_reminders import Command as SendRemindersCommand
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before trying again after an error, such as the database
+# being unavailable
+ERROR_SLEEP = 60
+
+
+class Command(SendRemindersCommand):
+    help = ("Stay running, sending the reminder emails as tasks become due at "
+            "midnight in their owner's timezone")
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--max-sleep', type=int, default=600,
+            help="Maximum number of seconds to sleep before checking the "
+                 "tasks again, to pick up tasks that were created or changed")
+
+    def handle(self, *args, **options):
+        max_sleep = datetime.timedelta(seconds=options['max_sleep'])
+
+        # Exit cleanly between runs on SIGINT/SIGTERM
+        stop = threading.Event()
+
+        def on_signal(signum, frame):
+            self.stderr.write("Got signal {0}, exiting".format(signum))
+            stop.set()
+
+        signal.signal(signal.SIGINT, on_signal)
+        signal.signal(signal.SIGTERM, on_signal)
+
+        while not stop.is_set():
+            try:
+                self.run_once(options)
+
+                now = timezone.now()
+                wakeup = now + max_sleep
+                for time in (next_due_time(now), next_retry_time()):
+                    if time is not None and time < wakeup:
+                        wakeup = time
+            except Exception:
+                logger.exception("Error sending reminders")
+                now = timezone.now()
+                wakeup = now + min(max_sleep,
+                                   datetime.timedelta(seconds=ERROR_SLEEP))
+
+            # Don't hold on to database connections while sleeping
+            for conn in connections.all():
+                conn.close()
+
+            delay = max((wakeup - now).total_seconds(), 0)
+            self.stderr.write("Sleeping until {0} ({1:.0f} seconds)".format(
+                wakeup.isoformat(), delay))
+            stop.wait(delay)
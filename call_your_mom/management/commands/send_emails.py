@@ -0,0 +1,93 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+import datetime
+import logging
+import signal
+import threading
+
+from ...outbox import DEFAULT_BATCH_SIZE, DEFAULT_POLL_INTERVAL, \
+    drain_emails, format_latency, latency_stats, percentile
+from ...reminders import DEFAULT_MAX_ATTEMPTS
+from .run_scheduler import ERROR_SLEEP
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Stay running, sending the login and registration emails queued "
+            "by the website")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+            help="Number of emails claimed at once")
+        parser.add_argument(
+            '--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+            help="Number of times sending an email is attempted before "
+                 "giving up")
+        parser.add_argument(
+            '--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+            help="Number of seconds to wait before checking for new emails, "
+                 "when there are none")
+        parser.add_argument(
+            '--once', action='store_true', default=False,
+            help="Send the queued emails and exit")
+        parser.add_argument(
+            '--stats', type=float, metavar='HOURS',
+            help="Show statistics on the emails queued in the last HOURS "
+                 "and exit")
+
+    def handle(self, *args, **options):
+        if options['stats'] is not None:
+            self.show_stats(options['stats'])
+            return
+
+        # Exit cleanly between batches on SIGINT/SIGTERM
+        stop = threading.Event()
+
+        if not options['once']:
+            def on_signal(signum, frame):
+                self.stderr.write("Got signal {0}, exiting".format(signum))
+                stop.set()
+
+            signal.signal(signal.SIGINT, on_signal)
+            signal.signal(signal.SIGTERM, on_signal)
+
+        while not stop.is_set():
+            try:
+                summary = drain_emails(
+                    batch_size=options['batch_size'],
+                    max_attempts=options['max_attempts'],
+                )
+            except Exception:
+                if options['once']:
+                    raise
+                logger.exception("Error sending emails")
+                # The database connection might be broken
+                for conn in connections.all():
+                    conn.close()
+                stop.wait(ERROR_SLEEP)
+                continue
+            if summary.sent or summary.failed:
+                self.stderr.write(
+                    "Sent {0} emails, {1} failed, delivery latency p50 {2} "
+                    "max {3}".format(
+                        summary.sent, summary.failed,
+                        format_latency(percentile(summary.latencies, 0.5)),
+                        format_latency(max(summary.latencies, default=None)),
+                    ))
+            if options['once']:
+                break
+            stop.wait(options['poll_interval'])
+
+    def show_stats(self, hours):
+        stats = latency_stats(
+            timezone.now() - datetime.timedelta(hours=hours))
+        self.stdout.write(
+            "Sent: {sent}\nFailed: {failed}\nQueued: {queued}\n".format(
+                **stats))
+        for name in ('p50', 'p90', 'p99', 'max', 'oldest_queued'):
+            self.stdout.write("{0}: {1}\n".format(
+                name, format_latency(stats[name])))
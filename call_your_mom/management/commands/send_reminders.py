@@ -1,48 +1,89 @@
-from django.core.mail import send_mail
 from django.core.management.base import BaseCommand
-from django.template.loader import render_to_string
-from django.urls import reverse
-from django.utils import timezone, translation
-from django.utils.translation import gettext as _
+import functools
 
-from website import settings
-from ...auth import make_login_link
-from ...models import Task
+from ... import metrics
+from ...emails import preload as preload_emails
+from ...recurrence import catch_up
+from ...reminders import DEFAULT_BATCH_SIZE, DEFAULT_MAX_ATTEMPTS, \
+    DEFAULT_MESSAGES_PER_CONNECTION, Mailer, drain_outbox, enqueue_reminders
 
 
 class Command(BaseCommand):
-    help = "Cron command sending the reminder emails for tasks that are due"
+    help = ("Cron command queueing and sending the reminder emails for tasks "
+            "that are due")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+            help="Number of tasks queued, or reminders sent, at once")
+        parser.add_argument(
+            '--digest', action='store_true', default=False,
+            help="Send a single email per user, listing all their due tasks")
+        parser.add_argument(
+            '--messages-per-connection', type=int,
+            default=DEFAULT_MESSAGES_PER_CONNECTION,
+            help="Number of emails sent before reconnecting to the relay")
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help="Number of threads sending emails in parallel, each using "
+                 "its own connection. The email time in the metrics is then "
+                 "the sum over all threads")
+        parser.add_argument(
+            '--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+            help="Number of times sending a reminder is attempted before "
+                 "giving up")
+        step = parser.add_mutually_exclusive_group()
+        step.add_argument(
+            '--enqueue-only', action='store_true', default=False,
+            help="Only add due tasks to the outbox, don't send anything")
+        step.add_argument(
+            '--send-only', action='store_true', default=False,
+            help="Only send the reminders already in the outbox")
 
     def handle(self, *args, **options):
-        for task in Task.objects.all():
-            if (task.is_due(task.user.timezone) and
-                    (not task.reminded or task.reminded < task.due)):
-                self.stderr.write(self.style.SUCCESS(
-                    "Sending email to {0} for task {1}".format(
-                        task.user.email,
-                        task.name)))
-
-                translation.activate(task.user.language)
-                link = reverse('ack_task', kwargs=dict(task_id=task.id))
-                link = make_login_link(task.user.id, link)
-
-                send_mail(
-                    subject=_("Reminder - {0}").format(task.name),
-                    message="{0}\n\n{1}\n\n{2}\n{3}".format(
-                        _("You asked to be reminded of this task by Call "
-                          "Your Mom."),
-                        task.description,
-                        _("Follow this link to mark this as done and prime "
-                          "the next reminder:"),
-                        link,
-                    ),
-                    html_message=render_to_string(
-                        'call_your_mom/email_reminder.html',
-                        {'name': task.name,
-                         'description': task.description,
-                         'link': link}),
-                    from_email=settings.EMAIL_FROM,
-                    recipient_list=[task.user.email],
-                )
-                task.reminded = timezone.now()
-                task.save()
+        self.run_once(options)
+
+    def run_once(self, options, now=None):
+        """Queue the due tasks and send the outbox, as options say.
+        """
+        if metrics.ENABLED:
+            with metrics.measure('command', 'send_reminders') as scope:
+                scope.extra = self._run_once(options, now)
+        else:
+            self._run_once(options, now)
+
+    def _run_once(self, options, now):
+        """Returns the counts, for the metrics.
+        """
+        preload_emails()
+        queued = 0
+        if not options['send_only']:
+            moved = catch_up(now)
+            if moved:
+                self.stderr.write("Moved {0} exact tasks to their current "
+                                  "occurrence".format(moved))
+            queued = enqueue_reminders(now, batch_size=options['batch_size'])
+            self.stderr.write("Queued {0} reminders".format(queued))
+        if options['enqueue_only']:
+            return {'queued': queued}
+
+        summary = drain_outbox(
+            batch_size=options['batch_size'],
+            digest=options['digest'],
+            now=now,
+            workers=options['workers'],
+            mailer_factory=functools.partial(
+                Mailer,
+                messages_per_connection=options['messages_per_connection'],
+            ),
+            max_attempts=options['max_attempts'],
+        )
+        self.stderr.write(self.style.SUCCESS(
+            "Sent {0} emails for {1} tasks".format(summary.emails,
+                                                   summary.reminded)))
+        if summary.failed:
+            self.stderr.write(self.style.ERROR(
+                "Failed to send reminders for {0} tasks".format(
+                    summary.failed)))
+        return {'queued': queued, 'emails': summary.emails,
+                'reminded': summary.reminded, 'failed': summary.failed}
@@ -0,0 +1,371 @@
+"""Optional instrumentation of requests, the reminder command and emails.
+
+Set ``METRICS_ENABLED = True`` in the settings to record, per view, the
+request latency, the time spent in the view itself (for ``needs_login``
+views), the number and duration of SQL queries, template rendering time and
+email sending time. They are exposed in the Prometheus text format by
+`get_metrics()` and logged as one JSON line per request or command run.
+
+Metrics are kept in memory, so each process reports its own. When disabled,
+`MetricsMiddleware` removes itself and the other hooks are a single check of
+`ENABLED`; template rendering is only hooked, by patching Django's template
+backend, when enabled.
+
+Queries are counted per thread. Work handed to other threads, such as
+``send_reminders --workers``, is only counted in the command's scope if it
+is wrapped with `in_thread()`; the email time then adds up the time spent in
+each thread, and can be more than the command's duration.
+"""
+
+import contextlib
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import HttpResponse, HttpResponseNotFound
+import functools
+import json
+import logging
+import threading
+import time
+
+from website import settings
+from .ratelimit import client_ip
+
+
+logger = logging.getLogger(__name__)
+
+
+ENABLED = getattr(settings, 'METRICS_ENABLED', False)
+
+# Addresses allowed to read the metrics
+ALLOWED_IPS = getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+
+def _labels(label, value, **extra):
+    pairs = [(label, value)] if label else []
+    pairs.extend(extra.items())
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in pairs)
+
+
+class Counter(object):
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, amount=1, label_value=None):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        yield '# HELP {0} {1}'.format(self.name, self.help)
+        yield '# TYPE {0} counter'.format(self.name)
+        for value, total in sorted(self.values.items()):
+            yield '{0}{1} {2}'.format(
+                self.name, _labels(self.label, value), _number(total))
+
+
+class Histogram(object):
+    def __init__(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, amount, label_value=None):
+        try:
+            counts, sums = self.values[label_value]
+        except KeyError:
+            counts = [0] * (len(self.buckets) + 1)
+            sums = [0.0]
+            self.values[label_value] = counts, sums
+        for i, bound in enumerate(self.buckets):
+            if amount <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        sums[0] += amount
+
+    def render(self):
+        yield '# HELP {0} {1}'.format(self.name, self.help)
+        yield '# TYPE {0} histogram'.format(self.name)
+        for value, (counts, sums) in sorted(self.values.items()):
+            cumulative = 0
+            bounds = [_number(b) for b in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield '{0}_bucket{1} {2}'.format(
+                    self.name, _labels(self.label, value, le=bound),
+                    cumulative)
+            yield '{0}_sum{1} {2}'.format(
+                self.name, _labels(self.label, value), _number(sums[0]))
+            yield '{0}_count{1} {2}'.format(
+                self.name, _labels(self.label, value), cumulative)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+_lock = threading.Lock()
+
+REQUEST_DURATION = Histogram(
+    'cym_request_duration_seconds',
+    "Time to handle requests, including middlewares, by view", 'view')
+VIEW_DURATION = Histogram(
+    'cym_view_duration_seconds',
+    "Time spent in views requiring login, by view", 'view')
+COMMAND_DURATION = Histogram(
+    'cym_command_duration_seconds',
+    "Time to run management commands, by command", 'command')
+QUERIES = Counter(
+    'cym_db_queries_total',
+    "SQL queries made, by view or command", 'scope')
+QUERY_TIME = Counter(
+    'cym_db_query_seconds_total',
+    "Time spent in SQL queries, by view or command", 'scope')
+TEMPLATE_DURATION = Histogram(
+    'cym_template_render_seconds',
+    "Time to render templates, by template", 'template')
+EMAIL_DURATION = Histogram(
+    'cym_email_send_seconds',
+    "Time to send an email to the relay")
+
+METRICS = [REQUEST_DURATION, VIEW_DURATION, COMMAND_DURATION, QUERIES,
+           QUERY_TIME, TEMPLATE_DURATION, EMAIL_DURATION]
+
+
+def render():
+    """The metrics, in the Prometheus text format.
+    """
+    with _lock:
+        lines = [line for metric in METRICS for line in metric.render()]
+    return '\n'.join(lines) + '\n'
+
+
+def clear():
+    with _lock:
+        for metric in METRICS:
+            metric.values.clear()
+
+
+class Scope(object):
+    """What is measured for a request, a view or a command run.
+    """
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.duration = None
+        self.queries = 0
+        self.query_time = 0.0
+        self.template_time = 0.0
+        self.email_time = 0.0
+        self.children = {}
+        self.extra = {}
+
+
+_local = threading.local()
+
+
+def _nothing():
+    # contextlib.nullcontext() needs Python 3.7
+    return contextlib.suppress()
+
+
+def _active_scopes():
+    try:
+        return _local.scopes
+    except AttributeError:
+        _local.scopes = []
+        return _local.scopes
+
+
+def _execute(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        # Scopes can be shared with other threads, see `in_thread()`
+        with _lock:
+            for scope in _active_scopes():
+                scope.queries += 1
+                scope.query_time += elapsed
+
+
+@contextlib.contextmanager
+def measure(kind, name):
+    """Measure a block as a request, view or command, called `name`.
+
+    The name can be changed while in the block. Scopes can be nested, only
+    the outermost one gets logged, with the others' measurements.
+    """
+    scopes = _active_scopes()
+    scope = Scope(kind, name)
+    if scopes:
+        wrapper = _nothing()
+    else:
+        wrapper = connection.execute_wrapper(_execute)
+    scopes.append(scope)
+    start = time.perf_counter()
+    try:
+        with wrapper:
+            yield scope
+    finally:
+        scope.duration = time.perf_counter() - start
+        scopes.pop()
+        _record(scope)
+        if scopes:
+            scopes[-1].children[kind] = scope
+        else:
+            _log(scope)
+
+
+def _record(scope):
+    histogram = {
+        'request': REQUEST_DURATION,
+        'view': VIEW_DURATION,
+        'command': COMMAND_DURATION,
+    }[scope.kind]
+    with _lock:
+        histogram.observe(scope.duration, scope.name)
+        if scope.kind != 'view':
+            # Queries of views are already counted by the request
+            QUERIES.inc(scope.queries, scope.name)
+            QUERY_TIME.inc(scope.query_time, scope.name)
+
+
+def _log(scope):
+    fields = {
+        'kind': scope.kind,
+        'name': scope.name,
+        'duration_ms': round(scope.duration * 1000, 3),
+        'queries': scope.queries,
+        'query_ms': round(scope.query_time * 1000, 3),
+        'template_ms': round(scope.template_time * 1000, 3),
+        'email_ms': round(scope.email_time * 1000, 3),
+    }
+    for kind, child in scope.children.items():
+        fields[kind + '_ms'] = round(child.duration * 1000, 3)
+        fields[kind + '_queries'] = child.queries
+    fields.update(scope.extra)
+    logger.info("metrics %s", json.dumps(fields, sort_keys=True),
+                extra={'metrics': fields})
+
+
+@contextlib.contextmanager
+def _timed(histogram, field, label_value=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            histogram.observe(elapsed, label_value)
+            for scope in _active_scopes():
+                setattr(scope, field, getattr(scope, field) + elapsed)
+
+
+def in_thread(function):
+    """Wrap a function to be run in another thread, so that its queries and
+    email time are recorded in the scopes active in this one.
+    """
+    scopes = list(_active_scopes())
+    if not ENABLED or not scopes:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        active = _active_scopes()
+        previous = active[:]
+        active[:] = scopes
+        try:
+            with connection.execute_wrapper(_execute):
+                return function(*args, **kwargs)
+        finally:
+            active[:] = previous
+
+    return wrapper
+
+
+def time_email():
+    """Context manager measuring the sending of an email.
+    """
+    if not ENABLED:
+        return _nothing()
+    return _timed(EMAIL_DURATION, 'email_time')
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unknown'
+    return match.url_name or match.view_name or 'unknown'
+
+
+def measure_view(request):
+    """Context manager measuring a view, see `auth.needs_login()`.
+    """
+    return measure('view', _view_name(request))
+
+
+class MetricsMiddleware(object):
+    """Measures requests. Put it first, to include the other middlewares.
+    """
+    def __init__(self, get_response):
+        if not ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with measure('request', 'unknown') as scope:
+            response = self.get_response(request)
+            scope.name = _view_name(request)
+            scope.extra = {'status': response.status_code}
+        return response
+
+
+_installed = False
+
+
+def install():
+    """Measure the rendering of templates, called when the app is ready if
+    metrics are enabled.
+
+    Django has no hook for this outside of tests, so this replaces
+    ``Template.render()`` of the Django template backend, for the whole
+    process.
+    """
+    global _installed
+
+    from django.template.backends.django import Template
+
+    if _installed:
+        return
+    _installed = True
+    render_template = Template.render
+
+    def timed_render(self, *args, **kwargs):
+        if not ENABLED:
+            return render_template(self, *args, **kwargs)
+        with _timed(TEMPLATE_DURATION, 'template_time', self.template.name):
+            return render_template(self, *args, **kwargs)
+
+    Template.render = timed_render
+
+
+def get_metrics(request):
+    """Metrics in the Prometheus text format, from allowed addresses.
+    """
+    if not ENABLED or client_ip(request) not in ALLOWED_IPS:
+        return HttpResponseNotFound()
+    return HttpResponse(render(),
+                        content_type='text/plain; version=0.0.4')
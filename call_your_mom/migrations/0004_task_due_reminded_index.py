@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call_your_mom', '0003_cymuser_timezone'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['due', 'reminded'],
+                               name='call_your_m_due_498fa9_idx'),
+        ),
+    ]
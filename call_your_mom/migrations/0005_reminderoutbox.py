@@ -0,0 +1,49 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call_your_mom', '0004_task_due_reminded_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReminderOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True,
+                                        serialize=False, verbose_name='ID')),
+                ('due', models.DateField()),
+                ('status', models.CharField(
+                    choices=[('queued', 'queued'), ('sending', 'sending'),
+                             ('sent', 'sent'), ('failed', 'failed')],
+                    default='queued', max_length=8)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField()),
+                ('claimed', models.DateTimeField(null=True)),
+                ('claimed_by', models.CharField(blank=True,
+                                                max_length=32)),
+                ('sent', models.DateTimeField(null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('task', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to='call_your_mom.Task')),
+            ],
+            options={
+                'verbose_name_plural': 'Reminder outbox',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='reminderoutbox',
+            index=models.Index(fields=['status', 'next_attempt'],
+                               name='call_your_m_status_0f602c_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='reminderoutbox',
+            unique_together={('task', 'due')},
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call_your_mom', '0005_reminderoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='next_reminder_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
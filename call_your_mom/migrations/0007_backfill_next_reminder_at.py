@@ -0,0 +1,36 @@
+import datetime
+from django.db import migrations
+from django.db.models import F, Q
+import pytz
+import pytz.exceptions
+
+
+def backfill_next_reminder_at(apps, schema_editor):
+    Task = apps.get_model('call_your_mom', 'Task')
+
+    pending = Task.objects.filter(Q(reminded__isnull=True) |
+                                  Q(reminded__lt=F('due')))
+    rows = (pending.order_by()
+            .values_list('user__timezone', 'due')
+            .distinct())
+    for tz_name, due in rows:
+        try:
+            tz = pytz.timezone(tz_name)
+        except pytz.exceptions.UnknownTimeZoneError:
+            continue
+        start = datetime.datetime.combine(due, datetime.time.min)
+        pending.filter(user__timezone=tz_name, due=due).update(
+            next_reminder_at=tz.normalize(tz.localize(start)),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call_your_mom', '0006_task_next_reminder_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_next_reminder_at,
+                             migrations.RunPython.noop),
+    ]
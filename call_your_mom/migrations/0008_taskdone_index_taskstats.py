@@ -0,0 +1,51 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_task_stats(apps, schema_editor):
+    TaskDone = apps.get_model('call_your_mom', 'TaskDone')
+    TaskStats = apps.get_model('call_your_mom', 'TaskStats')
+
+    rows = (TaskDone.objects.order_by()
+            .values('task_id')
+            .annotate(count=models.Count('id'),
+                      first_done=models.Min('done'),
+                      last_done=models.Max('done')))
+    TaskStats.objects.bulk_create(
+        [TaskStats(**row) for row in rows.iterator()],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call_your_mom', '0007_backfill_next_reminder_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskStats',
+            fields=[
+                ('task', models.OneToOneField(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    primary_key=True, related_name='stats', serialize=False,
+                    to='call_your_mom.Task')),
+                ('count', models.IntegerField(default=0)),
+                ('first_done', models.DateField(null=True)),
+                ('last_done', models.DateField(null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Task stats',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='taskdone',
+            index=models.Index(fields=['task', '-done'],
+                               name='call_your_m_task_id_10fa24_idx'),
+        ),
+        migrations.RunPython(backfill_task_stats,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:17
+
+import collections
+import itertools
+import json
+
+from django.db import migrations, models
+
+
+def backfill_intervals(apps, schema_editor):
+    # Due dates weren't recorded before, so only intervals can be computed
+    TaskDone = apps.get_model('call_your_mom', 'TaskDone')
+    TaskStats = apps.get_model('call_your_mom', 'TaskStats')
+
+    rows = (TaskDone.objects.order_by('task_id', 'done')
+            .values_list('task_id', 'done'))
+    for task_id, group in itertools.groupby(rows.iterator(),
+                                            key=lambda row: row[0]):
+        dates = [done for _, done in group]
+        intervals = collections.Counter(
+            str((later - earlier).days)
+            for earlier, later in zip(dates, dates[1:])
+        )
+        if intervals:
+            TaskStats.objects.filter(task_id=task_id).update(
+                intervals=json.dumps(intervals, sort_keys=True),
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call_your_mom', '0008_taskdone_index_taskstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskdone',
+            name='due',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddField(
+            model_name='taskstats',
+            name='best_streak',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='taskstats',
+            name='intervals',
+            field=models.TextField(default='{}'),
+        ),
+        migrations.AddField(
+            model_name='taskstats',
+            name='lateness_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='taskstats',
+            name='lateness_total',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='taskstats',
+            name='streak',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_intervals,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call_your_mom', '0009_taskstats_intervals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cymuser',
+            name='modified',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cymuser',
+            name='revision',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call_your_mom', '0010_cymuser_revision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True,
+                                        serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(
+                    choices=[('login', 'login'), ('register', 'register')],
+                    max_length=8)),
+                ('to', models.CharField(max_length=200)),
+                ('subject', models.CharField(max_length=200)),
+                ('body', models.TextField()),
+                ('html_body', models.TextField()),
+                ('status', models.CharField(
+                    choices=[('queued', 'queued'), ('sending', 'sending'),
+                             ('sent', 'sent'), ('failed', 'failed')],
+                    default='queued', max_length=8)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField()),
+                ('claimed', models.DateTimeField(null=True)),
+                ('claimed_by', models.CharField(blank=True,
+                                                max_length=32)),
+                ('sent', models.DateTimeField(null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('user', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to='call_your_mom.CYMUser')),
+            ],
+            options={
+                'verbose_name_plural': 'Email outbox',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='emailoutbox',
+            index=models.Index(fields=['status', 'next_attempt'],
+                               name='call_your_m_status_9da4e7_idx'),
+        ),
+    ]
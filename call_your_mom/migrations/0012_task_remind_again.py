@@ -0,0 +1,75 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:38
+
+import datetime
+from django.db import migrations, models
+from django.db.models import F
+from django.utils import timezone
+import pytz
+import pytz.exceptions
+
+from website import settings
+
+
+def backfill_remind_again_at(apps, schema_editor):
+    """Remind again of tasks that were reminded but not done, after the
+    first delay of `REMIND_AGAIN_DAYS`.
+
+    Tasks whose reminder again would already be due are left alone, rather
+    than reminding of every abandoned task at once after the upgrade.
+    """
+    Task = apps.get_model('call_your_mom', 'Task')
+
+    reminded = Task.objects.filter(reminded__gte=F('due'))
+    reminded.update(remind_count=1)
+    delays = getattr(settings, 'REMIND_AGAIN_DAYS', [3, 7])
+    if not delays:
+        return
+    now = timezone.now()
+    rows = (reminded.order_by()
+            .values_list('user__timezone', 'reminded')
+            .distinct())
+    for tz_name, day in rows:
+        try:
+            tz = pytz.timezone(tz_name)
+        except pytz.exceptions.UnknownTimeZoneError:
+            continue
+        start = datetime.datetime.combine(
+            day + datetime.timedelta(days=delays[0]),
+            datetime.time.min)
+        start = tz.normalize(tz.localize(start))
+        if start <= now:
+            continue
+        reminded.filter(user__timezone=tz_name, reminded=day).update(
+            remind_again_at=start,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call_your_mom', '0011_emailoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reminderoutbox',
+            name='remind_count',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='remind_again_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='remind_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterUniqueTogether(
+            name='reminderoutbox',
+            unique_together={('task', 'due', 'remind_count')},
+        ),
+        migrations.RunPython(backfill_remind_again_at,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:52
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call_your_mom', '0012_task_remind_again'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='task',
+            name='call_your_m_due_498fa9_idx',
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:04
+
+from django.db import migrations, models
+from django.db.models import F, Max, OuterRef, Subquery
+
+
+def backfill_sequence(apps, schema_editor):
+    """Number existing reminders with their ID, which is unique.
+
+    The tasks then continue from the highest number of their reminders.
+    """
+    ReminderOutbox = apps.get_model('call_your_mom', 'ReminderOutbox')
+    Task = apps.get_model('call_your_mom', 'Task')
+
+    ReminderOutbox.objects.update(sequence=F('id'))
+    last = (ReminderOutbox.objects.filter(task=OuterRef('pk'))
+            .order_by().values('task').annotate(last=Max('id'))
+            .values('last'))
+    Task.objects.filter(reminderoutbox__isnull=False).update(
+        reminders_queued=Subquery(last, output_field=models.IntegerField()),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call_your_mom', '0013_remove_task_due_reminded_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reminderoutbox',
+            name='sequence',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='reminders_queued',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_sequence, migrations.RunPython.noop),
+    ]
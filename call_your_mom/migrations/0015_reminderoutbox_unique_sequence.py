@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:04
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call_your_mom', '0014_reminder_sequence'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='reminderoutbox',
+            unique_together={('task', 'sequence')},
+        ),
+    ]
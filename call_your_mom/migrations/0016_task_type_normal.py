@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:30
+
+from django.db import migrations
+
+
+def set_normal_type(apps, schema_editor):
+    """Tasks created by the forms and the API had no type, make them normal.
+    """
+    Task = apps.get_model('call_your_mom', 'Task')
+    Task.objects.filter(type='').update(type='normal')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call_your_mom', '0015_reminderoutbox_unique_sequence'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_normal_type, migrations.RunPython.noop),
+    ]
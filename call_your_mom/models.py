@@ -1,8 +1,16 @@
+import json
+import logging
+
 from django.db import models
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from model_utils import Choices
-import pytz
+import pytz.exceptions
+
+from .timezones import local_date, local_midnight
+
+
+logger = logging.getLogger(__name__)
 
 
 class CYMUser(models.Model):
@@ -17,12 +25,97 @@ class CYMUser(models.Model):
     last_login = models.DateTimeField(null=True)
     last_login_email = models.DateTimeField()
     timezone = models.CharField(max_length=100, default='UTC')
+    # Incremented whenever the user's tasks change, see `auth.bump_revision()`
+    revision = models.IntegerField(default=0)
+    modified = models.DateTimeField(null=True)
 
     def __str__(self):
         return "<CYMUser id={0} email={1}>".format(self.id, self.email)
 
 
+def zones_by_local_date(now=None):
+    """Group the timezones of all users by their current local date.
+
+    Returns a dict mapping each local date to a list of timezone names.
+    """
+    if now is None:
+        now = timezone.now()
+
+    zones_by_date = {}
+    timezones = (CYMUser.objects.order_by()
+                 .values_list('timezone', flat=True).distinct())
+    for name in timezones:
+        try:
+            day = local_date(name, now)
+        except pytz.exceptions.UnknownTimeZoneError:
+            logger.warning("Unknown timezone %r, skipping its tasks", name)
+            continue
+        zones_by_date.setdefault(day, []).append(name)
+    return zones_by_date
+
+
+class TaskQuerySet(models.QuerySet):
+    def to_remind(self, now=None):
+        """Filter tasks that became due and were not reminded yet, or that
+        should be reminded again.
+
+        These are range scans on the `Task.next_reminder_at` and
+        `Task.remind_again_at` indexes.
+        """
+        if now is None:
+            now = timezone.now()
+        return self.filter(models.Q(next_reminder_at__lte=now) |
+                           models.Q(remind_again_at__lte=now))
+
+    def with_status(self, today):
+        """Annotate tasks with `is_due_now` and `last_done`, computed in SQL.
+
+        `today` is the current date in the owner's timezone.
+        """
+        last_done = (TaskDone.objects.filter(task=models.OuterRef('pk'))
+                     .order_by('-done')
+                     .values('done')[:1])
+        return self.annotate(
+            is_due_now=models.Case(
+                models.When(due__lte=today, then=models.Value(True)),
+                default=models.Value(False),
+                output_field=models.BooleanField(),
+            ),
+            last_done=models.Subquery(last_done,
+                                      output_field=models.DateField()),
+        )
+
+    def reschedule(self, user_timezone):
+        """Recompute `Task.next_reminder_at`, for tasks of a single timezone.
+
+        This issues a single UPDATE, computing the instant for each distinct
+        due date.
+        """
+        pending = self.not_reminded()
+        dues = pending.order_by().values_list('due', flat=True).distinct()
+        whens = [
+            models.When(due=due,
+                        then=models.Value(local_midnight(due, user_timezone),
+                                          output_field=models.DateTimeField()))
+            for due in dues
+        ]
+        if not whens:
+            return 0
+        return pending.update(next_reminder_at=models.Case(
+            *whens,
+            output_field=models.DateTimeField(),
+        ))
+
+    def not_reminded(self):
+        """Filter tasks for which no reminder was sent since they became due.
+        """
+        return self.filter(models.Q(reminded__isnull=True) |
+                           models.Q(reminded__lt=models.F('due')))
+
+
 class Task(models.Model):
+    objects = TaskQuerySet.as_manager()
+
     Type = Choices(('normal', _('normal')), ('exact', _('exact')))
     type = models.CharField(max_length=8, choices=Type)
     user = models.ForeignKey(CYMUser, on_delete=models.CASCADE)
@@ -32,18 +125,208 @@ class Task(models.Model):
     interval_days = models.IntegerField()
     due = models.DateField()
     reminded = models.DateField(null=True)
+    # When the reminder should be sent, if it wasn't yet. Derived from `due`,
+    # `reminded` and the user's timezone, see `schedule_reminder()`
+    next_reminder_at = models.DateTimeField(null=True, db_index=True)
+    # Number of reminders sent for the current due date, and when to send
+    # the next one if the task is still not done, see
+    # `reminders.mark_reminded()`
+    remind_count = models.IntegerField(default=0)
+    remind_again_at = models.DateTimeField(null=True, db_index=True)
+    # Last `ReminderOutbox.sequence` used for this task, never decreases
+    reminders_queued = models.IntegerField(default=0)
 
-    def is_due(self, user_timezone):
-        user_timezone = pytz.timezone(user_timezone)
-        now = timezone.now()
-        now_local = timezone.make_naive(now, user_timezone)
-        return self.due <= now_local.date()
+    # Fields updated by `schedule_reminder()`
+    SCHEDULE_FIELDS = ['next_reminder_at', 'remind_count', 'remind_again_at']
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Task, cls).from_db(db, field_names, values)
+        instance._scheduled = instance._schedule_key()
+        return instance
+
+    def _schedule_key(self):
+        # Deferred fields are not in __dict__, and are not saved either
+        return self.__dict__.get('due'), self.__dict__.get('reminded')
+
+    def schedule_reminder(self, user_timezone):
+        """Update `next_reminder_at` after changing `due` or `reminded`.
+
+        This is done by `save()` if needed, call it beforehand if the user's
+        timezone is at hand, to avoid querying the user.
+        """
+        if self.reminded is None or self.reminded < self.due:
+            self.next_reminder_at = local_midnight(self.due, user_timezone)
+            # New occurrence, forget about the reminders of the previous one
+            self.remind_count = 0
+            self.remind_again_at = None
+        else:
+            self.next_reminder_at = None
+        self._scheduled = self._schedule_key()
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if (self._schedule_key() != getattr(self, '_scheduled', None) and
+                (update_fields is None or
+                 {'due', 'reminded'}.intersection(update_fields))):
+            self.schedule_reminder(self.user.timezone)
+            if update_fields is not None:
+                kwargs['update_fields'] = (set(update_fields) |
+                                           set(self.SCHEDULE_FIELDS))
+        super(Task, self).save(*args, **kwargs)
+
+    def reset_reminders(self, user_timezone):
+        """Stop reminding again, after the task was done or changed, and
+        schedule the next reminder.
+        """
+        self.remind_count = 0
+        self.remind_again_at = None
+        self.schedule_reminder(user_timezone)
+
+    def is_due(self, user_timezone, now=None):
+        return self.due <= local_date(user_timezone, now)
 
 
 class TaskDone(models.Model):
     class Meta:
         verbose_name_plural = "Tasks done"
+        indexes = [
+            models.Index(fields=['task', '-done']),
+        ]
 
     task = models.ForeignKey(Task, on_delete=models.CASCADE)
     done = models.DateField()
+    # When the task was due at the time, unknown for old records
+    due = models.DateField(null=True)
     recorded = models.DateTimeField(auto_now_add=True)
+
+
+class TaskStats(models.Model):
+    """Summary of the `TaskDone` of a task, updated as they are recorded.
+
+    See the `stats` module.
+    """
+    class Meta:
+        verbose_name_plural = "Task stats"
+
+    task = models.OneToOneField(Task, on_delete=models.CASCADE,
+                                primary_key=True, related_name='stats')
+    count = models.IntegerField(default=0)
+    first_done = models.DateField(null=True)
+    last_done = models.DateField(null=True)
+    # JSON object mapping the number of days between successive completions
+    # to how many times that happened
+    intervals = models.TextField(default='{}')
+    # Sum of the days between due date and completion (negative if early)
+    lateness_total = models.IntegerField(default=0)
+    # Number of completions for which the due date is known
+    lateness_count = models.IntegerField(default=0)
+    # Number of most recent completions in a row done on time
+    streak = models.IntegerField(default=0)
+    best_streak = models.IntegerField(default=0)
+
+    @property
+    def mean_interval(self):
+        """Average number of days between completions, or None.
+        """
+        if self.count < 2:
+            return None
+        return (self.last_done - self.first_done).days / (self.count - 1)
+
+    @property
+    def median_interval(self):
+        """Median number of days between completions, or None.
+        """
+        intervals = json.loads(self.intervals)
+        histogram = sorted((int(days), number)
+                           for days, number in intervals.items())
+        total = sum(number for days, number in histogram)
+        if not total:
+            return None
+        # Find the middle value(s) in the sorted intervals
+        middle = []
+        seen = 0
+        for days, number in histogram:
+            for position in ((total - 1) // 2, total // 2):
+                if seen <= position < seen + number:
+                    middle.append(days)
+            seen += number
+        return sum(middle) / len(middle)
+
+    @property
+    def mean_lateness(self):
+        """Average number of days the task was done after it was due, or None.
+        """
+        if not self.lateness_count:
+            return None
+        return self.lateness_total / self.lateness_count
+
+
+class ReminderOutbox(models.Model):
+    """A reminder email waiting to be sent, or that was sent.
+
+    Rows are created by the due-task scan and go from ``queued`` to
+    ``sending`` (claimed by a worker) to ``sent``, or back to ``queued`` with
+    a later `next_attempt` if sending failed, until too many attempts
+    failed.
+    """
+    class Meta:
+        verbose_name_plural = "Reminder outbox"
+        unique_together = [('task', 'sequence')]
+        indexes = [
+            models.Index(fields=['status', 'next_attempt']),
+        ]
+
+    Status = Choices(('queued', _('queued')),
+                     ('sending', _('sending')),
+                     ('sent', _('sent')),
+                     ('failed', _('failed')))
+    task = models.ForeignKey(Task, on_delete=models.CASCADE)
+    due = models.DateField()
+    # 1 for the first reminder for this due date, then 2, ...
+    remind_count = models.IntegerField(default=1)
+    # Increases with each reminder queued for the task, whatever the due
+    # date, see `Task.reminders_queued`
+    sequence = models.IntegerField(default=0)
+    status = models.CharField(max_length=8, choices=Status,
+                              default=Status.queued)
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField()
+    claimed = models.DateTimeField(null=True)
+    claimed_by = models.CharField(max_length=32, blank=True)
+    sent = models.DateTimeField(null=True)
+    last_error = models.TextField(blank=True)
+
+
+class EmailOutbox(models.Model):
+    """A login or registration email waiting to be sent, or that was sent.
+
+    Requests only add emails here, they are sent by the ``send_emails``
+    command. Status changes are the same as for `ReminderOutbox`; `created`
+    and `sent` give the delivery latency.
+    """
+    class Meta:
+        verbose_name_plural = "Email outbox"
+        indexes = [
+            models.Index(fields=['status', 'next_attempt']),
+        ]
+
+    Kind = Choices(('login', _('login')),
+                   ('register', _('register')))
+    Status = ReminderOutbox.Status
+    kind = models.CharField(max_length=8, choices=Kind)
+    user = models.ForeignKey(CYMUser, on_delete=models.CASCADE)
+    to = models.CharField(max_length=200)
+    subject = models.CharField(max_length=200)
+    body = models.TextField()
+    html_body = models.TextField()
+    status = models.CharField(max_length=8, choices=Status,
+                              default=Status.queued)
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField()
+    claimed = models.DateTimeField(null=True)
+    claimed_by = models.CharField(max_length=32, blank=True)
+    sent = models.DateTimeField(null=True)
+    last_error = models.TextField(blank=True)
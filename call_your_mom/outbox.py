@@ -0,0 +1,172 @@
+"""Sending of the login and registration emails queued by requests.
+
+Requests only add the rendered emails to `EmailOutbox` (see
+`auth.queue_login_email()`), so they don't wait on the mail relay. The
+``send_emails`` command delivers them, with the same connection handling and
+retries as reminders.
+
+The bodies contain login links, which don't expire, so they are cleared once
+an email is sent or given up on; the rest of the row is kept for statistics.
+"""
+
+import collections
+from django.core.mail import EmailMultiAlternatives
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+import uuid
+
+from website import settings
+from .models import EmailOutbox
+from .reminders import DEFAULT_MAX_ATTEMPTS, Mailer, SerialDelivery, \
+    record_results, requeue_stale, skip_locked
+
+
+DEFAULT_BATCH_SIZE = 100
+
+# Seconds between checks of the outbox when it is empty
+DEFAULT_POLL_INTERVAL = 2.0
+
+
+Summary = collections.namedtuple('Summary', ['sent', 'failed', 'latencies'])
+
+
+def build_message(email):
+    """Build the message to send from an `EmailOutbox` row.
+    """
+    message = EmailMultiAlternatives(
+        subject=email.subject,
+        body=email.body,
+        from_email=settings.EMAIL_FROM,
+        to=[email.to],
+    )
+    message.attach_alternative(email.html_body, 'text/html')
+    return message
+
+
+def claim_emails(batch_size=DEFAULT_BATCH_SIZE, now=None):
+    """Claim up to `batch_size` queued emails for this worker.
+
+    Like `reminders.claim_reminders()`, this is an UPDATE conditional on the
+    emails still being queued.
+    """
+    if now is None:
+        now = timezone.now()
+    token = uuid.uuid4().hex
+    queued = EmailOutbox.objects.filter(
+        status=EmailOutbox.Status.queued,
+        next_attempt__lte=now,
+    )
+    with transaction.atomic():
+        ids = list(
+            skip_locked(queued)
+            .order_by('next_attempt', 'id')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return []
+        queued.filter(id__in=ids).update(
+            status=EmailOutbox.Status.sending,
+            claimed=now,
+            claimed_by=token,
+            attempts=F('attempts') + 1,
+        )
+    return list(EmailOutbox.objects.filter(claimed_by=token).order_by('id'))
+
+
+def drain_emails(batch_size=DEFAULT_BATCH_SIZE, mailer_factory=Mailer,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, now=None):
+    """Send the queued emails.
+
+    Returns a `Summary` with the number of emails sent and failed, and the
+    delivery latency of each email sent, in seconds since it was queued.
+    """
+    def current_time():
+        return now if now is not None else timezone.now()
+
+    requeue_stale(current_time(), model=EmailOutbox)
+    sent = failed = 0
+    latencies = []
+    with SerialDelivery(mailer_factory) as delivery:
+        while True:
+            batch = claim_emails(batch_size, current_time())
+            if not batch:
+                break
+
+            results = []
+            try:
+                for email in batch:
+                    error = delivery.submit(build_message, email).result()
+                    results.append((email, error))
+                    if error is None:
+                        sent += 1
+                        latencies.append(
+                            (current_time() - email.created).total_seconds())
+                    else:
+                        failed += 1
+            finally:
+                record_results(results, max_attempts, current_time(),
+                               model=EmailOutbox)
+                clear_bodies([email.id for email, error in results])
+    return Summary(sent, failed, latencies)
+
+
+def clear_bodies(ids):
+    """Clear the bodies of the given emails, if they won't be sent again.
+    """
+    if not ids:
+        return
+    EmailOutbox.objects.filter(
+        id__in=ids,
+        status__in=[EmailOutbox.Status.sent, EmailOutbox.Status.failed],
+    ).update(body='', html_body='')
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers, or None if it's empty.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(int(round(fraction * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def latency_stats(since, now=None):
+    """Statistics on the emails queued since the given time.
+
+    Returns a dict with the number of emails sent, failed and still queued,
+    the delivery latency percentiles in seconds, and how long the oldest
+    queued email has been waiting.
+    """
+    if now is None:
+        now = timezone.now()
+    emails = EmailOutbox.objects.filter(created__gte=since)
+    latencies = [
+        (sent - created).total_seconds()
+        for created, sent in (emails.filter(status=EmailOutbox.Status.sent)
+                              .values_list('created', 'sent'))
+    ]
+    counts = collections.Counter(emails.values_list('status', flat=True))
+    oldest = (emails.filter(status__in=[EmailOutbox.Status.queued,
+                                        EmailOutbox.Status.sending])
+              .order_by('created').values_list('created', flat=True)
+              .first())
+    return {
+        'sent': counts[EmailOutbox.Status.sent],
+        'failed': counts[EmailOutbox.Status.failed],
+        'queued': (counts[EmailOutbox.Status.queued] +
+                   counts[EmailOutbox.Status.sending]),
+        'p50': percentile(latencies, 0.50),
+        'p90': percentile(latencies, 0.90),
+        'p99': percentile(latencies, 0.99),
+        'max': max(latencies) if latencies else None,
+        'oldest_queued': ((now - oldest).total_seconds()
+                          if oldest is not None else None),
+    }
+
+
+def format_latency(seconds):
+    if seconds is None:
+        return "-"
+    return "{0:.3f}s".format(seconds)
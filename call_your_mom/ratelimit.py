@@ -0,0 +1,115 @@
+"""Rate-limiting of requests, using counters in the cache.
+
+This stops floods of requests before they reach the database. The policy on
+how often a user can get emails is still enforced by
+`auth.email_rate_limit()`.
+
+The counters have to be shared by all the web processes for the limits to
+hold, so the cache can't be the default per-process one (see `checks`).
+"""
+
+from django.contrib import messages
+from django.core.cache import cache
+from django.shortcuts import redirect
+from django.utils import timezone
+from django.utils.translation import gettext as _
+import functools
+import hashlib
+import logging
+
+from website import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimit(object):
+    """Allow `limit` hits per `period` seconds for each identifier.
+
+    This is a fixed-window counter: hits are counted per window of `period`
+    seconds, and the count starts over with the next window. Incrementing
+    the counter is atomic in the cache, so concurrent requests can't get
+    through together. Because windows are fixed, up to twice `limit` hits
+    can get through around the boundary between two windows, the end of one
+    and the start of the next.
+    """
+    def __init__(self, name, limit, period):
+        self.name = name
+        self.limit = limit
+        self.period = period
+
+    def _key(self, identifier, now):
+        window = int(now.timestamp()) // self.period
+        digest = hashlib.md5(identifier.encode('utf-8')).hexdigest()
+        return 'cym_ratelimit:{0}:{1}:{2}'.format(self.name, window, digest)
+
+    def hit(self, identifier, now=None):
+        """Count a hit, returning False if over the limit.
+        """
+        if now is None:
+            now = timezone.now()
+        key = self._key(identifier, now)
+        if cache.add(key, 1, self.period):
+            return True
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # Expired in between
+            cache.add(key, 1, self.period)
+            return True
+        return count <= self.limit
+
+
+# Requests for emails, per address, whether an account exists or not. The
+# 5-minute delay between emails of `auth.email_rate_limit()` can then be
+# enforced without the database. Emails only go to the user's address, so
+# this is also the limit per user; the longer delays of the policy, per
+# user, are still checked by `auth.email_rate_limit()`. A single hit per
+# window lets at most 2 requests through in 5 minutes, at the boundary
+EMAIL_LIMIT = RateLimit('email', 1, 5 * 60)
+
+# Requests for emails, per client address
+IP_LIMIT = RateLimit('ip', 30, 3600)
+
+
+def client_ip(request):
+    """The address of the client.
+
+    If the website is behind reverse proxies, set ``CLIENT_IP_HEADER`` in
+    the settings to the header they add the client's address to, and
+    ``CLIENT_IP_PROXIES`` to their number. Each proxy appends the address it
+    got the request from, so the client's is that many entries from the end;
+    the entries before it come from the client and can't be trusted.
+    """
+    header = getattr(settings, 'CLIENT_IP_HEADER', None)
+    if header and header in request.META:
+        proxies = getattr(settings, 'CLIENT_IP_PROXIES', 1)
+        addresses = [a.strip() for a in request.META[header].split(',')]
+        return addresses[max(0, len(addresses) - proxies)]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def limit_email_requests(wrapped):
+    """Decorator rate-limiting views sending emails, per IP and per email.
+
+    Rejected POST requests are redirected to the confirmation page with an
+    error message.
+    """
+    @functools.wraps(wrapped)
+    def wrapper(request, *args, **kwargs):
+        if request.method == 'POST':
+            email = (request.POST.get('email') or '').strip().lower()
+            if not IP_LIMIT.hit(client_ip(request)):
+                logger.warning("Rate-limiting client %s",
+                               client_ip(request))
+            elif email and not EMAIL_LIMIT.hit(email):
+                logger.warning("Rate-limiting requests for email")
+            else:
+                return wrapped(request, *args, **kwargs)
+            messages.add_message(
+                request, messages.ERROR,
+                _("Rate-limiting is active. Please try again later."))
+            return redirect('confirm')
+        return wrapped(request, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,119 @@
+"""When tasks are due next.
+
+Normal tasks are due `interval_days` after they were last done. Exact tasks
+stay on a fixed schedule: they are due every `interval_days` from their
+original due date, whenever they are actually done, and occurrences that
+were missed are skipped.
+"""
+
+import datetime
+from django.db import transaction
+from django.db.models import Case, DateField, DateTimeField, F, \
+    IntegerField, Q, Value, When
+from django.utils import timezone
+import functools
+import operator
+
+from .auth import bump_revisions
+from .models import Task, zones_by_local_date
+
+
+# Maximum number of (due, interval) pairs updated in one query
+DEFAULT_CHUNK_SIZE = 100
+
+
+def next_due(task_type, due, interval_days, done):
+    """The date a task is due next, after it was done on `done`.
+
+    For exact tasks, this is the first occurrence after `done` on the grid
+    starting at `due`, skipping the current occurrence even if it was done
+    early.
+    """
+    interval = datetime.timedelta(days=interval_days)
+    if task_type == Task.Type.exact:
+        occurrences = max(1, (done - due).days // interval_days + 1)
+        return due + occurrences * interval
+    return done + interval
+
+
+def latest_occurrence(due, interval_days, today):
+    """The last occurrence of an exact task on or before `today`.
+
+    Returns `due` if it is not in the past.
+    """
+    if due >= today:
+        return due
+    occurrences = (today - due).days // interval_days
+    return due + datetime.timedelta(days=occurrences * interval_days)
+
+
+def catch_up(now=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Move exact tasks that missed occurrences to their latest one.
+
+    Tasks are selected per local date of their owner, then updated with a
+    single UPDATE per chunk of distinct (due, interval) pairs, computing the
+    new due dates with a CASE. Tasks moved to an occurrence they were not
+    reminded of get reminded right away, and their re-reminders for the
+    previous occurrence are dropped. Returns the number of tasks moved.
+    """
+    if now is None:
+        now = timezone.now()
+
+    moved = 0
+    for today, zones in zones_by_local_date(now).items():
+        stale = Task.objects.filter(
+            type=Task.Type.exact,
+            user__timezone__in=zones,
+            interval_days__gt=0,
+            due__lt=today,
+        )
+        pairs = []
+        for due, interval_days in (stale.order_by('due', 'interval_days')
+                                   .values_list('due', 'interval_days')
+                                   .distinct()):
+            new_due = latest_occurrence(due, interval_days, today)
+            if new_due != due:
+                pairs.append((due, interval_days, new_due))
+
+        for start in range(0, len(pairs), chunk_size):
+            chunk = pairs[start:start + chunk_size]
+            tasks = stale.filter(functools.reduce(operator.or_, [
+                Q(due=due, interval_days=interval_days)
+                for due, interval_days, new_due in chunk
+            ]))
+            # Tasks that were already reminded of their new occurrence
+            reminded = functools.reduce(operator.or_, [
+                Q(due=due, interval_days=interval_days,
+                  reminded__gte=new_due)
+                for due, interval_days, new_due in chunk
+            ])
+            with transaction.atomic():
+                user_ids = list(tasks.order_by()
+                                .values_list('user_id', flat=True)
+                                .distinct())
+                moved += tasks.update(
+                    due=Case(
+                        *[When(due=due, interval_days=interval_days,
+                               then=Value(new_due, output_field=DateField()))
+                          for due, interval_days, new_due in chunk],
+                        default=F('due'),
+                        output_field=DateField(),
+                    ),
+                    next_reminder_at=Case(
+                        When(reminded, then=Value(None)),
+                        default=Value(now, output_field=DateTimeField()),
+                        output_field=DateTimeField(),
+                    ),
+                    remind_count=Case(
+                        When(reminded, then=F('remind_count')),
+                        default=Value(0),
+                        output_field=IntegerField(),
+                    ),
+                    remind_again_at=Case(
+                        When(reminded, then=F('remind_again_at')),
+                        default=Value(None),
+                        output_field=DateTimeField(),
+                    ),
+                )
+                bump_revisions(user_ids, now)
+    return moved
@@ -0,0 +1,586 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import collections
+import datetime
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import connection, transaction
+from django.db.models import Case, DateField, DateTimeField, F, Min, Q, \
+    Value, When
+from django.db.models.functions import Greatest
+from django.urls import reverse
+from django.utils import timezone
+import itertools
+import logging
+import pytz.exceptions
+import smtplib
+import threading
+import uuid
+
+from website import settings
+from . import metrics
+from .auth import make_login_link, make_login_token
+from .emails import render_digest, render_email
+from .models import ReminderOutbox, Task
+from .timezones import local_date
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_BATCH_SIZE = 500
+
+DEFAULT_MESSAGES_PER_CONNECTION = 100
+
+DEFAULT_MAX_ATTEMPTS = 5
+
+# Delay before the first retry, doubled for each following attempt
+RETRY_DELAY = datetime.timedelta(minutes=5)
+
+MAX_RETRY_DELAY = datetime.timedelta(hours=6)
+
+# Reminders claimed for longer than this are assumed to belong to a crashed
+# worker, and are queued again
+STALE_CLAIM_DELAY = datetime.timedelta(hours=1)
+
+# Days to wait before reminding again of a task that wasn't done, after the
+# first reminder, the second, ...; the last delay is then repeated. Empty to
+# only remind once
+REMIND_AGAIN_DAYS = getattr(settings, 'REMIND_AGAIN_DAYS', [3, 7])
+
+
+def pending_reminders(now=None):
+    """Tasks that are due and for which no reminder has been sent yet.
+
+    The owners are fetched in the same query, ordered so that tasks from the
+    same user are contiguous.
+    """
+    return (Task.objects.to_remind(now)
+            .select_related('user')
+            .order_by('user_id', 'id'))
+
+
+def next_due_time(now=None):
+    """The next instant at which a task that isn't reminded becomes due, or
+    should be reminded again.
+
+    Returns None if no task will become due.
+    """
+    if now is None:
+        now = timezone.now()
+    times = [
+        Task.objects.filter(**{field + '__gt': now})
+        .aggregate(time=Min(field))['time']
+        for field in ('next_reminder_at', 'remind_again_at')
+    ]
+    times = [time for time in times if time is not None]
+    return min(times) if times else None
+
+
+def next_retry_time():
+    """The next instant at which a queued reminder should be sent, or None.
+    """
+    return ReminderOutbox.objects.filter(
+        status=ReminderOutbox.Status.queued,
+    ).aggregate(Min('next_attempt'))['next_attempt__min']
+
+
+def remind_again_at(now=None):
+    """When to remind again of a task, after the reminder sent now.
+
+    This is an expression on `Task.remind_count`, the number of reminders
+    sent before this one, following `REMIND_AGAIN_DAYS`.
+    """
+    if now is None:
+        now = timezone.now()
+    if not REMIND_AGAIN_DAYS:
+        return Value(None, output_field=DateTimeField())
+
+    def after(days):
+        return Value(now + datetime.timedelta(days=days),
+                     output_field=DateTimeField())
+
+    return Case(
+        *[When(remind_count=count, then=after(days))
+          for count, days in enumerate(REMIND_AGAIN_DAYS[:-1])],
+        default=after(REMIND_AGAIN_DAYS[-1]),
+        output_field=DateTimeField(),
+    )
+
+
+def mark_reminded(tasks, now=None):
+    """Record that reminders were sent for these tasks.
+
+    `tasks` are pairs of task ID and owner's timezone. `Task.reminded` is set
+    to the owner's local date, with a single query per distinct date. This
+    also schedules the next reminder, in case they are not done.
+    """
+    if now is None:
+        now = timezone.now()
+    by_date = {}
+    for task_id, tz_name in tasks:
+        try:
+            day = local_date(tz_name, now)
+        except pytz.exceptions.UnknownTimeZoneError:
+            day = timezone.localdate(now)
+        by_date.setdefault(day, []).append(task_id)
+
+    updated = 0
+    for day, task_ids in sorted(by_date.items()):
+        updated += Task.objects.filter(id__in=task_ids).update(
+            # Snoozed reminders can be sent before the due date
+            reminded=Greatest(F('due'),
+                              Value(day, output_field=DateField())),
+            next_reminder_at=None,
+            remind_count=F('remind_count') + 1,
+            remind_again_at=remind_again_at(now),
+            reminders_queued=F('reminders_queued') + 1,
+        )
+    return updated
+
+
+def build_reminder(task):
+    """Build the reminder email for a single task.
+    """
+    user = task.user
+    token = make_login_token(user.id)
+    link = reverse('ack_task', kwargs=dict(task_id=task.id))
+    link = make_login_link(user.id, link, token=token)
+    snooze_link = reverse('snooze_task', kwargs=dict(task_id=task.id))
+    snooze_link = make_login_link(user.id, snooze_link, token=token)
+
+    subject, body, html = render_email('reminder', user.language,
+                                       name=task.name,
+                                       description=task.description,
+                                       link=link,
+                                       snooze_link=snooze_link)
+    message = EmailMultiAlternatives(
+        subject=subject,
+        body=body,
+        from_email=settings.EMAIL_FROM,
+        to=[user.email],
+    )
+    message.attach_alternative(html, 'text/html')
+    return message
+
+
+def build_digest(user, tasks):
+    """Build a single reminder email for several tasks of the same user.
+    """
+    if len(tasks) == 1:
+        return build_reminder(tasks[0])
+
+    token = make_login_token(user.id)
+    items = []
+    for task in tasks:
+        link = reverse('ack_task', kwargs=dict(task_id=task.id))
+        snooze_link = reverse('snooze_task', kwargs=dict(task_id=task.id))
+        items.append({'name': task.name,
+                      'description': task.description,
+                      'link': make_login_link(user.id, link, token=token),
+                      'snooze_link': make_login_link(user.id, snooze_link,
+                                                     token=token)})
+
+    subject, body, html = render_digest(user.language, items)
+    message = EmailMultiAlternatives(
+        subject=subject,
+        body=body,
+        from_email=settings.EMAIL_FROM,
+        to=[user.email],
+    )
+    message.attach_alternative(html, 'text/html')
+    return message
+
+
+class Mailer(object):
+    """Sends messages over a single connection, reconnecting on failure.
+
+    The connection is kept open across messages instead of being set up for
+    each one, and is recycled every `messages_per_connection` messages since
+    relays usually limit how many messages a session can carry.
+    """
+    @staticmethod
+    def is_retried(error):
+        """Whether sending again on a new connection might work.
+
+        SMTP errors are `OSError` too, but apart from the server
+        disconnecting, they mean the relay rejected the message.
+        """
+        return (isinstance(error, smtplib.SMTPServerDisconnected) or
+                not isinstance(error, smtplib.SMTPException))
+
+    def __init__(self, connection=None,
+                 messages_per_connection=DEFAULT_MESSAGES_PER_CONNECTION):
+        if connection is None:
+            connection = get_connection()
+        self.connection = connection
+        self.messages_per_connection = messages_per_connection
+        self._sent_on_connection = 0
+        self._is_open = False
+        self.last_error = None
+
+    def open(self):
+        if not self._is_open:
+            self.connection.open()
+            self._is_open = True
+            self._sent_on_connection = 0
+
+    def close(self):
+        if self._is_open:
+            self._is_open = False
+            try:
+                self.connection.close()
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def send(self, message):
+        """Send a single message, reconnecting once if the connection broke.
+
+        Returns True if the message was sent, False if it failed; the error is
+        logged.
+        """
+        if self._sent_on_connection >= self.messages_per_connection:
+            self.close()
+        for attempt in range(2):
+            self.open()
+            try:
+                with metrics.time_email():
+                    sent = self.connection.send_messages([message])
+            except OSError as e:
+                retried = self.is_retried(e)
+                if retried:
+                    logger.warning("Connection error sending to %s, "
+                                   "reconnecting", ", ".join(message.to))
+                    self.close()
+                if not retried or attempt > 0:
+                    logger.exception("Couldn't send email to %s",
+                                     ", ".join(message.to))
+                    self.last_error = repr(e)
+                    return False
+            else:
+                self._sent_on_connection += 1
+                return bool(sent)
+
+    def send_messages(self, messages):
+        """Send messages, returning the list of those that were sent.
+        """
+        return [message for message in messages if self.send(message)]
+
+
+def deliver(mailer, build, *args):
+    """Build a message with ``build(*args)`` and send it.
+
+    Errors are logged and reported by returning a description of the error,
+    so that a single bad task doesn't interrupt the whole run. Returns None if
+    the message was sent.
+    """
+    try:
+        if mailer.send(build(*args)):
+            return None
+        return mailer.last_error or "Message was not sent"
+    except Exception as e:
+        logger.exception("Error sending reminder")
+        return repr(e)
+
+
+class SerialDelivery(object):
+    """Delivers messages one at a time, in the calling thread.
+    """
+    def __init__(self, mailer_factory=Mailer):
+        self.mailer = mailer_factory()
+
+    def __enter__(self):
+        self.mailer.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.mailer.close()
+
+    def submit(self, build, *args):
+        future = Future()
+        future.set_result(deliver(self.mailer, build, *args))
+        return future
+
+
+class ThreadedDelivery(object):
+    """Delivers messages from a pool of threads, each with its connection.
+
+    At most `max_in_flight` messages can be submitted but not yet sent;
+    `submit()` blocks when that limit is reached.
+    """
+    def __init__(self, workers, mailer_factory=Mailer, max_in_flight=None):
+        if max_in_flight is None:
+            max_in_flight = workers * 4
+        self.mailer_factory = mailer_factory
+        self._executor = ThreadPoolExecutor(
+            workers,
+            thread_name_prefix='reminders',
+        )
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._local = threading.local()
+        self._mailers = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._executor.shutdown(wait=True)
+        for mailer in self._mailers:
+            mailer.close()
+
+    def _get_mailer(self):
+        mailer = getattr(self._local, 'mailer', None)
+        if mailer is None:
+            mailer = self._local.mailer = self.mailer_factory()
+            with self._lock:
+                self._mailers.append(mailer)
+        return mailer
+
+    def _run(self, build, *args):
+        try:
+            return deliver(self._get_mailer(), build, *args)
+        finally:
+            self._slots.release()
+
+    def submit(self, build, *args):
+        self._slots.acquire()
+        return self._executor.submit(metrics.in_thread(self._run),
+                                     build, *args)
+
+
+Summary = collections.namedtuple('Summary', ['reminded', 'emails', 'failed'])
+
+
+def skip_locked(queryset):
+    """Lock the selected rows, skipping those locked by another worker.
+
+    This is a no-op on databases that don't support it, such as SQLite, where
+    the whole database is locked by writers anyway.
+    """
+    features = connection.features
+    if not features.has_select_for_update_skip_locked:
+        return queryset
+    if features.has_select_for_update_of:
+        return queryset.select_for_update(skip_locked=True, of=('self',))
+    return queryset.select_for_update(skip_locked=True)
+
+
+def retry_delay(attempts):
+    """Delay before trying again to send a reminder after failed attempts.
+    """
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def enqueue_reminders(now=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Add tasks that are due and not reminded, or to remind again, to the
+    outbox.
+
+    Tasks are marked as reminded in the same transaction, so they are only
+    queued once. Returns the number of reminders queued.
+    """
+    if now is None:
+        now = timezone.now()
+    tasks = pending_reminders(now).order_by('id')
+
+    queued = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                skip_locked(tasks.filter(id__gt=last_id))
+                .values_list('id', 'due', 'remind_count', 'reminders_queued',
+                             'user__timezone')[:batch_size]
+            )
+            if not batch:
+                break
+            # The (task, sequence) uniqueness protects against another
+            # process that selected the same tasks, if we couldn't lock them.
+            # The sequence only increases, so a task that comes back to a due
+            # date it was reminded of before gets reminded again
+            ReminderOutbox.objects.bulk_create(
+                [ReminderOutbox(task_id=task_id, due=due,
+                                remind_count=remind_count + 1,
+                                sequence=sequence + 1,
+                                next_attempt=now)
+                 for task_id, due, remind_count, sequence, tz_name in batch],
+                ignore_conflicts=True,
+            )
+            mark_reminded([(task_id, tz_name)
+                           for task_id, due, remind_count, sequence, tz_name
+                           in batch],
+                          now)
+        queued += len(batch)
+        last_id = batch[-1][0]
+    return queued
+
+
+def requeue_stale(now=None, model=ReminderOutbox):
+    """Queue again reminders that were claimed by a worker that died.
+
+    This also works on other outbox models, such as `EmailOutbox`.
+    """
+    if now is None:
+        now = timezone.now()
+    return model.objects.filter(
+        status=model.Status.sending,
+        claimed__lt=now - STALE_CLAIM_DELAY,
+    ).update(status=model.Status.queued, claimed_by='')
+
+
+def claim_reminders(batch_size=DEFAULT_BATCH_SIZE, now=None):
+    """Claim up to `batch_size` queued reminders for this worker.
+
+    The claim is an UPDATE conditional on the reminder still being queued, so
+    two workers can never claim the same reminder, even when the database
+    can't lock rows. All the queued reminders of a user are claimed together,
+    so more than `batch_size` reminders can be returned.
+    """
+    if now is None:
+        now = timezone.now()
+    token = uuid.uuid4().hex
+    queued = ReminderOutbox.objects.filter(
+        status=ReminderOutbox.Status.queued,
+        next_attempt__lte=now,
+    )
+    with transaction.atomic():
+        rows = list(
+            skip_locked(queued)
+            .order_by('next_attempt', 'id')
+            .values_list('id', 'task__user_id')[:batch_size]
+        )
+        if not rows:
+            return []
+        # Also claim the other reminders of the same users, so they can get
+        # a single digest
+        users = set(user_id for reminder_id, user_id in rows)
+        queued.filter(
+            Q(id__in=[reminder_id for reminder_id, user_id in rows]) |
+            Q(task__user_id__in=users),
+        ).update(
+            status=ReminderOutbox.Status.sending,
+            claimed=now,
+            claimed_by=token,
+            attempts=F('attempts') + 1,
+        )
+    return list(
+        ReminderOutbox.objects.filter(claimed_by=token)
+        .select_related('task__user')
+        .order_by('task__user_id', 'task_id')
+    )
+
+
+def record_results(results, max_attempts, now, model=ReminderOutbox):
+    """Update the outbox with the outcome of sending reminders.
+
+    `results` is a list of ``(reminder, error)`` pairs. This also works on
+    other outbox models, such as `EmailOutbox`.
+    """
+    sent = [reminder.id for reminder, error in results if error is None]
+    if sent:
+        model.objects.filter(id__in=sent).update(
+            status=model.Status.sent,
+            sent=now,
+            last_error='',
+        )
+    for reminder, error in results:
+        if error is None:
+            continue
+        if reminder.attempts >= max_attempts:
+            model.objects.filter(id=reminder.id).update(
+                status=model.Status.failed,
+                last_error=error,
+            )
+        else:
+            model.objects.filter(id=reminder.id).update(
+                status=model.Status.queued,
+                next_attempt=now + retry_delay(reminder.attempts),
+                claimed_by='',
+                last_error=error,
+            )
+
+
+def drain_outbox(batch_size=DEFAULT_BATCH_SIZE, digest=False, now=None,
+                 workers=1, mailer_factory=Mailer,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Send the queued reminders.
+
+    If `digest` is True, a single email is sent to each user for the
+    reminders claimed together, listing all their tasks. If `workers` is more
+    than 1, emails are composed and sent from that many threads, each with
+    its own connection.
+
+    Reminders that couldn't be sent are retried later with exponential
+    backoff, up to `max_attempts` times.
+
+    Returns a `Summary` with the number of tasks reminded, emails sent, and
+    tasks for which sending failed.
+    """
+    if now is None:
+        now = timezone.now()
+    if workers > 1:
+        delivery = ThreadedDelivery(workers, mailer_factory)
+    else:
+        delivery = SerialDelivery(mailer_factory)
+
+    requeue_stale(now)
+    reminded = emails = failed = 0
+    with delivery:
+        while True:
+            batch = claim_reminders(batch_size, now)
+            if not batch:
+                break
+
+            # Submit the whole batch, then wait for it to be sent
+            jobs = []
+            for user_id, user_reminders in itertools.groupby(
+                    batch, key=lambda reminder: reminder.task.user_id):
+                user_reminders = list(user_reminders)
+                user = user_reminders[0].task.user
+                tasks = [reminder.task for reminder in user_reminders]
+                if digest:
+                    logger.info("Sending digest email to %s for %d tasks",
+                                user.email, len(tasks))
+                    jobs.append((
+                        user_reminders,
+                        delivery.submit(build_digest, user, tasks),
+                    ))
+                else:
+                    for reminder in user_reminders:
+                        logger.info("Sending email to %s for task %s",
+                                    user.email, reminder.task.name)
+                        jobs.append((
+                            [reminder],
+                            delivery.submit(build_reminder, reminder.task),
+                        ))
+
+            results = []
+            try:
+                for job_reminders, future in jobs:
+                    error = future.result()
+                    results.extend((reminder, error)
+                                   for reminder in job_reminders)
+                    if error is None:
+                        reminded += len(job_reminders)
+                        emails += 1
+                    else:
+                        failed += len(job_reminders)
+            finally:
+                # Record what was sent even if something failed
+                record_results(results, max_attempts, now)
+    return Summary(reminded, emails, failed)
+
+
+def send_reminders(batch_size=DEFAULT_BATCH_SIZE, digest=False, now=None,
+                   **kwargs):
+    """Queue reminders for tasks that are due, and send the outbox.
+
+    Takes the same arguments as `drain_outbox()`, and returns its summary.
+    """
+    enqueue_reminders(now, batch_size)
+    return drain_outbox(batch_size, digest, now, **kwargs)
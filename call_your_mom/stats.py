@@ -0,0 +1,172 @@
+"""Statistics on task completions.
+
+Each task has a `TaskStats` row summarizing its `TaskDone` history: how
+often it is done (mean and median interval), how late compared to its due
+date, and how many times in a row it was done on time. Rows are updated
+incrementally when a completion is recorded, and can be recomputed from the
+history with the ``rebuild_stats`` command.
+"""
+
+import collections
+import json
+
+from django.db import transaction
+
+from .models import Task, TaskDone, TaskStats
+
+
+DEFAULT_CHUNK_SIZE = 500
+
+
+def add_completion(stats, done, due):
+    """Update a `TaskStats` instance in place for a new, latest completion.
+
+    `due` is the date the task was due at the time, or None if unknown.
+    """
+    if stats.count:
+        intervals = json.loads(stats.intervals)
+        key = str((done - stats.last_done).days)
+        intervals[key] = intervals.get(key, 0) + 1
+        stats.intervals = json.dumps(intervals, sort_keys=True)
+    else:
+        stats.first_done = done
+    stats.count += 1
+    stats.last_done = done
+
+    if due is not None:
+        lateness = (done - due).days
+        stats.lateness_total += lateness
+        stats.lateness_count += 1
+        if lateness <= 0:
+            stats.streak += 1
+            stats.best_streak = max(stats.best_streak, stats.streak)
+        else:
+            stats.streak = 0
+
+
+def compute_stats(task_id, completions):
+    """Build the `TaskStats` of a task from its `(done, due)` history.
+
+    The completions have to be sorted by date. The instance is not saved.
+    """
+    stats = TaskStats(task_id=task_id)
+    for done, due in completions:
+        add_completion(stats, done, due)
+    return stats
+
+
+def rebuild_task_stats(task_id):
+    """Recompute and save the `TaskStats` of a task from its history.
+    """
+    completions = (TaskDone.objects.filter(task_id=task_id)
+                   .order_by('done', 'id')
+                   .values_list('done', 'due'))
+    stats = compute_stats(task_id, completions)
+    if stats.count:
+        stats.save()
+    else:
+        TaskStats.objects.filter(task_id=task_id).delete()
+    return stats
+
+
+def record_completion(task, done):
+    """Record that a task was done on the given date.
+
+    Creates the `TaskDone` against the task's current due date, and updates
+    its `TaskStats`. Completions that are older than the latest one change
+    the intervals and streaks before them, so the stats are recomputed from
+    the history in that case.
+    """
+    with transaction.atomic():
+        TaskDone.objects.create(task=task, done=done, due=task.due)
+        try:
+            stats = TaskStats.objects.select_for_update().get(task=task)
+        except TaskStats.DoesNotExist:
+            stats = None
+        if stats is None or done < stats.last_done:
+            return rebuild_task_stats(task.id)
+        add_completion(stats, done, task.due)
+        stats.save()
+        return stats
+
+
+def rebuild_all_stats(chunk_size=DEFAULT_CHUNK_SIZE):
+    """Recompute the `TaskStats` of every task, in chunks of tasks.
+
+    Each chunk takes a single query to read the history of its tasks, and is
+    replaced in its own transaction. Returns the number of tasks.
+    """
+    total = 0
+    last_id = 0
+    while True:
+        task_ids = list(Task.objects.filter(id__gt=last_id)
+                        .order_by('id')
+                        .values_list('id', flat=True)[:chunk_size])
+        if not task_ids:
+            return total
+        last_id = task_ids[-1]
+
+        history = collections.defaultdict(list)
+        rows = (TaskDone.objects.filter(task_id__in=task_ids)
+                .order_by('task_id', 'done', 'id')
+                .values_list('task_id', 'done', 'due'))
+        for task_id, done, due in rows.iterator():
+            history[task_id].append((done, due))
+
+        with transaction.atomic():
+            TaskStats.objects.filter(task_id__in=task_ids).delete()
+            TaskStats.objects.bulk_create(
+                [compute_stats(task_id, completions)
+                 for task_id, completions in history.items()],
+            )
+        total += len(task_ids)
+
+
+def stats_dict(stats):
+    """Serialize a `TaskStats` for the JSON views.
+    """
+    def date(value):
+        return value.isoformat() if value is not None else None
+
+    return {
+        'count': stats.count,
+        'first_done': date(stats.first_done),
+        'last_done': date(stats.last_done),
+        'mean_interval': stats.mean_interval,
+        'median_interval': stats.median_interval,
+        'mean_lateness': stats.mean_lateness,
+        'streak': stats.streak,
+        'best_streak': stats.best_streak,
+    }
+
+
+def user_stats(user):
+    """Aggregate the statistics of all the tasks of a user.
+
+    Reads one `TaskStats` row per task; intervals are combined so the mean
+    and median are over all the completions, not averages of the tasks'.
+    """
+    combined = TaskStats(count=0, intervals='{}')
+    intervals = collections.Counter()
+    span_days = 0
+    for stats in TaskStats.objects.filter(task__user=user):
+        combined.count += stats.count
+        if stats.count > 1:
+            span_days += (stats.last_done - stats.first_done).days
+        intervals.update(json.loads(stats.intervals))
+        combined.first_done = min(filter(None, [combined.first_done,
+                                                stats.first_done]))
+        combined.last_done = max(filter(None, [combined.last_done,
+                                               stats.last_done]))
+        combined.lateness_total += stats.lateness_total
+        combined.lateness_count += stats.lateness_count
+        # Sum of the current streaks, the best is of any single task
+        combined.streak += stats.streak
+        combined.best_streak = max(combined.best_streak, stats.best_streak)
+    combined.intervals = json.dumps(intervals)
+
+    result = stats_dict(combined)
+    number = sum(intervals.values())
+    result['mean_interval'] = span_days / number if number else None
+    result['tasks'] = Task.objects.filter(user=user).count()
+    return result
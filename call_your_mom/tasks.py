@@ -0,0 +1,207 @@
+"""Validating and applying changes to tasks.
+
+This is shared by the HTML views and the JSON API. The `clean_*` functions
+take the submitted values as strings and return a dict of values along with
+a dict of error messages by field; when there are errors, the values are
+still filled in with sensible defaults so a form can be shown again.
+"""
+
+import datetime
+import dateutil.parser
+from django.db import transaction
+from django.utils.translation import gettext as _
+import json
+
+from .auth import bump_revision
+from .models import Task
+from .recurrence import next_due
+from .stats import record_completion
+from .timezones import local_date, local_midnight
+
+
+# Choices of days after which to remind again of a task, when snoozing
+SNOOZE_DAYS = [1, 3, 7]
+
+
+def parse_date(value):
+    """Parse a date as entered by a user, returning None if it is invalid.
+    """
+    if not value:
+        return None
+    try:
+        return dateutil.parser.parse(value).date()
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+
+def _clean_text(data, field, values, errors):
+    """Validate a text field of a task, which might not be a string in JSON.
+    """
+    value = data.get(field)
+    if value is None:
+        value = ''
+    max_length = Task._meta.get_field(field).max_length
+    if not isinstance(value, str):
+        errors[field] = _("This should be text")
+        value = ''
+    elif len(value) > max_length:
+        errors[field] = _("This can't be longer than {0} "
+                          "characters").format(max_length)
+        value = value[:max_length]
+    values[field] = value
+
+
+def _clean_type(data, task, values, errors):
+    """Validate the type of a task, unchanged or normal if it is not given.
+    """
+    value = data.get('type')
+    if not value:
+        if task is not None and task.type in Task.Type:
+            value = task.type
+        else:
+            value = Task.Type.normal
+    elif not isinstance(value, str) or value not in Task.Type:
+        errors['type'] = _("Invalid task type {0}").format(json.dumps(value))
+        value = Task.Type.normal
+    values['type'] = value
+
+
+def clean_task(data, task, user_timezone):
+    """Validate the fields of a new or modified task.
+    """
+    values = {}
+    errors = {}
+
+    _clean_text(data, 'name', values, errors)
+    _clean_text(data, 'description', values, errors)
+    _clean_type(data, task, values, errors)
+    if not values['name'] and 'name' not in errors:
+        errors['name'] = _("Please give your task a name")
+
+    interval_days = data.get('interval_days', '')
+    if interval_days:
+        try:
+            interval_days = int(interval_days)
+        except (ValueError, TypeError):
+            interval_days = None
+        if interval_days is not None and interval_days < 1:
+            interval_days = None
+    if not interval_days:
+        errors['interval_days'] = _("Please give your task an interval in "
+                                    "days between occurrences")
+        interval_days = 7
+    values['interval_days'] = interval_days
+
+    due = parse_date(data.get('due', ''))
+    if not due:
+        errors['due'] = _("Please give your task a due date")
+        if task:
+            due = task.due
+        else:
+            due = (local_date(user_timezone) +
+                   datetime.timedelta(days=interval_days))
+    values['due'] = due
+
+    return values, errors
+
+
+def clean_ack(data, task, user_timezone):
+    """Validate the acknowledgement of a task, the dates it was done and is
+    due next.
+    """
+    values = {}
+    errors = {}
+
+    done = parse_date(data.get('done', ''))
+    if not done:
+        errors['done'] = _("Please enter the date you performed the task")
+        done = local_date(user_timezone)
+    values['done'] = done
+
+    due = parse_date(data.get('due', ''))
+    if not due:
+        errors['due'] = _("Please enter the date this task is due next")
+        due = next_due(task.type, task.due, task.interval_days, done)
+    values['due'] = due
+
+    return values, errors
+
+
+def clean_snooze(data, task, user_timezone):
+    """Validate the number of days after which to remind again of a task.
+
+    The reminder is then sent at midnight in the user's timezone.
+    """
+    values = {}
+    errors = {}
+
+    try:
+        days = int(data.get('days', ''))
+    except (ValueError, TypeError):
+        days = None
+    if days not in SNOOZE_DAYS:
+        errors['days'] = _("Please choose when to be reminded again")
+        days = SNOOZE_DAYS[0]
+    values['days'] = days
+    values['until'] = local_midnight(
+        local_date(user_timezone) + datetime.timedelta(days=days),
+        user_timezone,
+    )
+
+    return values, errors
+
+
+def save_task(task, values, user):
+    """Create or update a task from validated values.
+
+    Returns the task.
+    """
+    if task is None:
+        task = Task(user_id=user.id)
+    if task.due != values['due']:
+        # Remind of the new due date, even if it is not after the last one
+        task.reminded = None
+    task.type = values['type']
+    task.name = values['name']
+    task.description = values['description']
+    task.interval_days = values['interval_days']
+    task.due = values['due']
+    task.reset_reminders(user.timezone)
+    with transaction.atomic():
+        task.save()
+        bump_revision(user.id)
+    return task
+
+
+def acknowledge_task(task, values, user):
+    """Record that a task was done, and set when it is due next.
+    """
+    with transaction.atomic():
+        record_completion(task, values['done'])
+
+        task.due = values['due']
+        # This occurrence is done, the next one gets reminded
+        task.reminded = None
+        task.reset_reminders(user.timezone)
+        task.save()
+        bump_revision(user.id)
+
+
+def snooze_reminder(task, values):
+    """Remind again of a task later, unless it is done before.
+    """
+    if task.reminded is None or task.reminded < task.due:
+        # Not reminded yet, the snoozed reminder replaces the first one
+        task.reminded = task.due
+    task.next_reminder_at = None
+    task.remind_again_at = values['until']
+    task.save(update_fields=['reminded', 'next_reminder_at',
+                             'remind_again_at'])
+
+
+def remove_task(task):
+    """Delete a task.
+    """
+    with transaction.atomic():
+        task.delete()
+        bump_revision(task.user_id)
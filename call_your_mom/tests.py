@@ -1,12 +1,42 @@
 import datetime
-from django.test import TestCase
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import F
+from django.contrib.auth.models import User
+from django.test import RequestFactory, TestCase, override_settings
+from django.template.loader import render_to_string
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse, resolve
+from django.utils import timezone, translation
+from django.utils.timezone import utc
 import contextlib
+import io
+import json
+import os
+import smtplib
+import tempfile
+import threading
+from unittest import mock
 import urllib.parse
 
+from website import settings
 from . import auth
+from . import checks
+from . import emails
+from . import metrics
+from . import ratelimit
+from . import recurrence
+from . import reminders
+from . import timezones
 from . import views
-from .models import CYMUser
+from .management.commands import run_scheduler, send_emails
+from .tasks import acknowledge_task, parse_date, save_task
+from .models import CYMUser, EmailOutbox, ReminderOutbox, Task, TaskDone, \
+    TaskStats
 
 
 def parse_url(path):
@@ -16,6 +46,7 @@ def parse_url(path):
 
 class LogInTestCase(TestCase):
     def setUp(self):
+        cache.clear()
         self.__session = self.client.session
 
     @contextlib.contextmanager
@@ -31,16 +62,41 @@ class LogInTestCase(TestCase):
 
 class TimezonesTestCase(TestCase):
     def test_timezone_list(self):
+        choices = timezones.timezone_choices()
+
         # Check reasonable number
-        self.assertGreater(len(views._timezones), 200)
-        self.assertLess(len(views._timezones), 2000)
+        self.assertGreater(len(choices), 200)
+        self.assertLess(len(choices), 2000)
 
         # Check some timezones
-        tz = [tz for tz in views._timezones if tz[0] == 'Europe/Paris']
+        tz = [tz for tz in choices if tz[0] == 'Europe/Paris']
         self.assertEqual(tz, [('Europe/Paris', '+01:00')])
-        tz = [tz for tz in views._timezones if tz[0] == 'America/New_York']
+        tz = [tz for tz in choices if tz[0] == 'America/New_York']
         self.assertEqual(tz, [('America/New_York', '-05:00')])
 
+        # Standard offset, even during daylight saving time
+        summer = datetime.datetime(2018, 7, 1, tzinfo=utc)
+        tz = [tz for tz in timezones.timezone_choices(summer)
+              if tz[0] == 'Europe/Paris']
+        self.assertEqual(tz, [('Europe/Paris', '+01:00')])
+
+    def test_local_date(self):
+        def at(hour, minute, day=10):
+            return datetime.datetime(2018, 4, day, hour, minute, tzinfo=utc)
+
+        # Paris is UTC+2 in April
+        self.assertEqual(timezones.local_date('Europe/Paris', at(21, 59)),
+                         datetime.date(2018, 4, 10))
+        # Cached until midnight
+        with mock.patch.object(timezones, 'get_timezone') as get_timezone:
+            self.assertEqual(timezones.local_date('Europe/Paris', at(12, 0)),
+                             datetime.date(2018, 4, 10))
+            get_timezone.assert_not_called()
+        self.assertEqual(timezones.local_date('Europe/Paris', at(22, 0)),
+                         datetime.date(2018, 4, 11))
+        self.assertEqual(timezones.local_date('Europe/Paris', at(21, 0, 9)),
+                         datetime.date(2018, 4, 9))
+
 
 class AuthCase(LogInTestCase):
     fixtures = ['test.json']
@@ -94,6 +150,188 @@ class AuthCase(LogInTestCase):
         auth.email_rate_limit(user, datetime.datetime(2018, 4, 3,
                                                       16, 14, 0))
 
+    def test_request_ratelimit(self):
+        limit = ratelimit.RateLimit('test', 2, 60)
+        now = datetime.datetime(2018, 4, 2, 16, 0, 10, tzinfo=utc)
+        self.assertEqual([limit.hit('a', now) for _ in range(3)],
+                         [True, True, False])
+        self.assertTrue(limit.hit('b', now))
+        self.assertTrue(limit.hit('a', now + datetime.timedelta(minutes=1)))
+
+        # Rejected before any query
+        client = self.client_class()
+        response = client.post(reverse('login'), {'email': 'a@example.org'})
+        self.assertEqual(response.status_code, 302)
+        with self.assertNumQueries(0):
+            response = client.post(reverse('login'),
+                                   {'email': 'A@example.org'})
+        self.assertEqual(
+            str(list(response.wsgi_request._messages)[-1]),
+            "Rate-limiting is active. Please try again later.")
+
+        # This client already made 2 requests
+        with mock.patch.object(ratelimit.IP_LIMIT, 'limit', 3):
+            for i in range(3):
+                client.post(reverse('register'),
+                            {'email': 'b%d@example.org' % i})
+            self.assertEqual(
+                CYMUser.objects.filter(email__startswith='b').count(), 1)
+        self.assertEqual(
+            list(EmailOutbox.objects.values_list('to', flat=True)),
+            ['b0@example.org'])
+
+    def test_client_ip(self):
+        request = RequestFactory().get(
+            '/', REMOTE_ADDR='10.0.0.2',
+            HTTP_X_FORWARDED_FOR='127.0.0.1, 192.0.2.1, 10.0.0.1')
+        self.assertEqual(ratelimit.client_ip(request), '10.0.0.2')
+        with mock.patch.object(settings, 'CLIENT_IP_HEADER',
+                               'HTTP_X_FORWARDED_FOR', create=True):
+            # The client's own entries are ignored
+            self.assertEqual(ratelimit.client_ip(request), '10.0.0.1')
+            with mock.patch.object(settings, 'CLIENT_IP_PROXIES', 2,
+                                   create=True):
+                self.assertEqual(ratelimit.client_ip(request), '192.0.2.1')
+            with mock.patch.object(settings, 'CLIENT_IP_PROXIES', 5,
+                                   create=True):
+                self.assertEqual(ratelimit.client_ip(request), '127.0.0.1')
+
+    def test_email_outbox(self):
+        client = self.client_class()
+        response = client.post(reverse('register'),
+                               {'email': 'new@example.org'})
+        self.assertEqual(response.status_code, 302)
+        response = client.post(reverse('login'),
+                               {'email': 'remirampin@gmail.com'})
+        self.assertEqual(response.status_code, 302)
+        # Nothing was sent by the requests
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(EmailOutbox.objects.count(), 2)
+
+        out = io.StringIO()
+        call_command('send_emails', once=True, stderr=out)
+        self.assertIn("Sent 2 emails, 0 failed", out.getvalue())
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ['new@example.org', 'remirampin@gmail.com'])
+        self.assertTrue(all(m.alternatives for m in mail.outbox))
+        user = CYMUser.objects.get(email='new@example.org')
+        self.assertIn(auth.make_login_link(user.id), mail.outbox[0].body +
+                      mail.outbox[1].body)
+
+        # Sent emails aren't sent again
+        call_command('send_emails', once=True, stderr=io.StringIO())
+        self.assertEqual(len(mail.outbox), 2)
+        # Their login links are not kept
+        self.assertFalse(EmailOutbox.objects.exclude(body='', html_body='')
+                         .exists())
+
+        out = io.StringIO()
+        call_command('send_emails', stats=1, stdout=out)
+        self.assertIn("Sent: 2\nFailed: 0\nQueued: 0\n", out.getvalue())
+
+    def test_email_worker_errors(self):
+        # Not caught by the command
+        class Stop(BaseException):
+            pass
+
+        with mock.patch.object(send_emails, 'drain_emails',
+                               side_effect=[RuntimeError("db down"),
+                                            Stop]) as drain, \
+                mock.patch.object(threading.Event, 'wait') as wait, \
+                mock.patch.object(send_emails.signal, 'signal'), \
+                mock.patch.object(send_emails.connections, 'all',
+                                  return_value=[]), \
+                self.assertLogs(send_emails.__name__, 'ERROR') as logs:
+            with self.assertRaises(Stop):
+                call_command('send_emails', stderr=io.StringIO())
+        self.assertIn("db down", logs.output[0])
+        # Waited a bit after the error, then tried again
+        wait.assert_called_once_with(run_scheduler.ERROR_SLEEP)
+        self.assertEqual(drain.call_count, 2)
+
+    def test_shared_cache_check(self):
+        locmem = {'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with mock.patch.object(settings, 'DEBUG', False), \
+                mock.patch.object(settings, 'CACHES', locmem, create=True):
+            self.assertEqual(
+                [w.id for w in checks.check_shared_cache(None)],
+                ['call_your_mom.W001'])
+            locmem['default']['BACKEND'] = \
+                'django.core.cache.backends.db.DatabaseCache'
+            self.assertEqual(checks.check_shared_cache(None), [])
+
+    def test_session_user_cache(self):
+        def user_queries():
+            return [q['sql'] for q in queries.captured_queries
+                    if 'call_your_mom_cymuser' in q['sql']]
+
+        with self.logged_in():
+            # Pages not using the user don't load it
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('landing'))
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(user_queries(), [])
+
+            # The user is loaded once, then cached
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(reverse('index'))
+                self.client.get(reverse('index'))
+            self.assertEqual(len(user_queries()), 1)
+
+            # Saving the user updates the cache
+            user = CYMUser.objects.get(id=1)
+            user.timezone = 'Europe/Paris'
+            user.save()
+            self.assertEqual(auth.get_user(1).timezone, 'Europe/Paris')
+
+            # Deleted user is logged out
+            user.delete()
+            response = self.client.get(reverse('profile'))
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(parse_url(response.url)[0].url_name, 'login')
+            self.assertNotIn(CYMUser.USER_ID_KEY, self.client.session)
+
+
+class TokenLoginTestCase(TestCase):
+    fixtures = ['test.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_token_login(self):
+        token = auth.make_login_token(1)
+        url = reverse('profile') + '?token=' + token
+
+        def updates():
+            return [q['sql'] for q in queries.captured_queries
+                    if q['sql'].startswith('UPDATE "call_your_mom_cymuser"')]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, reverse('profile'))
+        self.assertEqual(self.client.session[CYMUser.USER_ID_KEY], '1')
+        # Only last_login is written
+        self.assertEqual(len(updates()), 1)
+        self.assertNotIn('email', updates()[0])
+        last_login = CYMUser.objects.get(id=1).last_login
+        self.assertEqual(auth.get_user(1).last_login, last_login)
+
+        # Logging in again right away doesn't write
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertEqual(updates(), [])
+        self.assertEqual(CYMUser.objects.get(id=1).last_login, last_login)
+
+    def test_invalid_token(self):
+        for token in ['AAAA', 'not base32!', auth.make_login_token(1)[:-8],
+                      auth.make_login_token(42)]:
+            response = self.client.get(reverse('profile') + '?token=' + token)
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(response.url, reverse('profile'))
+            self.assertNotIn(CYMUser.USER_ID_KEY, self.client.session)
+
 
 class AckTestCase(LogInTestCase):
     fixtures = ['test.json']
@@ -109,3 +347,1018 @@ class AckTestCase(LogInTestCase):
             self.assertEqual(response.status_code, 404)
             response = self.client.get(reverse('ack_task', args=[2]))
             self.assertEqual(response.status_code, 200)
+
+    def test_ack(self):
+        with self.logged_in():
+            for done, due in [('2018-04-08', '2018-04-15'),
+                              ('2018-04-03', '2018-04-15'),
+                              ('2018-04-20', '2018-04-27')]:
+                response = self.client.post(reverse('ack_task', args=[2]),
+                                            {'done': done, 'due': due})
+                self.assertEqual(response.status_code, 302)
+
+            task = Task.objects.get(id=2)
+            self.assertEqual(task.due, datetime.date(2018, 4, 27))
+            self.assertEqual(task.stats.count, 5)
+            self.assertEqual(task.stats.first_done, datetime.date(2018, 4, 1))
+            self.assertEqual(task.stats.last_done, datetime.date(2018, 4, 20))
+            self.assertEqual(task.stats.mean_interval, 19 / 4)
+
+            response = self.client.get(reverse('change_task', args=[2]))
+            self.assertEqual(
+                list(response.context['task_done_previously']),
+                [datetime.date(2018, 4, 20), datetime.date(2018, 4, 8),
+                 datetime.date(2018, 4, 3), datetime.date(2018, 4, 1),
+                 datetime.date(2018, 4, 1)])
+            self.assertContains(response, "Done 5 times")
+
+            # Errors on every field are shown
+            response = self.client.post(
+                reverse('change_task', args=[2]),
+                {'name': "call", 'description': "x" * 281,
+                 'interval_days': '7', 'due': '2018-04-27'})
+            self.assertEqual(
+                [str(m) for m in response.context['messages']],
+                ["This can't be longer than 280 characters"])
+            self.assertEqual(Task.objects.get(id=2).name, "call your mom")
+
+    def test_exact(self):
+        task = Task.objects.get(id=2)
+        for task_type, done, due in [
+                ('normal', '2018-04-01', '2018-04-08'),
+                ('normal', '2018-04-20', '2018-04-27'),
+                ('exact', '2018-03-28', '2018-04-09'),
+                ('exact', '2018-04-02', '2018-04-09'),
+                ('exact', '2018-04-09', '2018-04-16'),
+                ('exact', '2018-04-20', '2018-04-23')]:
+            self.assertEqual(
+                recurrence.next_due(task_type, datetime.date(2018, 4, 2), 7,
+                                    parse_date(done)),
+                parse_date(due))
+
+        task.type = Task.Type.exact
+        task.save()
+        with self.logged_in(), \
+                mock.patch.object(views, 'local_date',
+                                  return_value=datetime.date(2018, 4, 20)):
+            response = self.client.get(reverse('ack_task', args=[2]))
+            self.assertEqual(response.context['task_due'],
+                             datetime.date(2018, 4, 23))
+
+    def test_snooze(self):
+        with self.logged_in(), \
+                mock.patch('call_your_mom.tasks.local_date',
+                           return_value=datetime.date(2018, 4, 5)):
+            response = self.client.get(reverse('snooze_task', args=[2]))
+            self.assertEqual(response.status_code, 200)
+            response = self.client.post(reverse('snooze_task', args=[2]),
+                                        {'days': '2'})
+            self.assertEqual(response.status_code, 200)
+            response = self.client.post(reverse('snooze_task', args=[2]),
+                                        {'days': '3'})
+            self.assertEqual(response.status_code, 302)
+
+        task = Task.objects.get(id=2)
+        self.assertEqual(task.remind_again_at,
+                         datetime.datetime(2018, 4, 8, tzinfo=utc))
+        self.assertEqual(
+            list(Task.objects.to_remind(
+                datetime.datetime(2018, 4, 8, tzinfo=utc))),
+            [task])
+
+    def test_stats(self):
+        with self.logged_in():
+            for done, due in [('2018-04-08', '2018-04-15'),
+                              ('2018-04-03', '2018-04-15'),
+                              ('2018-04-20', '2018-04-27')]:
+                self.client.post(reverse('ack_task', args=[2]),
+                                 {'done': done, 'due': due})
+
+            # Intervals are 0, 2, 5, 12 days; lateness -12, 6, 5 days (the
+            # due date of the fixture's completions is unknown)
+            stats = TaskStats.objects.get(task_id=2)
+            self.assertEqual(stats.median_interval, 3.5)
+            self.assertEqual(stats.mean_lateness, -1 / 3)
+            self.assertEqual((stats.streak, stats.best_streak), (0, 1))
+
+            response = self.client.get(reverse('task_stats', args=[2]))
+            self.assertEqual(response.json(), {
+                'task': 2,
+                'count': 5,
+                'first_done': '2018-04-01',
+                'last_done': '2018-04-20',
+                'mean_interval': 19 / 4,
+                'median_interval': 3.5,
+                'mean_lateness': -1 / 3,
+                'streak': 0,
+                'best_streak': 1,
+            })
+            self.assertEqual(
+                self.client.get(reverse('task_stats', args=[1])).status_code,
+                404)
+
+            response = self.client.get(reverse('profile_stats'))
+            self.assertEqual(response.json()['tasks'], 1)
+            self.assertEqual(response.json()['median_interval'], 3.5)
+
+        # Rebuilding from the history gives the same result
+        TaskStats.objects.all().delete()
+        call_command('rebuild_stats', chunk_size=1, stderr=io.StringIO())
+        rebuilt = TaskStats.objects.get(task_id=2)
+        fields = [f.name for f in TaskStats._meta.fields]
+        self.assertEqual([getattr(rebuilt, f) for f in fields],
+                         [getattr(stats, f) for f in fields])
+
+
+class FlakyEmailBackend(EmailBackend):
+    """Email backend losing its connection every few messages.
+    """
+    def __init__(self, fail_every, **kwargs):
+        super(FlakyEmailBackend, self).__init__(**kwargs)
+        self.fail_every = fail_every
+        self.attempts = 0
+        self.opened = 0
+
+    def open(self):
+        self.opened += 1
+
+    def send_messages(self, messages):
+        self.attempts += 1
+        if self.attempts % self.fail_every == 0:
+            raise smtplib.SMTPServerDisconnected("Connection lost")
+        return super(FlakyEmailBackend, self).send_messages(messages)
+
+
+class RemindersTestCase(TestCase):
+    fixtures = ['test.json']
+
+    def create_task(self, user, **kwargs):
+        task = Task(user=user, **kwargs)
+        task.schedule_reminder(user.timezone)
+        task.save()
+        return task
+
+    def setUp(self):
+        self.users = {}
+        for tz in ('Pacific/Kiritimati', 'Pacific/Pago_Pago'):
+            self.users[tz] = CYMUser.objects.create(
+                email='{0}@example.com'.format(tz.split('/')[1]),
+                last_login_email=datetime.datetime(2018, 4, 2, 16, 0, 0,
+                                                   tzinfo=utc),
+                timezone=tz)
+        for user in self.users.values():
+            self.create_task(user=user, name="call", description="",
+                             interval_days=7,
+                             due=datetime.date(2018, 4, 11))
+
+    def test_schedule_on_save(self):
+        # Local date is 2018-04-11 in Kiritimati but 2018-04-10 in Pago Pago
+        now = datetime.datetime(2018, 4, 10, 12, 0, tzinfo=utc)
+        self.assertEqual(
+            [task.user.timezone for task in Task.objects.to_remind(now)],
+            ['Pacific/Kiritimati'])
+
+        # Saved without scheduling, e.g. from the shell
+        task = Task.objects.get(user=self.users['Pacific/Pago_Pago'])
+        task.due = datetime.date(2018, 4, 10)
+        task.save()
+        task = Task.objects.get(user__timezone='Pacific/Kiritimati')
+        task.reminded = task.due
+        task.save(update_fields=['reminded'])
+        self.assertEqual(
+            [task.user.timezone for task in Task.objects.to_remind(now)],
+            ['Pacific/Pago_Pago'])
+
+        # Other fields don't need the user
+        task = Task.objects.get(user__timezone='Pacific/Pago_Pago')
+        task.name = "call mom"
+        with self.assertNumQueries(1):
+            task.save()
+
+    def test_admin_timezone(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.org',
+                                              'admin')
+        self.client.force_login(admin)
+        user = self.users['Pacific/Kiritimati']
+        response = self.client.post(
+            reverse('admin:call_your_mom_cymuser_change', args=[user.id]),
+            {'email': user.email, 'language': 'en',
+             'last_login_email_0': '2018-04-02',
+             'last_login_email_1': '16:00:00',
+             'last_login_0': '2018-04-02', 'last_login_1': '16:00:00',
+             'timezone': 'Pacific/Pago_Pago'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            Task.objects.get(user=user).next_reminder_at,
+            datetime.datetime(2018, 4, 11, 11, 0, tzinfo=utc))
+
+    def test_next_due_time(self):
+        # Task is due 2018-04-11, local midnight in Kiritimati (+14) is 10:00
+        # UTC the day before, in Pago Pago (-11) it is 11:00 UTC that day
+        now = datetime.datetime(2018, 4, 10, 0, 0, tzinfo=utc)
+        self.assertEqual(reminders.next_due_time(now),
+                         datetime.datetime(2018, 4, 10, 10, 0, tzinfo=utc))
+        now = datetime.datetime(2018, 4, 10, 12, 0, tzinfo=utc)
+        self.assertEqual(reminders.next_due_time(now),
+                         datetime.datetime(2018, 4, 11, 11, 0, tzinfo=utc))
+        now = datetime.datetime(2018, 4, 11, 12, 0, tzinfo=utc)
+        self.assertIsNone(reminders.next_due_time(now))
+
+    def test_reschedule(self):
+        user = self.users['Pacific/Pago_Pago']
+        task = user.task_set.get()
+        self.assertEqual(task.next_reminder_at,
+                         datetime.datetime(2018, 4, 11, 11, 0, tzinfo=utc))
+
+        user.timezone = 'Europe/Paris'
+        user.save()
+        self.assertEqual(user.task_set.reschedule(user.timezone), 1)
+        task.refresh_from_db()
+        self.assertEqual(task.next_reminder_at,
+                         datetime.datetime(2018, 4, 10, 22, 0, tzinfo=utc))
+        self.assertEqual(
+            list(user.task_set.to_remind(
+                datetime.datetime(2018, 4, 10, 22, 0, tzinfo=utc))),
+            [task])
+
+        # Reminded tasks are not rescheduled
+        # Reminded on the day before in UTC, but on the due date in Paris
+        reminders.mark_reminded(
+            [(task.id, user.timezone)],
+            datetime.datetime(2018, 4, 10, 23, 0, tzinfo=utc))
+        self.assertEqual(user.task_set.reschedule(user.timezone), 0)
+        task.refresh_from_db()
+        self.assertIsNone(task.next_reminder_at)
+        self.assertEqual(task.reminded, task.due)
+
+    def test_catch_up(self):
+        for user in self.users.values():
+            user.task_set.update(type=Task.Type.exact)
+        reminders.mark_reminded(
+            Task.objects.values_list('id', 'user__timezone'),
+            datetime.datetime(2018, 4, 10, 12, 0, tzinfo=utc))
+        self.create_task(user=self.users['Pacific/Kiritimati'],
+                         name="rent", description="", type=Task.Type.exact,
+                         interval_days=30, due=datetime.date(2018, 4, 1))
+        revision = CYMUser.objects.get(email='Kiritimati@example.com').revision
+
+        # 2018-04-25 in Kiritimati, 2018-04-24 in Pago Pago
+        now = datetime.datetime(2018, 4, 24, 12, 0, tzinfo=utc)
+        with self.assertNumQueries(13):
+            self.assertEqual(recurrence.catch_up(now), 2)
+        self.assertEqual(
+            sorted((t.user.timezone, t.name, t.due, t.next_reminder_at)
+                   for t in Task.objects.filter(type=Task.Type.exact)),
+            [('Pacific/Kiritimati', 'call', datetime.date(2018, 4, 25), now),
+             ('Pacific/Kiritimati', 'rent', datetime.date(2018, 4, 1),
+              datetime.datetime(2018, 3, 31, 10, 0, tzinfo=utc)),
+             ('Pacific/Pago_Pago', 'call', datetime.date(2018, 4, 18), now)])
+        self.assertEqual(
+            CYMUser.objects.get(email='Kiritimati@example.com').revision,
+            revision + 1)
+
+        self.assertFalse(Task.objects.filter(
+            name="call", remind_again_at__isnull=False).exists())
+
+        # Nothing left to move
+        self.assertEqual(recurrence.catch_up(now), 0)
+        # Also reminds again of the fixture's task, that wasn't done
+        self.assertEqual(
+            reminders.enqueue_reminders(now, batch_size=10), 4)
+
+    def test_reminded_local_date(self):
+        task = self.users['Pacific/Pago_Pago'].task_set.get()
+        task.due = datetime.date(2018, 4, 5)
+        task.schedule_reminder(task.user.timezone)
+        task.save()
+
+        # Still 2018-04-19 in Pago Pago
+        now = datetime.datetime(2018, 4, 20, 0, 5, tzinfo=utc)
+        reminders.mark_reminded([(task.id, task.user.timezone)], now)
+        task.refresh_from_db()
+        self.assertEqual(task.reminded, datetime.date(2018, 4, 19))
+
+        # Done, and due again on the day it was reminded
+        acknowledge_task(task, {'done': datetime.date(2018, 4, 18),
+                                'due': datetime.date(2018, 4, 19)},
+                         task.user)
+        task.refresh_from_db()
+        self.assertEqual((task.remind_count, task.remind_again_at), (0, None))
+        self.assertEqual(task.next_reminder_at,
+                         datetime.datetime(2018, 4, 19, 11, 0, tzinfo=utc))
+        self.assertIn(task, Task.objects.to_remind(now))
+
+    def test_due_date_round_trip(self):
+        user = self.users['Pacific/Pago_Pago']
+        task = user.task_set.get()
+        now = datetime.datetime(2018, 4, 11, 12, 0, tzinfo=utc)
+        reminders.send_reminders(now=now)
+        self.assertEqual(len(mail.outbox), 2)
+
+        # Moved to another date and back to the one it was reminded of
+        values = {'type': task.type, 'name': task.name,
+                  'description': task.description,
+                  'interval_days': task.interval_days}
+        for due in (datetime.date(2018, 4, 12), datetime.date(2018, 4, 11)):
+            task = Task.objects.get(id=task.id)
+            save_task(task, dict(values, due=due), user)
+        summary = reminders.send_reminders(now=now)
+        self.assertEqual(summary, (1, 1, 0))
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(
+            list(ReminderOutbox.objects.filter(task=task)
+                 .values_list('due', 'remind_count', 'status')),
+            [(datetime.date(2018, 4, 11), 1, ReminderOutbox.Status.sent)] * 2)
+
+    def test_remind_again(self):
+        Task.objects.filter(id=2).delete()
+        now = datetime.datetime(2018, 4, 11, 12, 0, tzinfo=utc)
+        self.assertEqual(reminders.enqueue_reminders(now), 2)
+        self.assertEqual(reminders.next_due_time(now),
+                         datetime.datetime(2018, 4, 14, 12, 0, tzinfo=utc))
+
+        # Again after 3 days, then every 7 days
+        for days, queued in [(2, 0), (3, 2), (9, 0), (10, 2), (17, 2)]:
+            self.assertEqual(
+                reminders.enqueue_reminders(
+                    now + datetime.timedelta(days=days)),
+                queued)
+        self.assertEqual(
+            sorted(ReminderOutbox.objects.values_list('remind_count',
+                                                      flat=True)),
+            [1, 1, 2, 2, 3, 3, 4, 4])
+
+        # Doing the task stops the reminders
+        task = self.users['Pacific/Kiritimati'].task_set.get()
+        task.due = datetime.date(2018, 5, 20)
+        task.schedule_reminder(task.user.timezone)
+        task.save()
+        self.assertEqual((task.remind_count, task.remind_again_at), (0, None))
+        with mock.patch.object(reminders, 'REMIND_AGAIN_DAYS', []):
+            self.assertEqual(
+                reminders.enqueue_reminders(
+                    now + datetime.timedelta(days=40)),
+                2)
+            self.assertEqual(
+                reminders.enqueue_reminders(
+                    now + datetime.timedelta(days=80)),
+                0)
+
+    def test_command(self):
+        call_command('send_reminders', stderr=io.StringIO())
+        self.assertEqual(
+            sorted(m.to[0] for m in mail.outbox),
+            ['Kiritimati@example.com', 'Pago_Pago@example.com'])
+
+        # Running again doesn't send anything
+        call_command('send_reminders', stderr=io.StringIO())
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_scheduler_errors(self):
+        class Stop(Exception):
+            pass
+
+        command = run_scheduler.Command(stderr=io.StringIO())
+        with mock.patch.object(command, 'run_once',
+                               side_effect=[RuntimeError("db down"),
+                                            None]) as run_once, \
+                mock.patch.object(threading.Event, 'wait',
+                                  side_effect=[None, Stop]) as wait, \
+                mock.patch.object(run_scheduler.signal, 'signal'), \
+                mock.patch.object(run_scheduler.connections, 'all',
+                                  return_value=[]), \
+                self.assertLogs(run_scheduler.__name__, 'ERROR') as logs:
+            with self.assertRaises(Stop):
+                call_command(command, max_sleep=600)
+        self.assertIn("db down", logs.output[0])
+        # Waited a bit after the error, then ran again
+        self.assertAlmostEqual(wait.call_args_list[0][0][0],
+                               run_scheduler.ERROR_SLEEP, delta=1)
+        self.assertEqual(run_once.call_count, 2)
+
+    def test_query_count(self):
+        for user in self.users.values():
+            for i in range(5):
+                self.create_task(user=user, name="task", description="",
+                                 interval_days=7,
+                                 due=datetime.date(2018, 4, 1))
+
+        # The number of queries depends on the number of batches, not tasks
+        # Each batch runs in a transaction, which adds 2 SAVEPOINT queries
+
+        # For each batch: select, insert and an update per local date (both
+        # batches have tasks from both timezones), then a final empty select
+        with self.assertNumQueries(2 * (2 + 4) + (2 + 1)):
+            self.assertEqual(reminders.enqueue_reminders(batch_size=6), 12)
+
+        # Requeue stale reminders, then claim (select and update), load and
+        # record results, then a final empty claim
+        # The first batch has tasks from both users, so it gets extended to
+        # all their reminders
+        with self.assertNumQueries(1 + (2 + 2 + 2) + (2 + 1)):
+            summary = reminders.drain_outbox(batch_size=6)
+        self.assertEqual(summary, (12, 12, 0))
+        self.assertEqual(len(mail.outbox), 12)
+        self.assertFalse(reminders.pending_reminders().exists())
+
+    def test_outbox(self):
+        now = datetime.datetime(2018, 4, 12, 12, 0, tzinfo=utc)
+        self.assertEqual(reminders.enqueue_reminders(now), 2)
+        # Already queued
+        self.assertEqual(reminders.enqueue_reminders(now), 0)
+
+        # Reminders can only be claimed once
+        claimed = reminders.claim_reminders(now=now)
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(reminders.claim_reminders(now=now), [])
+
+        # Until the worker is assumed to have died
+        later = now + reminders.STALE_CLAIM_DELAY
+        self.assertEqual(reminders.requeue_stale(later), 0)
+        later += datetime.timedelta(seconds=1)
+        self.assertEqual(reminders.requeue_stale(later), 2)
+        claimed = reminders.claim_reminders(now=later)
+        self.assertEqual([reminder.attempts for reminder in claimed], [2, 2])
+
+    def test_mailer(self):
+        for user in self.users.values():
+            for i in range(5):
+                self.create_task(user=user, name="task", description="",
+                                 interval_days=7,
+                                 due=datetime.date(2018, 4, 1))
+
+        backend = FlakyEmailBackend(fail_every=4)
+        mailer = reminders.Mailer(backend, messages_per_connection=2)
+        summary = reminders.send_reminders(mailer_factory=lambda: mailer)
+        self.assertEqual(summary, (12, 12, 0))
+        self.assertEqual(len(mail.outbox), 12)
+        self.assertEqual(backend.attempts, 15)
+        # Initial connection, 3 reconnections after a failure, and 4 recycled
+        # connections
+        self.assertEqual(backend.opened, 8)
+
+        # Rejected messages are not sent again
+        backend = FlakyEmailBackend(fail_every=4)
+        mailer = reminders.Mailer(backend)
+        message = mail.EmailMessage("test", "test", to=['a@example.org'])
+        refused = smtplib.SMTPRecipientsRefused({})
+        with mock.patch.object(backend, 'send_messages',
+                               side_effect=refused) as send_messages, \
+                self.assertLogs('call_your_mom.reminders', 'ERROR'):
+            self.assertFalse(mailer.send(message))
+        self.assertEqual(send_messages.call_count, 1)
+        self.assertEqual(backend.opened, 1)
+
+    def test_workers(self):
+        for user in self.users.values():
+            for i in range(20):
+                self.create_task(user=user, name="task %d" % i,
+                                 description="", interval_days=7,
+                                 due=datetime.date(2018, 4, 1))
+        bad = self.create_task(user=self.users['Pacific/Pago_Pago'],
+                               name="bad", description="",
+                               interval_days=7,
+                               due=datetime.date(2018, 4, 1))
+
+        build_reminder = reminders.build_reminder
+
+        def build(task):
+            if task.id == bad.id:
+                raise ValueError("Can't build this one")
+            return build_reminder(task)
+
+        with mock.patch.object(reminders, 'build_reminder', build):
+            summary = reminders.send_reminders(batch_size=10, workers=4)
+        self.assertEqual(summary, (42, 42, 1))
+        self.assertEqual(len(mail.outbox), 42)
+
+        # The failed reminder will be retried later
+        self.assertFalse(reminders.pending_reminders().exists())
+        reminder = ReminderOutbox.objects.get(task=bad)
+        self.assertEqual(reminder.status, ReminderOutbox.Status.queued)
+        self.assertEqual(reminder.attempts, 1)
+        self.assertIn("Can't build this one", reminder.last_error)
+        self.assertEqual(
+            ReminderOutbox.objects.filter(
+                status=ReminderOutbox.Status.sent).count(),
+            42)
+
+    def test_compiled_emails(self):
+        values = {'name': "plants <3",
+                  'description': "water & feed",
+                  'link': 'http://example.org/ack/1?token=a&b',
+                  'snooze_link': 'http://example.org/snooze/1?token=a&b'}
+        for language in ('en', 'fr'):
+            subject, body, html = emails.render_email('reminder', language,
+                                                      **values)
+            with translation.override(language):
+                self.assertEqual(html, render_to_string(
+                    'call_your_mom/email_reminder.html', values))
+                self.assertEqual(subject, translation.gettext(
+                    "Reminder - {0}").format("plants <3"))
+            self.assertIn("water & feed", body)
+            self.assertIn("water &amp; feed", html)
+            self.assertIn('lang="{0}"'.format(language), html)
+
+    def test_compiled_digest(self):
+        user = self.users['Pacific/Kiritimati']
+        user.language = 'fr'
+        tasks = [
+            self.create_task(user=user, name="plants <3",
+                             description="water & feed", interval_days=7,
+                             due=datetime.date(2018, 4, 1)),
+            self.create_task(user=user, name="mom", description="",
+                             interval_days=7, due=datetime.date(2018, 4, 1)),
+        ]
+        with translation.override('en'):
+            message = reminders.build_digest(user, tasks)
+            # The user's language is not left active
+            self.assertEqual(translation.get_language(), 'en')
+        with translation.override('fr'):
+            self.assertEqual(message.subject, translation.ngettext(
+                "Reminder - {0} task", "Reminder - {0} tasks", 2).format(2))
+        self.assertIn("plants <3\nwater & feed\nhttp", message.body)
+        self.assertIn("\n\nmom\nhttp", message.body)
+        self.assertIn(reverse('ack_task', args=[tasks[1].id]), message.body)
+        html = message.alternatives[0][0]
+        self.assertIn('lang="fr"', html)
+        self.assertIn("<strong>plants &lt;3</strong>: water &amp; feed<br/>",
+                      html)
+        self.assertIn("<strong>mom</strong><br/>", html)
+
+    def test_digest(self):
+        for user in self.users.values():
+            for i in range(5):
+                self.create_task(user=user, name="task %d" % i,
+                                 description="", interval_days=7,
+                                 due=datetime.date(2018, 4, 1))
+
+        # Small batches, so users' tasks have to be carried over
+        summary = reminders.send_reminders(batch_size=4, digest=True)
+        self.assertEqual(summary, (12, 2, 0))
+        self.assertEqual(
+            sorted(m.to[0] for m in mail.outbox),
+            ['Kiritimati@example.com', 'Pago_Pago@example.com'])
+        for message in mail.outbox:
+            self.assertEqual(message.subject, "Reminder - 6 tasks")
+            user = CYMUser.objects.get(email=message.to[0])
+            for task in user.task_set.all():
+                self.assertIn(reverse('ack_task', args=[task.id]),
+                              message.body)
+        self.assertFalse(reminders.pending_reminders().exists())
+
+
+class ProfileTestCase(LogInTestCase):
+    fixtures = ['test.json']
+
+    def test_timezone_select(self):
+        with self.logged_in():
+            response = self.client.get(reverse('profile'))
+            self.assertContains(
+                response,
+                '<option value="UTC" selected>UTC (+00:00)</option>',
+                html=True)
+
+            # Select is cached, the list is not even used
+            calls = []
+
+            def timezone_choices():
+                calls.append(1)
+                return []
+
+            with mock.patch.object(views, 'timezone_choices',
+                                   timezone_choices):
+                response = self.client.get(reverse('profile'))
+            self.assertContains(response, 'Europe/Paris')
+            self.assertEqual(calls, [])
+
+    def test_pagination(self):
+        user = CYMUser.objects.get(id=1)
+        for i in range(views.PROFILE_PAGE_SIZE * 2 + 10):
+            Task.objects.create(user=user, name="task %d" % i, description="",
+                                interval_days=7,
+                                due=datetime.date(2018, 4, 1 + i % 20))
+        TaskDone.objects.create(task_id=3, done=datetime.date(2018, 3, 30))
+
+        with self.logged_in():
+            self.client.get(reverse('profile'))  # Warm up caches
+
+            pages = []
+            url = reverse('profile')
+            while url:
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url)
+                pages.append((response.context['tasks'],
+                              len(queries.captured_queries)))
+                if response.context['next_page']:
+                    url = (reverse('profile') + '?after=' +
+                           response.context['next_page'])
+                else:
+                    url = None
+
+        self.assertEqual([len(tasks) for tasks, _ in pages],
+                         [views.PROFILE_PAGE_SIZE, views.PROFILE_PAGE_SIZE,
+                          11])
+        # Same number of queries on each page
+        self.assertEqual(len(set(count for _, count in pages)), 1)
+
+        tasks = [task for page, _ in pages for task in page]
+        self.assertEqual(tasks,
+                         sorted(tasks, key=lambda task: (task.due, task.id)))
+        self.assertEqual(len(set(task.id for task in tasks)), len(tasks))
+        self.assertTrue(all(task.is_due_now for task in tasks))
+        self.assertEqual(
+            sorted((task.id, task.last_done)
+                   for task in tasks if task.last_done),
+            [(2, datetime.date(2018, 4, 1)), (3, datetime.date(2018, 3, 30))])
+
+
+class ApiTestCase(LogInTestCase):
+    fixtures = ['test.json']
+
+    def setUp(self):
+        super(ApiTestCase, self).setUp()
+        self.auth = {
+            'HTTP_AUTHORIZATION': 'Token ' + auth.make_login_token(1),
+        }
+
+    def api(self, method, name, args=(), data=None, **headers):
+        headers = dict(self.auth, **headers)
+        if data is not None:
+            headers['data'] = json.dumps(data)
+            headers['content_type'] = 'application/json'
+        return getattr(self.client, method)(reverse(name, args=args),
+                                            **headers)
+
+    def test_auth(self):
+        response = self.client.get(reverse('api_tasks'))
+        self.assertEqual(response.status_code, 401)
+        response = self.client.get(reverse('api_tasks'),
+                                   HTTP_AUTHORIZATION='Token nope')
+        self.assertEqual(response.status_code, 401)
+        with self.logged_in():
+            response = self.client.get(reverse('api_tasks'))
+            self.assertEqual(response.status_code, 200)
+            # Changes need the token, there is no CSRF protection
+            response = self.client.post(reverse('api_tasks'), {})
+            self.assertEqual(response.status_code, 401)
+        response = self.api('delete', 'api_tasks')
+        self.assertEqual(response.status_code, 405)
+
+    def test_conditional(self):
+        response = self.api('get', 'api_tasks')
+        self.assertEqual([task['id'] for task in response.json()['tasks']],
+                         [2])
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        # API clients don't have a session
+        client = self.client_class()
+        with self.assertNumQueries(1):
+            response = client.get(reverse('api_tasks'),
+                                  HTTP_IF_NONE_MATCH=etag, **self.auth)
+        self.assertEqual(response.status_code, 304)
+        response = self.api('get', 'api_tasks',
+                            HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        # Changing a task changes the ETag
+        response = self.api('patch', 'api_task', [2], {'interval_days': 3})
+        self.assertEqual(response.json()['interval_days'], 3)
+        response = self.api('get', 'api_tasks', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # So does changing it from the website
+        etag = response['ETag']
+        with self.logged_in():
+            self.client.post(reverse('ack_task', args=[2]),
+                             {'done': '2018-04-08', 'due': '2018-04-15'})
+        response = self.api('get', 'api_tasks', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # Or from another process, that didn't update our cache
+        etag = response['ETag']
+        CYMUser.objects.filter(id=1).update(revision=F('revision') + 1)
+        response = self.api('get', 'api_tasks', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_tasks(self):
+        response = self.api('post', 'api_tasks', data={'name': ''})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(sorted(response.json()['errors']),
+                         ['due', 'interval_days', 'name'])
+        response = self.api('post', 'api_tasks',
+                            data={'name': ["water plants"],
+                                  'description': None,
+                                  'interval_days': 4, 'due': '2018-04-10'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(sorted(response.json()['errors']), ['name'])
+        response = self.api('post', 'api_tasks',
+                            data={'name': "water plants",
+                                  'description': "x" * 281,
+                                  'interval_days': 4, 'due': '2018-04-10'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(sorted(response.json()['errors']), ['description'])
+
+        response = self.api('post', 'api_tasks',
+                            data={'name': "water plants", 'type': "often",
+                                  'interval_days': 4, 'due': '2018-04-10'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(sorted(response.json()['errors']), ['type'])
+
+        response = self.api('post', 'api_tasks',
+                            data={'name': "water plants",
+                                  'description': None,
+                                  'interval_days': 4, 'due': '2018-04-10'})
+        self.assertEqual(response.status_code, 201)
+        task_id = response.json()['id']
+        self.assertEqual(response['Location'],
+                         reverse('api_task', args=[task_id]))
+        self.assertIsNotNone(Task.objects.get(id=task_id).next_reminder_at)
+        self.assertEqual(response.json()['type'], Task.Type.normal)
+
+        # Exact tasks
+        response = self.api('patch', 'api_task', [task_id],
+                            {'type': Task.Type.exact})
+        self.assertEqual(response.json()['type'], Task.Type.exact)
+        response = self.api('patch', 'api_task', [task_id],
+                            {'interval_days': 5})
+        self.assertEqual(Task.objects.get(id=task_id).type, Task.Type.exact)
+
+        response = self.api('put', 'api_task', [task_id],
+                            {'name': "water all plants"})
+        self.assertEqual(response.status_code, 400)
+        response = self.api('get', 'api_task', [task_id])
+        self.assertEqual(response.json()['name'], "water plants")
+
+        response = self.api('post', 'api_task_ack', [task_id],
+                            {'done': '2018-04-09', 'due': '2018-04-13'})
+        self.assertEqual(response.json()['due'], '2018-04-13')
+        response = self.api('get', 'api_task_done', [task_id])
+        self.assertEqual(response.json(), {
+            'done': [{'id': mock.ANY, 'done': '2018-04-09',
+                      'due': '2018-04-10', 'recorded': mock.ANY}],
+            'next': None,
+        })
+
+        response = self.api('delete', 'api_task', [task_id])
+        self.assertEqual(response.status_code, 204)
+        response = self.api('get', 'api_task', [task_id])
+        self.assertEqual(response.status_code, 404)
+        # Not this user's task
+        response = self.api('get', 'api_task_done', [1])
+        self.assertEqual(response.status_code, 404)
+
+
+class BulkTestCase(LogInTestCase):
+    fixtures = ['test.json']
+
+    def test_export(self):
+        Task.objects.filter(id=2).update(type=Task.Type.exact)
+        TaskDone.objects.create(task_id=2, done=datetime.date(2018, 4, 5),
+                                due=datetime.date(2018, 4, 2))
+        exported = {}
+        with self.logged_in():
+            response = self.client.get(reverse('export_tasks',
+                                               args=['csv']))
+            self.assertEqual(response['Content-Type'], 'text/csv')
+            exported['csv'] = b''.join(response.streaming_content)
+            self.assertEqual(
+                exported['csv'].decode('utf-8'),
+                'name,description,type,interval_days,due,done\r\n'
+                'call your mom,,exact,7,2018-04-02,'
+                '2018-04-01 2018-04-01 2018-04-05/2018-04-02\r\n')
+
+            response = self.client.get(reverse('export_tasks',
+                                               args=['json']))
+            exported['json'] = b''.join(response.streaming_content)
+            self.assertEqual(json.loads(exported['json'])['tasks'][0]['done'],
+                             [{'done': '2018-04-01', 'due': None},
+                              {'done': '2018-04-01', 'due': None},
+                              {'done': '2018-04-05', 'due': '2018-04-02'}])
+
+        # Import them back for other users
+        def contents(user_id):
+            return [
+                ((task.type, task.name, task.description, task.interval_days,
+                  task.due),
+                 list(task.taskdone_set.order_by('done', 'id')
+                      .values_list('done', 'due')))
+                for task in Task.objects.filter(user_id=user_id)
+            ]
+
+        for fmt, content in exported.items():
+            user = CYMUser.objects.create(email='%s@example.org' % fmt,
+                                          last_login_email=timezone.now())
+            with tempfile.TemporaryDirectory() as tmp:
+                filename = os.path.join(tmp, 'tasks.' + fmt)
+                with open(filename, 'wb') as fp:
+                    fp.write(content)
+                call_command('import_tasks', user.email, filename,
+                             stderr=io.StringIO())
+            self.assertEqual(contents(user.id), contents(1))
+            task = Task.objects.get(user=user)
+            self.assertIsNotNone(task.next_reminder_at)
+            self.assertEqual(task.stats.count, 3)
+            self.assertEqual(task.stats.mean_lateness, 3)
+            self.assertEqual(CYMUser.objects.get(id=user.id).revision, 1)
+
+    def test_import(self):
+        def upload(name, content):
+            return self.client.post(reverse('import_tasks'), {
+                'file': SimpleUploadedFile(name, content.encode('utf-8')),
+            })
+
+        with self.logged_in():
+            response = upload(
+                'tasks.csv',
+                'name,interval_days,due,done\n'
+                'water plants,3,2018-04-10,2018-04-01 2018-04-04\n'
+                ',3,2018-04-10,\n'
+                'clean,0,2018-04-10,nope\n'
+                'sing,3,2018-04-10,2018-04-01/later\n')
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(Task.objects.count(), 1)
+            self.assertEqual(
+                [str(m) for m in response.wsgi_request._messages],
+                ["Nothing was imported, the file has errors:",
+                 "Task 2: Please give your task a name",
+                 "Task 3: Please give your task an interval in days between "
+                 "occurrences",
+                 "Task 3: Invalid completion {\"done\": \"nope\"}",
+                 "Task 4: Invalid completion {\"done\": \"2018-04-01\", "
+                 "\"due\": \"later\"}"])
+
+            # JSON values of the wrong type are errors too, null is empty
+            response = upload('tasks.json', json.dumps({'tasks': [
+                {'name': "water plants", 'description': None,
+                 'interval_days': 3, 'due': '2018-04-10', 'done': None},
+                {'name': 3, 'description': ["nope"], 'interval_days': 3,
+                 'due': '2018-04-10', 'done': [3]},
+                {'name': "x" * 81, 'interval_days': 3, 'due': 20180410},
+                {'name': "sing", 'type': "often", 'interval_days': 3,
+                 'due': '2018-04-10'},
+            ]}))
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(Task.objects.count(), 1)
+            self.assertEqual(
+                [str(m) for m in response.wsgi_request._messages][-7:],
+                ["Nothing was imported, the file has errors:",
+                 "Task 2: This should be text",
+                 "Task 2: This should be text",
+                 "Task 2: Invalid completion {\"done\": 3}",
+                 "Task 3: Please give your task a due date",
+                 "Task 3: This can't be longer than 80 characters",
+                 "Task 4: Invalid task type \"often\""])
+
+            with self.assertNumQueries(10):
+                upload('tasks.csv',
+                       'name,interval_days,due,done\n' +
+                       ''.join('task {0},3,2018-04-10,2018-04-01 2018-04-04\n'
+                               .format(i) for i in range(50)))
+        self.assertEqual(Task.objects.count(), 51)
+        self.assertEqual(TaskDone.objects.count(), 102)
+        self.assertEqual(TaskStats.objects.count(), 51)
+
+    def test_generate_load_data(self):
+        call_command('generate_load_data', users=30, tasks_per_user=4,
+                     history_days=60, chunk_size=20, seed=4,
+                     stderr=io.StringIO())
+        users = CYMUser.objects.filter(email__startswith='load-')
+        self.assertEqual(users.count(), 30)
+        tasks = Task.objects.filter(user__in=users)
+        self.assertGreater(tasks.count(), 30)
+        self.assertFalse(tasks.filter(next_reminder_at__isnull=True,
+                                      reminded__isnull=True).exists())
+        self.assertEqual(
+            TaskStats.objects.filter(task__in=tasks).count(),
+            tasks.filter(taskdone__isnull=False).distinct().count())
+        for task in tasks.filter(stats__isnull=False)[:10]:
+            self.assertEqual(task.stats.count, task.taskdone_set.count())
+
+        # Running it again would mix up the users
+        with self.assertRaises(CommandError):
+            call_command('generate_load_data', users=5, seed=4,
+                         stderr=io.StringIO())
+        call_command('generate_load_data', users=5, seed=4,
+                     email_prefix='again', stderr=io.StringIO())
+        self.assertEqual(users.count(), 30)
+
+
+class CalendarTestCase(TestCase):
+    fixtures = ['test.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_token(self):
+        response = self.client.get(reverse('calendar_feed',
+                                           args=[auth.make_login_token(1)]))
+        self.assertEqual(response.status_code, 404)
+        # Feed tokens can't be used to log in
+        response = self.client.get(
+            reverse('profile') + '?token=' + auth.make_feed_token(1))
+        self.assertNotIn(CYMUser.USER_ID_KEY, self.client.session)
+
+    def test_feed(self):
+        url = reverse('calendar_feed', args=[auth.make_feed_token(1)])
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'],
+                         'text/calendar; charset=utf-8')
+        feed = response.content.decode('utf-8')
+        self.assertIn('\r\nDTSTART;VALUE=DATE:20180402\r\n', feed)
+        self.assertIn('\r\nSUMMARY:call your mom\r\n', feed)
+        self.assertNotIn('RRULE', feed)
+
+        # Polling only reads the revision and hits the cache
+        etag = response['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+            self.assertEqual(response.content.decode('utf-8'), feed)
+
+        # Changed by another process, whose cached user is not this one's
+        Task.objects.filter(id=2).update(type=Task.Type.exact,
+                                         name="call your mom, or dad " * 5)
+        CYMUser.objects.filter(id=1).update(revision=F('revision') + 1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        feed = response.content.decode('utf-8')
+        self.assertIn('\r\nRRULE:FREQ=DAILY;INTERVAL=7\r\n', feed)
+        self.assertTrue(all(len(line.encode('utf-8')) <= 75
+                            for line in feed.split('\r\n')))
+        self.assertIn('SUMMARY:call your mom\\, or dad', feed)
+
+
+METRICS_MIDDLEWARE = 'call_your_mom.metrics.MetricsMiddleware'
+
+
+@override_settings(MIDDLEWARE=[METRICS_MIDDLEWARE] + [
+    m for m in settings.MIDDLEWARE if m != METRICS_MIDDLEWARE])
+class MetricsTestCase(LogInTestCase):
+    fixtures = ['test.json']
+
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        metrics.install()
+        metrics.clear()
+        patcher = mock.patch.object(metrics, 'ENABLED', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_requests(self):
+        with self.logged_in(), \
+                self.assertLogs('call_your_mom.metrics', 'INFO') as logs:
+            response = self.client.get(reverse('profile'))
+            self.assertEqual(response.status_code, 200)
+        fields = json.loads(logs.records[-1].getMessage().split(' ', 1)[1])
+        self.assertEqual((fields['kind'], fields['name'], fields['status']),
+                         ('request', 'profile', 200))
+        self.assertGreater(fields['queries'], fields['view_queries'])
+        self.assertGreater(fields['view_queries'], 0)
+        self.assertGreater(fields['template_ms'], 0)
+
+        # Only served locally
+        response = self.client.get(reverse('metrics'),
+                                   REMOTE_ADDR='192.0.2.1')
+        self.assertEqual(response.status_code, 404)
+        text = self.client.get(reverse('metrics')).content.decode('utf-8')
+        self.assertIn('cym_request_duration_seconds_count{view="profile"} 1',
+                      text)
+        self.assertIn('cym_view_duration_seconds_bucket{view="profile",'
+                      'le="+Inf"} 1', text)
+        self.assertIn('cym_db_queries_total{scope="profile"} %d'
+                      % fields['queries'], text)
+        self.assertIn('cym_template_render_seconds_count'
+                      '{template="call_your_mom/profile.html"} 1', text)
+
+    def test_reminders(self):
+        queries = {}
+        for workers in (1, 2):
+            Task.objects.filter(id=2).update(
+                reminded=None,
+                next_reminder_at=datetime.datetime(2018, 4, 1, tzinfo=utc))
+            with self.assertLogs('call_your_mom.metrics', 'INFO') as logs:
+                call_command('send_reminders', workers=workers,
+                             stderr=io.StringIO())
+            fields = logs.records[-1].metrics
+            self.assertEqual(
+                (fields['kind'], fields['name'], fields['emails']),
+                ('command', 'send_reminders', 1))
+            # Including the work of the threads
+            self.assertGreater(fields['email_ms'], 0)
+            queries[workers] = fields['queries']
+        self.assertEqual(queries[1], queries[2])
+        self.assertIn('cym_email_send_seconds_count 2', metrics.render())
+
+    def test_disabled(self):
+        metrics.ENABLED = False
+        with self.logged_in():
+            self.client.get(reverse('profile'))
+        self.assertEqual(metrics.REQUEST_DURATION.values, {})
+        self.assertEqual(
+            self.client.get(reverse('metrics')).status_code, 404)
@@ -0,0 +1,112 @@
+"""Cached timezone computations.
+
+Looking up a zone and converting the current time to a local date is done for
+every task in a few places, so zone objects are memoized, and the current
+local date of each zone is cached until the next midnight in that zone.
+
+The list of timezones offered to users is built on first use and cached for
+the day, in this process and in Django's cache.
+"""
+
+import datetime
+from django.core.cache import cache
+from django.utils import timezone
+import functools
+import hashlib
+import pytz
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(name):
+    """Get a timezone object from its name.
+
+    Raises `pytz.exceptions.UnknownTimeZoneError` for invalid names.
+    """
+    return pytz.timezone(name)
+
+
+def local_midnight(day, tz_name):
+    """The instant a day starts in the given timezone, as an aware datetime.
+    """
+    tz = get_timezone(tz_name)
+    start = datetime.datetime.combine(day, datetime.time.min)
+    return tz.normalize(tz.localize(start))
+
+
+# Maps timezone name to (local date, start of that day, start of next day)
+_local_dates = {}
+
+
+def local_date(tz_name, now=None):
+    """The date in the given timezone at instant `now` (default: now).
+    """
+    if now is None:
+        now = timezone.now()
+    entry = _local_dates.get(tz_name)
+    if entry is not None and entry[1] <= now < entry[2]:
+        return entry[0]
+
+    day = timezone.make_naive(now, get_timezone(tz_name)).date()
+    _local_dates[tz_name] = (
+        day,
+        local_midnight(day, tz_name),
+        local_midnight(day + datetime.timedelta(days=1), tz_name),
+    )
+    return day
+
+
+def _format_offset(offset):
+    sign = '+'
+    if offset < 0:
+        offset = -offset
+        sign = '-'
+    return '{}{:02}:{:02}'.format(sign, offset // 3600, (offset // 60) % 60)
+
+
+def _build_timezone_choices(now):
+    choices = []
+    for name in pytz.common_timezones:
+        local = now.astimezone(get_timezone(name))
+        # Show the standard offset, not the daylight saving time one
+        offset = int((local.utcoffset() - local.dst()).total_seconds())
+        choices.append((offset, _format_offset(offset), name))
+    choices = [(n, s) for (o, s, n) in sorted(choices)]
+    version = hashlib.md5(repr(choices).encode('utf-8')).hexdigest()[:12]
+    return version, choices
+
+
+# (UTC date, version, choices)
+_timezone_choices = None
+
+
+def _get_timezone_choices(now=None):
+    global _timezone_choices
+
+    if now is None:
+        now = timezone.now()
+    day = now.date()
+    if _timezone_choices is not None and _timezone_choices[0] == day:
+        return _timezone_choices
+
+    key = 'cym_timezone_choices:{0}'.format(day.isoformat())
+    value = cache.get(key)
+    if value is None:
+        value = _build_timezone_choices(now)
+        cache.set(key, value, 24 * 3600)
+    _timezone_choices = (day,) + tuple(value)
+    return _timezone_choices
+
+
+def timezone_choices(now=None):
+    """List of ``(name, offset)`` for the common timezones, sorted by offset.
+
+    The offsets are the standard ones (not daylight saving time) currently in
+    effect. The list is only computed once a day.
+    """
+    return _get_timezone_choices(now)[2]
+
+
+def timezone_choices_version(now=None):
+    """A string that changes when the list of timezones or offsets changes.
+    """
+    return _get_timezone_choices(now)[1]
@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import api, metrics, views
 
 
 urlpatterns = [
@@ -10,8 +10,22 @@ urlpatterns = [
     path('logout', views.logout, name='logout'),
     path('confirm', views.confirm, name='confirm'),
     path('profile', views.profile, name='profile'),
+    path('profile/stats', views.get_profile_stats, name='profile_stats'),
     path('task/<str:task_id>', views.change_task, name='change_task'),
     path('delete/<int:task_id>', views.delete_task, name='delete_task'),
     path('ack/<int:task_id>', views.ack_task, name='ack_task'),
+    path('snooze/<int:task_id>', views.snooze_task, name='snooze_task'),
+    path('stats/<int:task_id>', views.get_task_stats, name='task_stats'),
+    path('export/tasks.<str:fmt>', views.export_tasks, name='export_tasks'),
+    path('import', views.import_tasks, name='import_tasks'),
+    path('calendar/<str:token>.ics', views.calendar_feed,
+         name='calendar_feed'),
     path('set_lang/<str:lang>', views.set_lang, name='set_lang'),
+    path('metrics', metrics.get_metrics, name='metrics'),
+    path('api/v1/tasks', api.task_list, name='api_tasks'),
+    path('api/v1/tasks/<int:task_id>', api.task_detail, name='api_task'),
+    path('api/v1/tasks/<int:task_id>/ack', api.task_ack,
+         name='api_task_ack'),
+    path('api/v1/tasks/<int:task_id>/done', api.task_done,
+         name='api_task_done'),
 ]
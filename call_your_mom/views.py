@@ -1,23 +1,38 @@
 import datetime
-import dateutil.parser
-import pytz
+import io
 import pytz.exceptions
 from django.contrib import messages
 from django.core.exceptions import ObjectDoesNotExist
-from django.http import HttpResponseNotFound
+from django.db import transaction
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseNotFound, JsonResponse, \
+    StreamingHttpResponse
 from django.shortcuts import redirect, render
 from django.utils import timezone, translation
-from django.utils.translation import gettext as _
-
-from .auth import needs_login, send_login_email, send_register_email, \
-    clear_login, EmailRateLimit
-from .models import CYMUser, Task, TaskDone
+from django.utils.cache import get_conditional_response, \
+    patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.utils.translation import gettext as _, ngettext
+
+from . import bulk
+from . import ical
+from .auth import bump_revision, get_revision, needs_login, \
+    queue_login_email, queue_register_email, clear_login, verify_feed_token, \
+    EmailRateLimit
+from .models import CYMUser, Task, TaskDone, TaskStats
+from .ratelimit import limit_email_requests
+from .recurrence import next_due
+from .stats import stats_dict, user_stats
+from .tasks import SNOOZE_DAYS, acknowledge_task, clean_ack, clean_snooze, \
+    clean_task, remove_task, save_task, snooze_reminder
+from .timezones import get_timezone, local_date, timezone_choices, \
+    timezone_choices_version
 
 
 def index(request):
     """Website index, redirects either to landing page or profile.
     """
-    if request.cym_user is not None:
+    if request.cym_user:
         return redirect('profile')
     else:
         return redirect('landing')
@@ -29,6 +44,7 @@ def landing(request):
     return render(request, 'call_your_mom/landing.html')
 
 
+@limit_email_requests
 def register(request):
     """Registration-or-login page, via which users sign up for the website.
     """
@@ -47,17 +63,18 @@ def register(request):
 
         try:
             if user is not None:
-                send_login_email(user)
+                queue_login_email(user)
                 user.last_login_email = timezone.now()
-                user.save()
+                user.save(update_fields=['last_login_email'])
             else:
-                user = CYMUser(
-                    email=email,
-                    created=timezone.now(),
-                    last_login_email=timezone.now(),
-                )
-                send_register_email(user)
-                user.save()
+                # The user needs an ID for the link
+                with transaction.atomic():
+                    user = CYMUser.objects.create(
+                        email=email,
+                        created=timezone.now(),
+                        last_login_email=timezone.now(),
+                    )
+                    queue_register_email(user)
         except EmailRateLimit:
             messages.add_message(
                 request, messages.ERROR,
@@ -74,6 +91,7 @@ def register(request):
         return render(request, 'call_your_mom/register.html')
 
 
+@limit_email_requests
 def login(request):
     """Login page.
 
@@ -95,9 +113,9 @@ def login(request):
             pass
         else:
             try:
-                send_login_email(user, path)
+                queue_login_email(user, path)
                 user.last_login_email = timezone.now()
-                user.save()
+                user.save(update_fields=['last_login_email'])
             except EmailRateLimit:
                 messages.add_message(
                     request, messages.ERROR,
@@ -129,47 +147,67 @@ def confirm(request):
     return render(request, 'call_your_mom/confirm.html')
 
 
-_somedate = datetime.datetime(2018, 1, 2, 13, 0)
-_timezones = []
-for name in pytz.common_timezones:
-    tz = pytz.timezone(name)
-    offset = tz.utcoffset(_somedate) - tz.dst(_somedate)
-    offset = orig = int(offset.total_seconds())
+PROFILE_PAGE_SIZE = 50
 
-    offset_str = '+'
-    if offset < 0:
-        offset = -offset
-        offset_str = '-'
-    offset_str = '{}{:02}:{:02}'.format(offset_str,
-                                        offset // 3600,
-                                        (offset // 60) % 60)
 
-    _timezones.append((orig, offset_str, name))
-_timezones = [(n, s) for (o, s, n) in sorted(_timezones)]
+def _parse_page_key(value):
+    """Parse the position of a page of tasks, as ``<due>_<id>``.
+    """
+    try:
+        due, task_id = value.split('_', 1)
+        return datetime.datetime.strptime(due, '%Y-%m-%d').date(), int(task_id)
+    except ValueError:
+        return None
 
 
 @needs_login
 def profile(request):
     """A user's profile, listing all his tasks.
+
+    Tasks are sorted by due date and paginated using the (due, id) of the
+    last task on the previous page, so each page costs the same.
     """
     if request.method == 'POST':
         if 'timezone' in request.POST:
             try:
-                tz = pytz.timezone(request.POST['timezone'])
+                tz = get_timezone(request.POST['timezone'])
             except pytz.exceptions.UnknownTimeZoneError:
                 pass
             else:
-                request.cym_user.timezone = tz
-                request.cym_user.save()
+                with transaction.atomic():
+                    request.cym_user.timezone = tz.zone
+                    request.cym_user.save(update_fields=['timezone'])
+                    request.cym_user.task_set.reschedule(tz.zone)
+                    bump_revision(request.cym_user.id)
                 messages.add_message(
                     request, messages.INFO,
                     _("Timezone updated"))
         redirect('profile')
 
+    tasks = (request.cym_user.task_set
+             .only('id', 'user_id', 'name', 'created', 'interval_days', 'due')
+             .with_status(local_date(request.cym_user.timezone))
+             .order_by('due', 'id'))
+    after = _parse_page_key(request.GET.get('after', ''))
+    if after is not None:
+        tasks = tasks.filter(Q(due__gt=after[0]) |
+                             Q(due=after[0], id__gt=after[1]))
+    # Get one more to know if there is a next page
+    tasks = list(tasks[:PROFILE_PAGE_SIZE + 1])
+    next_page = None
+    if len(tasks) > PROFILE_PAGE_SIZE:
+        tasks = tasks[:PROFILE_PAGE_SIZE]
+        next_page = '{0}_{1}'.format(tasks[-1].due.isoformat(), tasks[-1].id)
+
     return render(request, 'call_your_mom/profile.html',
                   {'cym_user': request.cym_user,
-                   'tasks': request.cym_user.task_set.all(),
-                   'timezones': _timezones})
+                   'tasks': tasks,
+                   'first_page': after is None,
+                   'next_page': next_page,
+                   'feed_link': ical.make_feed_link(request.cym_user.id),
+                   # Callable, only evaluated if the fragment isn't cached
+                   'timezones': timezone_choices,
+                   'timezones_version': timezone_choices_version()})
 
 
 @needs_login
@@ -182,6 +220,7 @@ def change_task(request, task_id):
     if task_id == 'new':
         task = None
         task_done_previously = []
+        task_stats = None
     else:
         try:
             task_id = int(task_id)
@@ -194,71 +233,36 @@ def change_task(request, task_id):
         task_done_previously = (
             TaskDone.objects.filter(task=task)
             .order_by('-done')
-            .all()[:30]
+            .values_list('done', flat=True)[:30]
         )
+        try:
+            task_stats = task.stats
+        except ObjectDoesNotExist:
+            task_stats = None
 
     if request.method == 'POST':
-        task_name = request.POST.get('name', '')
-        task_description = request.POST.get('description', '')
-        task_due = request.POST.get('due', '')
-        task_interval_days = request.POST.get('interval_days', '')
-
-        valid = True
-
-        if not task_name:
-            messages.add_message(request, messages.ERROR,
-                                 _("Please give your task a name"))
-            valid = False
-
-        if task_due:
-            try:
-                task_due = dateutil.parser.parse(task_due).date()
-            except ValueError:
-                task_due = None
-        if not task_due:
-            messages.add_message(request, messages.ERROR,
-                                 _("Please give your task a due date"))
-            if task:
-                task_due = task.due
-            else:
-                task_due = (timezone.now() +
-                            datetime.timedelta(days=task_interval_days))
-                task_due = timezone.make_naive(task_due)
-            valid = False
-
-        if task_interval_days:
-            try:
-                task_interval_days = int(task_interval_days)
-            except ValueError:
-                task_interval_days = None
-            if task_interval_days < 1:
-                task_interval_days = None
-        if not task_interval_days:
-            messages.add_message(request, messages.ERROR,
-                                 _("Please give your task an interval in days "
-                                   "between occurrences"))
-            task_interval_days = 7
-            valid = False
-
-        if valid:
-            if task:
-                task.name = task_name
-                task.description = task_description
-                task.interval_days = task_interval_days
-                task.due = task_due
-                task.save()
+        values, errors = clean_task(request.POST, task,
+                                    request.cym_user.timezone)
+        for message in errors.values():
+            messages.add_message(request, messages.ERROR, message)
+
+        if not errors:
+            created = task is None
+            task = save_task(task, values, request.cym_user)
+            if created:
                 messages.add_message(request, messages.INFO,
-                                     _("Task updated"))
+                                     _("Task created"))
             else:
-                task = Task(user_id=request.cym_user.id,
-                            name=task_name,
-                            description=task_description,
-                            interval_days=task_interval_days,
-                            due=task_due)
-                task.save()
                 messages.add_message(request, messages.INFO,
-                                     _("Task created"))
+                                     _("Task updated"))
             return redirect('profile')
+
+        task_name = values['name']
+        task_description = values['description']
+        task_interval_days = values['interval_days']
+        task_due = values['due']
+        task_is_due = task is not None and task.is_due(
+            request.cym_user.timezone)
     elif task:
         task_name = task.name
         task_description = task.description
@@ -269,9 +273,8 @@ def change_task(request, task_id):
         task_name = ''
         task_description = ''
         task_interval_days = 7
-        task_due = (timezone.now() +
+        task_due = (local_date(request.cym_user.timezone) +
                     datetime.timedelta(days=task_interval_days))
-        task_due = timezone.make_naive(task_due).date()
         task_is_due = False
 
     return render(request, 'call_your_mom/change_task.html',
@@ -282,6 +285,7 @@ def change_task(request, task_id):
                    'task_due': task_due,
                    'task_is_due': task_is_due,
                    'task_done_previously': task_done_previously,
+                   'task_stats': task_stats,
                    'new': task is None})
 
 
@@ -297,7 +301,7 @@ def delete_task(request, task_id):
     if not task or task.user.id != request.cym_user.id:
         return HttpResponseNotFound(_("Couldn't find this task!"))
 
-    task.delete()
+    remove_task(task)
     messages.add_message(request, messages.INFO,
                          _("Task deleted"))
 
@@ -319,46 +323,22 @@ def ack_task(request, task_id):
         return HttpResponseNotFound(_("Couldn't find this task!"))
 
     if task and request.method == 'POST':
-        task_done = request.POST.get('done', '')
-        task_due = request.POST.get('due', '')
-
-        valid = True
-
-        if task_done:
-            try:
-                task_done = dateutil.parser.parse(task_done).date()
-            except ValueError:
-                task_done = None
-        if not task_done:
-            messages.add_message(request, messages.ERROR,
-                                 _("Please enter the date you performed the "
-                                   "task"))
-            task_done = timezone.make_naive(timezone.now()).date()
-            valid = False
-
-        if task_due:
-            try:
-                task_due = dateutil.parser.parse(task_due).date()
-            except ValueError:
-                task_due = None
-        if not task_due:
-            messages.add_message(request, messages.ERROR,
-                                 _("Please enter the date this task is due "
-                                   "next"))
-            task_due = task_done + datetime.timedelta(days=task.interval_days)
-            valid = False
-
-        if valid:
-            done = TaskDone(task=task, done=task_done)
-            done.save()
-
-            task.due = task_due
-            task.save()
-
+        values, errors = clean_ack(request.POST, task,
+                                   request.cym_user.timezone)
+        for field in ('done', 'due'):
+            if field in errors:
+                messages.add_message(request, messages.ERROR, errors[field])
+
+        if not errors:
+            acknowledge_task(task, values, request.cym_user)
             return redirect('profile')
+
+        task_done = values['done']
+        task_due = values['due']
     else:
-        task_done = timezone.make_naive(timezone.now()).date()
-        task_due = task_done + datetime.timedelta(days=task.interval_days)
+        task_done = local_date(request.cym_user.timezone)
+        task_due = next_due(task.type, task.due, task.interval_days,
+                            task_done)
 
     return render(request, 'call_your_mom/ack_task.html',
                   {'task': task,
@@ -367,6 +347,135 @@ def ack_task(request, task_id):
                    'task_is_due': task.is_due(request.cym_user.timezone)})
 
 
+@needs_login
+def snooze_task(request, task_id):
+    """Be reminded of a task again later, from a reminder.
+    """
+    try:
+        task = Task.objects.get(id=task_id)
+    except ObjectDoesNotExist:
+        task = None
+    if not task or task.user.id != request.cym_user.id:
+        return HttpResponseNotFound(_("Couldn't find this task!"))
+
+    if request.method == 'POST':
+        values, errors = clean_snooze(request.POST, task,
+                                      request.cym_user.timezone)
+        if 'days' in errors:
+            messages.add_message(request, messages.ERROR, errors['days'])
+        else:
+            snooze_reminder(task, values)
+            messages.add_message(
+                request, messages.INFO,
+                ngettext("You will be reminded again in {0} day",
+                         "You will be reminded again in {0} days",
+                         values['days']).format(values['days']))
+            return redirect('profile')
+
+    return render(request, 'call_your_mom/snooze_task.html',
+                  {'task': task,
+                   'snooze_days': SNOOZE_DAYS})
+
+
+@needs_login
+def get_task_stats(request, task_id):
+    """Statistics on the completions of a task, as JSON.
+    """
+    try:
+        task = Task.objects.select_related('stats').get(id=task_id)
+    except ObjectDoesNotExist:
+        task = None
+    if not task or task.user_id != request.cym_user.id:
+        return HttpResponseNotFound(_("Couldn't find this task!"))
+
+    try:
+        stats = task.stats
+    except ObjectDoesNotExist:
+        stats = TaskStats(task=task)
+    return JsonResponse(dict(stats_dict(stats), task=task.id))
+
+
+@needs_login
+def get_profile_stats(request):
+    """Statistics on the completions of all the user's tasks, as JSON.
+    """
+    return JsonResponse(user_stats(request.cym_user))
+
+
+@needs_login
+def export_tasks(request, fmt):
+    """Download all the user's tasks and their completions.
+    """
+    if fmt not in bulk.FORMATS:
+        return HttpResponseNotFound(_("Unknown format"))
+    response = StreamingHttpResponse(
+        bulk.export_tasks(request.cym_user, fmt),
+        content_type=bulk.FORMATS[fmt],
+    )
+    response['Content-Disposition'] = \
+        'attachment; filename="tasks.{0}"'.format(fmt)
+    return response
+
+
+@needs_login
+def import_tasks(request):
+    """Create tasks from an uploaded file, in one of the export formats.
+    """
+    if request.method != 'POST' or 'file' not in request.FILES:
+        return redirect('profile')
+
+    upload = request.FILES['file']
+    fmt = upload.name.rsplit('.', 1)[-1].lower()
+    if fmt not in bulk.FORMATS:
+        messages.add_message(request, messages.ERROR,
+                             _("Please upload a .csv or .json file"))
+        return redirect('profile')
+
+    try:
+        rows = bulk.read_tasks(
+            io.TextIOWrapper(upload.file, encoding='utf-8', newline=''),
+            fmt,
+        )
+        tasks = bulk.import_tasks(request.cym_user, rows)
+    except bulk.InvalidImport as e:
+        messages.add_message(request, messages.ERROR,
+                             _("Nothing was imported, the file has errors:"))
+        for row, field, message in e.errors[:10]:
+            messages.add_message(
+                request, messages.ERROR,
+                _("Task {0}: {1}").format(row, message))
+    else:
+        messages.add_message(request, messages.INFO,
+                             _("Imported {0} tasks").format(len(tasks)))
+    return redirect('profile')
+
+
+def calendar_feed(request, token):
+    """The user's tasks in iCalendar format, for calendar applications.
+
+    Authenticated by the token in the URL, see `auth.make_feed_token()`. A
+    request that isn't conditional or didn't change only reads the user's
+    revision from the database, and the cache.
+    """
+    user_id = verify_feed_token(token)
+    found = get_revision(user_id) if user_id is not None else None
+    if found is None:
+        return HttpResponseNotFound(_("Unknown calendar"))
+    revision, modified = found
+
+    etag = quote_etag(ical.feed_etag(user_id, revision))
+    last_modified = int(modified.timestamp())
+    response = get_conditional_response(request, etag=etag,
+                                        last_modified=last_modified)
+    if response is None:
+        response = HttpResponse(ical.get_feed(user_id, revision, modified),
+                                content_type='text/calendar; charset=utf-8')
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
 def set_lang(request, lang):
     """Change the language.
     """
@@ -374,5 +483,5 @@ def set_lang(request, lang):
     request.session[translation.LANGUAGE_SESSION_KEY] = lang
     if request.cym_user:
         request.cym_user.language = lang
-        request.cym_user.save()
+        request.cym_user.save(update_fields=['language'])
     return redirect('index')